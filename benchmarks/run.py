@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+"""
+libyate benchmark suite
+
+Measures the codec, the command parser and serializer and an end-to-end
+application loop driven by a fake engine over a socket pair. Results are
+stored as JSON so runs can be compared, including runs of different
+interpreters::
+
+    python -m benchmarks.run -o before.json
+    python -m benchmarks.run -o after.json -c before.json
+
+    python2 -m benchmarks.run -o py2.json
+    python3 -m benchmarks.run -c py2.json
+"""
+
+import json
+import logging
+import optparse
+import os
+import platform
+import socket
+import sys
+import time
+import timeit
+
+from threading import Thread
+
+import libyate
+import libyate.cache
+import libyate.engine
+import libyate.extmodule
+import libyate.net
+import libyate.routing
+import libyate.state
+import libyate.type
+
+from libyate.compat import wire
+from tests.helpers import PairClient
+
+
+BENCHMARKS = []
+
+COMMAND_STRINGS = (
+    '%%>connect:global::',
+    'Error in:%%>install::engine.timer',
+    '%%>install:50:call.route:called:^123',
+    '%%<install:100:call.route:true',
+    '%%>message:234479288:1095112796:call.route::caller=1000:called=2000'
+    ':billid=1095112796-1:answered=false:direct=sip/sip%z2000@10.0.0.1',
+    '%%<message:234479288:true:call.route:sip/sip%z2000@10.0.0.1:'
+    'error=:reason=',
+    '%%>output:arbitrary unescaped string',
+    '%%>setlocal:trackparam:libyate',
+    '%%<setlocal:engine.version:5.0.0:true',
+    '%%>uninstall:call.route',
+    '%%<uninstall:100:call.route:true',
+    '%%>unwatch:engine.timer',
+    '%%<unwatch:engine.timer:true',
+    '%%>watch:engine.timer',
+    '%%<watch:engine.timer:true',
+)
+
+KVP_SIZES = (1, 10, 100, 1000)
+
+
+def benchmark(name, number=10000):
+    """Register a benchmark
+
+    The decorated function receives no arguments and returns the callable to
+    be measured.
+
+    :param str name: benchmark name
+    :param int number: number of calls on each measurement
+    """
+
+    def decorator(func):
+        BENCHMARKS.append((name, number, func))
+        return func
+
+    return decorator
+
+
+def kvp_string(size):
+    """Build an encoded key-value list
+
+    :param int size: number of key-value pairs
+    :return: An encoded key-value list string
+    :rtype: str
+    """
+
+    return ':'.join('key{0}=value%z{0}'.format(i) for i in range(size))
+
+
+#
+# Codec
+#
+
+@benchmark('yate_encode')
+def bench_yate_encode():
+    string = 'sip/sip:2000@10.0.0.1;tag=%1234\n'
+    return lambda: libyate.type.yate_encode(string)
+
+
+@benchmark('yate_decode')
+def bench_yate_decode():
+    string = libyate.type.yate_encode('sip/sip:2000@10.0.0.1;tag=%1234\n')
+    return lambda: libyate.type.yate_decode(string)
+
+
+#
+# Framing
+#
+
+@benchmark('framing.100', 1000)
+def bench_framing():
+    data = wire('\n'.join(COMMAND_STRINGS[4] for _ in range(100)) + '\n')
+
+    def run():
+        buf = libyate.net.LineBuffer()
+
+        # Split the burst in socket sized chunks
+        for i in range(0, len(data), 8192):
+            buf.feed(data[i:i + 8192])
+
+            while buf.readline() is not None:
+                pass
+
+    return run
+
+
+#
+# Parser and serializer
+#
+
+def _register_commands():
+    for string in COMMAND_STRINGS:
+        cls = libyate.engine.KW_CLS_MAP[string.split(':', 1)[0]]
+
+        def parse(s=string):
+            return lambda: libyate.engine.from_string(s)
+
+        def serialize(s=string):
+            cmd = libyate.engine.from_string(s)
+            return lambda: str(cmd)
+
+        benchmark('from_string.{0}'.format(cls.__name__))(parse)
+        benchmark('str.{0}'.format(cls.__name__))(serialize)
+
+_register_commands()
+
+
+def _register_kvp():
+    for size in KVP_SIZES:
+        number = max(10, 10000 // size)
+
+        def parse(n=size):
+            descriptor = libyate.type.KeyValueList()
+            string = kvp_string(n)
+            return lambda: descriptor.format(string)
+
+        def serialize(n=size):
+            kvp = libyate.type.KeyValueList().format(kvp_string(n))
+            return lambda: libyate.type.obj_to_str(kvp)
+
+        benchmark('kvp.parse.{0}'.format(size), number)(parse)
+        benchmark('kvp.serialize.{0}'.format(size), number)(serialize)
+
+_register_kvp()
+
+
+@benchmark('reply.pass')
+def bench_reply_pass():
+    msg = libyate.engine.from_string(COMMAND_STRINGS[4])
+    return lambda: '{0}\n'.format(msg.reply())
+
+
+@benchmark('reply.processed')
+def bench_reply_processed():
+    msg = libyate.engine.from_string(COMMAND_STRINGS[4])
+    return lambda: '{0}\n'.format(msg.reply(True, retvalue='sip/2000'))
+
+
+@benchmark('reply.cached')
+def bench_reply_cached():
+    msg = libyate.engine.from_string(COMMAND_STRINGS[4])
+    handler = libyate.cache.ReplyCache(('called', ))(
+        lambda m: m.reply(True, retvalue='sip/2000'))
+    return lambda: '{0}\n'.format(handler(msg))
+
+
+def _register_routing():
+    # 10000 numbers, 4 to 8 digits, and a few expressions
+    table = libyate.routing.RoutingTable.parse('\n'.join(
+        ['{0} * sip/sip:{{1}}@10.0.0.{1}'.format(
+            str(i * 7919 % 100000000).zfill(4 + i % 5), i % 250)
+         for i in range(10000)] +
+        ['/^9(\\d{{{0}}})$/ * sip/sip:{{1}}@10.0.1.1'.format(i)
+         for i in range(4, 8)] +
+        ['* * -']))
+
+    def run(called):
+        return lambda: lambda: table.lookup(called, '100')
+
+    benchmark('routing.prefix')(run('0791912345'))
+    benchmark('routing.regex')(run('912345'))
+    benchmark('routing.default')(run('812345678901'))
+
+_register_routing()
+
+
+@benchmark('calls.state')
+def bench_calls_state():
+    calls = libyate.state.CallStore()
+    ids = ['sip/{0}'.format(i) for i in range(1000)]
+
+    for id in ids:
+        calls.state(id)
+
+    return lambda: calls.state(ids[500])
+
+
+def _register_reply_kvp():
+    string = '%%>message:1:1095112796:call.route::{0}'.format(kvp_string(100))
+
+    def full():
+        msg = libyate.engine.from_string(string)
+        msg.kvp['key0'] = 'changed'
+        return lambda: '{0}\n'.format(msg.reply(kvp=msg.kvp))
+
+    def changes():
+        msg = libyate.engine.from_string(string)
+        msg.kvp['key0'] = 'changed'
+        return lambda: '{0}\n'.format(msg.reply())
+
+    benchmark('reply.kvp.full.100', 1000)(full)
+    benchmark('reply.kvp.changes.100', 1000)(changes)
+
+_register_reply_kvp()
+
+
+def _register_kvp_raw():
+    sdp = libyate.type.yate_encode('\r\n'.join(
+        ['v=0', 'o=- 1 1 IN IP4 10.0.0.1', 's=-', 'c=IN IP4 10.0.0.1',
+         't=0 0', 'm=audio 5000 RTP/AVP 0 8 101'] +
+        ['a=rtpmap:{0} codec{0}/8000'.format(i) for i in range(100)]))
+    string = '{0}:sdp_raw={1}'.format(kvp_string(10), sdp)
+
+    def parse(raw_size):
+        def setup():
+            descriptor = libyate.type.KeyValueList(tracked=True,
+                                                   raw_size=raw_size)
+            return lambda: descriptor.format(string)['key0']
+
+        return setup
+
+    # Large value not read by the handler
+    benchmark('kvp.raw.eager', 1000)(parse(None))
+    benchmark('kvp.raw.lazy', 1000)(parse(libyate.engine.KVP_RAW_SIZE))
+
+_register_kvp_raw()
+
+
+def _register_output():
+    msg = libyate.engine.from_string(COMMAND_STRINGS[4])
+    replies = [msg.reply(True, retvalue='sip/2000') for _ in range(100)]
+
+    # Unbuffered, so each write costs a system call as with the engine pipe
+    sink = open(os.devnull, 'wb', 0)
+
+    # One write per reply
+    def unbatched():
+        def run():
+            for reply in replies:
+                sink.write(wire('{0}\n'.format(reply)))
+
+        return run
+
+    # The same replies in a single write
+    def batched():
+        buf = bytearray()
+
+        def run():
+            del buf[:]
+
+            for reply in replies:
+                reply.write_to(buf)
+
+            sink.write(buf)
+
+        return run
+
+    benchmark('output.unbatched.100', 100)(unbatched)
+    benchmark('output.batched.100', 100)(batched)
+
+_register_output()
+
+
+@benchmark('message.new')
+def bench_message_new():
+    return lambda: libyate.engine.Message(name='call.execute')
+
+
+@benchmark('message.callback')
+def bench_message_callback():
+    registry = libyate.extmodule.CallbackRegistry()
+
+    def run():
+        id = libyate.engine.message_id()
+        registry.add(id, None)
+        registry.pop(id)
+
+    return run
+
+
+#
+# Application round-trip
+#
+
+def fake_engine(sock, count, stats):
+    """Send messages to the application and wait for all the replies
+
+    :param socket.socket sock: engine side of the socket pair
+    :param int count: number of messages to send
+    :param dict stats: receives the elapsed time
+    """
+
+    message = ('%%>message:{0}:1095112796:call.route::caller=1000:'
+               'called=2000:billid=1095112796-1\n')
+
+    stream = sock.makefile('rb')
+
+    # Wait for the handler installation
+    while not stream.readline().startswith(b'%%>install'):
+        pass
+
+    sock.sendall(b'%%<install:100:call.route:true\n')
+
+    start = time.time()
+
+    sender = Thread(target=lambda: sock.sendall(wire(''.join(
+        message.format(i) for i in range(count)))))
+    sender.start()
+
+    replies = 0
+
+    while replies < count:
+        line = stream.readline()
+
+        if not line:
+            break
+
+        if line.startswith(b'%%<message:'):
+            replies += 1
+
+    stats['elapsed'] = time.time() - start
+    stats['replies'] = replies
+
+    sender.join()
+    sock.shutdown(socket.SHUT_RDWR)
+    sock.close()
+
+
+def round_trip(count, threaded):
+    """Run the application loop against the fake engine
+
+    :param int count: number of messages
+    :param bool threaded: process each message on its own thread
+    :return: Time spent per message in seconds
+    :rtype: float
+    """
+
+    engine_sock, app_sock = socket.socketpair()
+
+    app = PairClient(app_sock)
+    app.install(app.call_route, 'call.route')
+
+    stats = {}
+    engine = Thread(target=fake_engine, args=(engine_sock, count, stats))
+    engine.start()
+
+    app.main(threaded=threaded)
+    engine.join()
+
+    if stats.get('replies') != count:
+        raise RuntimeError('Got {0} of {1} replies'.format(
+            stats.get('replies'), count))
+
+    return stats['elapsed'] / count
+
+
+def run_round_trip(name, count, threaded, repeat):
+    """Measure the application loop
+
+    :return: benchmark result
+    :rtype: dict
+    """
+
+    best = min(round_trip(count, threaded) for _ in range(repeat))
+
+    return {
+        'name': name,
+        'number': count,
+        'repeat': repeat,
+        'usec_per_op': best * 10**6,
+        'ops_per_sec': 1 / best if best else None,
+    }
+
+
+#
+# Runner
+#
+
+def run_benchmark(name, number, func, repeat):
+    """Measure a registered benchmark
+
+    :return: benchmark result
+    :rtype: dict
+    """
+
+    best = min(timeit.Timer(func()).repeat(repeat, number)) / number
+
+    return {
+        'name': name,
+        'number': number,
+        'repeat': repeat,
+        'usec_per_op': best * 10**6,
+        'ops_per_sec': 1 / best if best else None,
+    }
+
+
+def compare(results, baseline):
+    """Print the results side by side with a previous run
+
+    :param list results: results of this run
+    :param dict baseline: results loaded from a previous run
+    """
+
+    previous = dict((r['name'], r) for r in baseline['results'])
+
+    print('Baseline: {0} {1}, libyate {2}'.format(
+        baseline.get('implementation', '?'), baseline.get('python', '?'),
+        baseline.get('libyate', '?')))
+
+    print('{0:<32} {1:>12} {2:>12} {3:>8}'.format(
+        'benchmark', 'before (us)', 'after (us)', 'change'))
+
+    for result in results:
+        old = previous.get(result['name'])
+
+        if old is None:
+            print('{0:<32} {1:>12} {2:>12.3f}'.format(
+                result['name'], '-', result['usec_per_op']))
+            continue
+
+        print('{0:<32} {1:>12.3f} {2:>12.3f} {3:>+7.1f}%'.format(
+            result['name'], old['usec_per_op'], result['usec_per_op'],
+            (result['usec_per_op'] / old['usec_per_op'] - 1) * 100))
+
+
+def main(argv=None):
+    parser = optparse.OptionParser('usage: %prog [options]')
+    parser.add_option('-o', '--output', help='write the results to a JSON '
+                                             'file')
+    parser.add_option('-c', '--compare', help='compare with the results '
+                                              'stored in a JSON file')
+    parser.add_option('-f', '--filter', default='',
+                      help='run only the benchmarks starting with FILTER')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='number of measurements, the best is kept')
+    parser.add_option('-n', '--messages', type='int', default=2000,
+                      help='number of messages for the round-trip benchmark')
+
+    options, _ = parser.parse_args(argv)
+
+    # Keep the application loop quiet
+    logging.basicConfig(level=logging.CRITICAL)
+
+    results = []
+
+    for name, number, func in BENCHMARKS:
+        if name.startswith(options.filter):
+            results.append(run_benchmark(name, number, func, options.repeat))
+            print('{0:<32} {1:>12.3f} us'.format(
+                name, results[-1]['usec_per_op']))
+
+    for name, threaded in (('round_trip', False),
+                           ('round_trip.threaded', True)):
+        if name.startswith(options.filter):
+            results.append(run_round_trip(name, options.messages, threaded,
+                                          options.repeat))
+            print('{0:<32} {1:>12.3f} us'.format(
+                name, results[-1]['usec_per_op']))
+
+    report = {
+        'libyate': libyate.__version__,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'timestamp': time.time(),
+        'results': results,
+    }
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,217 @@
+"""
+libyate - message handler reply caching
+"""
+
+import time
+
+from collections import OrderedDict
+from threading import Lock
+
+import libyate.engine
+import libyate.type
+
+
+# Estimated size in bytes of an entry, besides its strings
+ENTRY_OVERHEAD = 256
+
+
+class ReplyCache(object):
+    """Cache of message handler replies
+
+    For handlers whose decision depends only on a few key-value pairs of the
+    message, like the called number on call.route. The reply of the handler
+    is stored under the values of those pairs and the following messages
+    with the same values are answered from the cache, without calling the
+    handler. Entries expire after the time to live and the least recently
+    used ones are evicted to keep the number of entries and their estimated
+    size within the limits.
+
+    The cache is a handler decorator, also applied by the cache argument of
+    Application.install. Each cache must be used by a single handler.
+
+    :param tuple keys: names of the key-value pairs the reply depends on
+    :param function key: function receiving the message and returning a
+        hashable cache key, or None to bypass the cache; replaces keys
+    :param float ttl: time to live of the entries in seconds, no expiration
+        if None
+    :param int size: maximum number of entries, unlimited if None
+    :param int max_bytes: maximum estimated size of the entries in bytes,
+        unlimited if None
+    :raise ValueError: if neither or both keys and key are given
+    """
+
+    def __init__(self, keys=None, key=None, ttl=60, size=10000,
+                 max_bytes=None):
+
+        if (keys is None) == (key is None):
+            raise ValueError('Either keys or key must be given')
+
+        if key is None:
+            keys = tuple(keys)
+            missing = (None, ) * len(keys)
+
+            def key(cmd):
+                kvp = cmd.kvp
+
+                if kvp is None:
+                    return missing
+
+                return tuple(kvp.get(k) for k in keys)
+
+        self.keys = keys
+        self.key = key
+        self.ttl = ttl
+        self.size = size
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+
+        # Least recently used first
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __call__(self, handler):
+        """Decorate a message handler
+
+        :param function handler: handler function for received messages
+        :return: The handler function answering from the cache
+        :rtype: function
+        """
+
+        def wrapper(cmd):
+            key = self.key(cmd)
+
+            if key is None:
+                return handler(cmd)
+
+            reply = self._get(key, cmd)
+
+            if reply is None:
+                reply = handler(cmd)
+                self._put(key, cmd, reply)
+
+            return reply
+
+        wrapper.__name__ = getattr(handler, '__name__', wrapper.__name__)
+        wrapper.__doc__ = getattr(handler, '__doc__', None)
+        wrapper.cache = self
+
+        return wrapper
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, cmd):
+        """Return the cached reply for the message
+
+        :param libyate.engine.Message cmd: A received message
+        :return: A reply to the message or None if not cached
+        :rtype: libyate.engine.MessageReply
+        """
+
+        key = self.key(cmd)
+
+        if key is not None:
+            return self._get(key, cmd)
+
+    def put(self, cmd, reply):
+        """Store the reply of the handler for the message
+
+        Results other than a reply to the message are not stored.
+
+        :param libyate.engine.Message cmd: A received message
+        :param reply: handler result for the message
+        """
+
+        key = self.key(cmd)
+
+        if key is not None:
+            self._put(key, cmd, reply)
+
+    def clear(self):
+        """Remove every entry"""
+
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def _get(self, key, cmd):
+        """Return the reply for the message from the entry of the key
+
+        :param key: cache key of the message
+        :param libyate.engine.Message cmd: A received message
+        :rtype: libyate.engine.MessageReply
+        """
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry is not None:
+                expires = entry[4]
+
+                if expires is not None and expires <= time.time():
+                    self.bytes -= entry[5]
+                    entry = None
+
+            if entry is None:
+                self.misses += 1
+                return
+
+            # Most recently used
+            self._entries[key] = entry
+            self.hits += 1
+
+        processed, name, retvalue, kvp = entry[:4]
+
+        return cmd.reply(processed, name, retvalue,
+                         None if kvp is None else kvp.copy())
+
+    def _put(self, key, cmd, reply):
+        """Store the reply under the key
+
+        :param key: cache key of the message
+        :param libyate.engine.Message cmd: A received message
+        :param reply: handler result for the message
+        """
+
+        if not isinstance(reply, libyate.engine.MessageReply) or \
+                reply.id != cmd.id:
+            return
+
+        obj_to_str = libyate.type.obj_to_str
+
+        kvp = reply.kvp
+        size = ENTRY_OVERHEAD + len(repr(key)) + \
+            len(obj_to_str(reply.name)) + len(obj_to_str(reply.retvalue))
+
+        if kvp:
+            kvp = libyate.type.OrderedDict(kvp)
+            size += sum(len(obj_to_str(k)) + len(obj_to_str(v))
+                        for k, v in kvp.items())
+        else:
+            kvp = None
+
+        expires = None if self.ttl is None else time.time() + self.ttl
+        entry = (reply.processed, reply.name, reply.retvalue, kvp, expires,
+                 size)
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+
+            if old is not None:
+                self.bytes -= old[5]
+
+            self._entries[key] = entry
+            self.bytes += size
+
+            while self._entries and (
+                    (self.size is not None and
+                     len(self._entries) > self.size) or
+                    (self.max_bytes is not None and
+                     self.bytes > self.max_bytes)):
+                old = self._entries.popitem(last=False)[1]
+                self.bytes -= old[5]
+                self.evictions += 1
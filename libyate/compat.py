@@ -0,0 +1,96 @@
+"""
+libyate - Python 2 and 3 compatibility helpers
+
+Commands are handled as native strings: byte strings on Python 2 and text on
+Python 3. On Python 3 the data exchanged with the engine is decoded once per
+line at the I/O boundary, using UTF-8 with surrogate escapes so any byte
+sequence survives a round trip.
+"""
+
+import sys
+
+
+PY3 = sys.version_info[0] >= 3
+
+if PY3:
+    # noinspection PyUnresolvedReferences,PyCompatibility
+    import queue
+
+    # noinspection PyUnresolvedReferences,PyCompatibility
+    from collections.abc import MutableMapping
+
+    string_types = (str, )
+    text_type = str
+    xrange = range
+
+    def native(data):
+        """Return the native string of data received from the engine
+
+        :param bytes data: received bytes
+        :rtype: str
+        """
+
+        return data.decode('utf-8', 'surrogateescape')
+
+    def wire(string):
+        """Return the bytes of a native string to be sent to the engine,
+        bytes-like objects are returned unchanged
+
+        :param str string: native string
+        :rtype: bytes
+        """
+
+        if isinstance(string, str):
+            return string.encode('utf-8', 'surrogateescape')
+
+        return string
+
+else:
+    # noinspection PyUnresolvedReferences
+    import Queue as queue
+
+    # noinspection PyUnresolvedReferences
+    from collections import MutableMapping
+
+    # noinspection PyUnresolvedReferences
+    string_types = (str, unicode)
+    # noinspection PyUnresolvedReferences
+    text_type = unicode
+    # noinspection PyUnresolvedReferences
+    xrange = xrange
+
+    def native(data):
+        """Return the native string of data received from the engine
+
+        :param str data: received bytes
+        :rtype: str
+        """
+
+        return data
+
+    def wire(string):
+        """Return the bytes of a native string to be sent to the engine,
+        bytes-like objects are returned unchanged
+
+        :param str string: native string
+        :rtype: str
+        """
+
+        return string
+
+
+def with_metaclass(meta, *bases):
+    """Create a base class with a metaclass, for both Python 2 and 3
+
+    :param type meta: metaclass
+    :param bases: base classes, object if missing
+    :return: A temporary class replaced by the metaclass on subclassing
+    :rtype: type
+    """
+
+    # noinspection PyDocstring
+    class Metaclass(meta):
+        def __new__(mcs, name, this_bases, attrs):
+            return meta(name, bases or (object, ), attrs)
+
+    return type.__new__(Metaclass, 'temporary_class', (), {})
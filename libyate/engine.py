@@ -2,16 +2,101 @@
 libyate - engine command definitions
 """
 
+import os
+import random
+
 from abc import abstractmethod
 from datetime import datetime
+from itertools import count
 
 import libyate.type
 
+from libyate.compat import PY3, wire, with_metaclass
 
-_id = id
 
 KW_CLS_MAP = {}
 
+# Size of the message values kept encoded until read, like raw SDP bodies
+KVP_RAW_SIZE = 1024
+
+
+class IdGenerator(object):
+    """Collision-free message ID generator
+
+    IDs are a per-process prefix followed by a sequence number, both written
+    with characters that never need to be encoded. Generating an ID is a
+    single counter increment, atomic under the GIL.
+
+    :param str prefix: ID prefix, a random prefix based on the process ID if
+        None
+    """
+
+    def __init__(self, prefix=None):
+        self.prefix = None
+        self._counter = None
+
+        self.reset(prefix)
+
+    def __call__(self):
+        return self.prefix + str(next(self._counter))
+
+    def reset(self, prefix=None):
+        """Start a new sequence, used on fork so the child process does not
+        generate the IDs of its parent
+
+        :param str prefix: ID prefix, a new random prefix if None
+        """
+
+        if prefix is None:
+            prefix = '{0:x}.{1:x}.'.format(os.getpid(),
+                                           random.getrandbits(32))
+
+        self.prefix = prefix
+        self._counter = count(1)
+
+    def sequence(self, id):
+        """Return the sequence number of an ID generated by this object
+
+        :param str id: message ID
+        :return: The sequence number, None for other IDs
+        :rtype: int
+        """
+
+        prefix = self.prefix
+
+        if not id.startswith(prefix):
+            return None
+
+        digits = id[len(prefix):]
+
+        try:
+            sequence = int(digits)
+        except ValueError:
+            return None
+
+        # Only the canonical form, int() also accepts signs and underscores
+        if str(sequence) != digits:
+            return None
+
+        return sequence
+
+    def format(self, sequence):
+        """Return the ID of a sequence number
+
+        :param int sequence: sequence number
+        :rtype: str
+        """
+
+        return self.prefix + str(sequence)
+
+
+# Default IDs of the messages created by this process
+message_id = IdGenerator()
+
+if hasattr(os, 'register_at_fork'):
+    # noinspection PyUnresolvedReferences
+    os.register_at_fork(after_in_child=message_id.reset)
+
 
 class CommandMeta(libyate.type.DescriptorMeta):
     """Meta class for Yate command objects"""
@@ -27,11 +112,9 @@ class CommandMeta(libyate.type.DescriptorMeta):
         return cls
 
 
-class Command(object):
+class Command(with_metaclass(CommandMeta)):
     """Object representing an Yate command"""
 
-    __metaclass__ = CommandMeta
-
     __descriptors__ = None
     __keyword__ = None
 
@@ -46,6 +129,8 @@ class Command(object):
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    __hash__ = object.__hash__
+
     def __iter__(self):
         if self.__keyword__ is None:
             raise NotImplementedError('Unknown keyword for class {0}'
@@ -68,8 +153,28 @@ class Command(object):
     def __str__(self):
         return ':'.join(self)
 
-    def __unicode__(self):
-        return str(self).decode()
+    def write_to(self, buf):
+        """Append the command string and its line terminator to a buffer
+
+        The command is formatted through str(), as when sent alone, so only
+        the write is saved. Lets several commands be sent with one write,
+        like the commands replayed after a reconnection.
+
+        :param bytearray buf: output buffer
+        :return: The number of bytes appended
+        :rtype: int
+        """
+
+        data = wire(str(self))
+
+        buf += data
+        buf += b'\n'
+
+        return len(data) + 1
+
+    if not PY3:
+        def __unicode__(self):
+            return str(self).decode('utf-8')
 
 
 class Connect(Command):
@@ -155,12 +260,15 @@ class InstallReply(Command):
 class Message(Command):
     """Yate message command
 
-    :param str id: obscure unique message ID string generated by Yate
+    :param str id: obscure unique message ID string generated by Yate, a new
+        message_id() if None
     :param time: time (in seconds) the message was initially created
     :type time: str, int or datetime.datetime
     :param str name: name of the message
     :param str retvalue: default textual return value of the message
-    :param kvp: enumeration of the key-value pairs of the message
+    :param kvp: enumeration of the key-value pairs of the message, changes
+        made to them are tracked and sent with the reply; on Python 3,
+        encoded values larger than KVP_RAW_SIZE are decoded only when read
     :type kvp: dict, list, set, tuple or libyate.type.OrderedDict
     """
 
@@ -170,14 +278,15 @@ class Message(Command):
     time = libyate.type.DateTime()
     name = libyate.type.EncodedString()
     retvalue = libyate.type.EncodedString(blank=True)
-    kvp = libyate.type.KeyValueList(blank=True)
+    kvp = libyate.type.KeyValueList(blank=True, tracked=True,
+                                    raw_size=KVP_RAW_SIZE)
 
     # noinspection PyShadowingBuiltins
     def __init__(self, id=None, time=None, name=None, retvalue=None,
                  kvp=None):
 
         if id is None:
-            id = _id(self)
+            id = message_id()
 
         if time is None:
             time = datetime.utcnow()
@@ -191,17 +300,36 @@ class Message(Command):
     def reply(self, processed=False, name=None, retvalue=None, kvp=None):
         """Generate a message reply
 
+        Key-value pairs set or deleted on the message since it was received
+        are included in the reply, deleted keys as delete markers.
+
         :param bool processed: indication of if the message has been processed
             or it should be passed to the next handler
         :param str name: new name of the message, if empty keep unchanged
         :param str retvalue: new textual return value of the message
-        :param kvp: new key-value pairs to set in the message; to delete the
-            key-value pair provide just a key name with no equal sign or value
+        :param kvp: new key-value pairs to set in the message, added to the
+            tracked changes; to delete the key-value pair provide just a key
+            name with no equal sign or value
         :type kvp: dict, list, set, tuple or libyate.type.OrderedDict
         :return: A MessageReply object
         :rtype libyate.cmd.MessageReply
         """
 
+        current = self.kvp
+
+        if isinstance(current, libyate.type.TrackedDict) and current.modified:
+            changes = current.changes()
+
+            if kvp:
+                changes.update(libyate.type.OrderedDict(kvp))
+
+            kvp = changes
+
+        # Common replies are serialized directly from the message id
+        if name is None and not kvp and isinstance(processed, bool) and \
+                (retvalue is None or isinstance(retvalue, str)):
+            return PreparedReply(self.id, processed, retvalue)
+
         return MessageReply(id=self.id, processed=processed, name=name,
                             retvalue=retvalue, kvp=kvp)
 
@@ -235,6 +363,63 @@ class MessageReply(Command):
             id=id, processed=processed, name=name, retvalue=retvalue, kvp=kvp)
 
 
+class PreparedReply(MessageReply):
+    """Yate message reply serialized on creation
+
+    Used by Message.reply() for replies without name and key-value pairs,
+    such as the pass-through reply. The command string is built directly from
+    the message ID, skipping the descriptors. Assigning any attribute drops
+    the prepared string and falls back to the regular serialization.
+
+    :param str id: same message ID string received from the message
+    :param bool processed: indication of if the message has been processed or
+        it should be passed to the next handler
+    :param str retvalue: new textual return value of the message
+    """
+
+    # noinspection PyMissingConstructor,PyShadowingBuiltins
+    def __init__(self, id, processed=False, retvalue=None):
+        id = str(id)
+        retvalue = retvalue or None
+
+        if retvalue is None:
+            string = (_REPLY_PROCESSED if processed else _REPLY_IGNORED)
+        else:
+            string = '{0}{1}:'.format(
+                _REPLY_RETVALUE_PROCESSED if processed else
+                _REPLY_RETVALUE_IGNORED, libyate.type.yate_encode(retvalue))
+
+        self.__dict__.update(id=id, processed=processed, name=None,
+                             retvalue=retvalue, kvp=None,
+                             __string__=''.join((
+                                 _REPLY_PREFIX, libyate.type.yate_encode(id),
+                                 string)))
+
+    def __setattr__(self, key, value):
+        self.__dict__.pop('__string__', None)
+        super(PreparedReply, self).__setattr__(key, value)
+
+    def __delattr__(self, key):
+        self.__dict__.pop('__string__', None)
+        super(PreparedReply, self).__delattr__(key)
+
+    def __str__(self):
+        string = self.__dict__.get('__string__')
+
+        if string is None:
+            return super(PreparedReply, self).__str__()
+
+        return string
+
+
+# Fragments of the prepared replies
+_REPLY_PREFIX = MessageReply.__keyword__ + ':'
+_REPLY_PROCESSED = ':true:::'
+_REPLY_IGNORED = ':false:::'
+_REPLY_RETVALUE_PROCESSED = ':true::'
+_REPLY_RETVALUE_IGNORED = ':false::'
+
+
 class Output(Command):
     """Yate output command
 
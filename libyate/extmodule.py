@@ -2,40 +2,87 @@
 libyate - external module application code
 """
 
+import heapq
 import logging
-import Queue
+import random
 import signal
 import socket
 import sys
+import time
 
 from abc import ABCMeta, abstractmethod
-from threading import Thread
+from itertools import count
+from threading import Condition, Lock, Thread
 
 import libyate.engine
+import libyate.metrics
+import libyate.net
+import libyate.scheduler
+import libyate.type
+
+from libyate.compat import queue, wire, with_metaclass, xrange
+
+
+# Maximum number of queued commands serialized into a single write
+OUTPUT_BATCH_SIZE = 64
 
 
 # noinspection PyBroadException
-class Application(object):
+class Application(with_metaclass(ABCMeta)):
     """Yate external module application
 
     :param str name: application name for logging purposes
     :param str trackparam: value for handler tracking parameter
     :param bool restart: restart module if it terminates unexpectedly
+    :param libyate.metrics.Metrics metrics: metrics registry, a new one is
+        created if None
+    :param libyate.metrics.Profiler profiler: stage profiler for sampled
+        messages, disabled if None
+    :param dict weights: weight of each scheduling class on the input queue,
+        libyate.scheduler.DEFAULT_WEIGHTS if None
+    :param libyate.state.CallStore calls: per-call state store, the states
+        are removed after the chan.hangup handlers and watchers return,
+        chan.hangup is watched if no watcher is installed
     """
 
-    __metaclass__ = ABCMeta
-
-    def __init__(self, name=None, trackparam=None, restart=None):
+    def __init__(self, name=None, trackparam=None, restart=None,
+                 metrics=None, profiler=None, weights=None, calls=None):
 
-        self.__msg_callback__ = {}
+        self.__msg_callback__ = CallbackRegistry()
+        self.__msg_deadlines__ = {}
         self.__msg_handlers__ = {}
         self.__msg_watchers__ = {}
 
+        self.__handler_classes__ = {}
+        self.__watcher_classes__ = {}
+
+        self.__handler_batches__ = {}
+        self.__watcher_batches__ = {}
+
+        self.__handler_caches__ = {}
+
+        # Commands defining the module state, to be replayed on reconnection
+        self.__replay__ = libyate.type.OrderedDict()
+
+        self.__timers__ = []
+        self.__timer_cond__ = Condition(Lock())
+        self.__timer_seq__ = count()
+        self.__timer_thread__ = None
+
         self.__input_buffer__ = None
 
-        self.__input_queue__ = Queue.Queue()
-        self.__output_queue__ = Queue.Queue()
-        self.__startup_queue__ = Queue.Queue()
+        self.__input_queue__ = libyate.scheduler.FairQueue(weights)
+        self.__output_queue__ = queue.Queue()
+        self.__startup_queue__ = queue.Queue()
+
+        self.calls = calls
+
+        if metrics is None:
+            metrics = libyate.metrics.Metrics()
+
+        self.metrics = metrics
+        self.profiler = profiler
+        self._register_metrics()
 
         if name is None:
             self.logger = logging.getLogger(
@@ -52,6 +99,66 @@ class Application(object):
             self.logger.debug('Setting module restart parameter')
             self.set_local('restart', 'true' if restart else 'false')
 
+        # Replaced by any watcher installed later
+        if calls is not None:
+            self.watch(None, 'chan.hangup')
+
+    def _register_metrics(self):
+        """Describe the application metrics and register the gauges"""
+
+        m = self.metrics
+
+        m.describe('libyate_received_bytes_total',
+                   'Bytes received from the engine')
+        m.describe('libyate_sent_bytes_total', 'Bytes sent to the engine')
+        m.describe('libyate_commands_total',
+                   'Commands received from the engine')
+        m.describe('libyate_parse_errors_total',
+                   'Lines received from the engine that could not be parsed')
+        m.describe('libyate_messages_total',
+                   'Messages dispatched to handlers, watchers and callbacks')
+        m.describe('libyate_handler_errors_total',
+                   'Exceptions raised by handlers, watchers and callbacks')
+        m.describe('libyate_handler_seconds',
+                   'Time spent on handlers, watchers and callbacks')
+        m.describe('libyate_watcher_skipped_total',
+                   'Watcher notifications dropped by sampling or coalescing')
+        m.describe('libyate_failed_callbacks_total',
+                   'Callbacks answered as not processed after losing the '
+                   'engine connection')
+        m.describe('libyate_deadline_overruns_total',
+                   'Messages auto-replied because the handler missed its '
+                   'deadline')
+        m.describe('libyate_cache_hits',
+                   'Messages answered from the handler reply caches')
+        m.describe('libyate_cache_misses',
+                   'Messages not found on the handler reply caches')
+        m.describe('libyate_cache_entries',
+                   'Replies stored on the handler reply caches')
+        m.describe('libyate_call_states', 'Calls with state on the store')
+
+        m.gauge('libyate_input_queue_size', self.__input_queue__.qsize)
+        m.gauge('libyate_input_queue_class_size', lambda: dict(
+            ((('class', c), ), self.__input_queue__.qsize(c))
+            for c in self.__input_queue__.weights))
+        m.gauge('libyate_output_queue_size', self.__output_queue__.qsize)
+        m.gauge('libyate_pending_callbacks',
+                lambda: len(self.__msg_callback__))
+        m.gauge('libyate_handlers', lambda: len(self.__msg_handlers__))
+        m.gauge('libyate_watchers', lambda: len(self.__msg_watchers__))
+
+        def cache_gauge(func):
+            return lambda: dict(((('name', name), ), func(cache))
+                                for name, cache
+                                in list(self.__handler_caches__.items()))
+
+        m.gauge('libyate_cache_hits', cache_gauge(lambda c: c.hits))
+        m.gauge('libyate_cache_misses', cache_gauge(lambda c: c.misses))
+        m.gauge('libyate_cache_entries', cache_gauge(len))
+
+        if self.calls is not None:
+            m.gauge('libyate_call_states', lambda: len(self.calls))
+
     @abstractmethod
     def readline(self):
         """Get the next command from the engine
@@ -68,7 +175,7 @@ class Application(object):
     def write(self, string):
         """Send command to the engine
 
-        :param str string: Command string to be sent
+        :param string: Command string or buffer to be sent
         :raise IOError: on Input/Output errors
         """
 
@@ -86,7 +193,7 @@ class Application(object):
         :param bool threaded: each message will be processed on it's own thread
         """
 
-        self.__input_buffer__ = ''
+        self.__input_buffer__ = libyate.net.LineBuffer()
 
         signal.signal(signal.SIGINT, self.stop)
         signal.signal(signal.SIGTERM, self.stop)
@@ -117,6 +224,9 @@ class Application(object):
         while not startup_queue.empty():
             self.__output_queue__.put(startup_queue.get())
 
+        if self.calls is not None and self.calls.interval is not None:
+            self._schedule(self.calls.interval, self._expire_calls)
+
         self.logger.debug('Executing user startup code')
         try:
             self.start()
@@ -151,8 +261,9 @@ class Application(object):
         except:
             pass
 
+        # The stop sentinel is served after every queued command
         try:
-            self.__input_queue__.put(None)
+            self.__input_queue__.put_last(None)
         except:
             pass
 
@@ -161,13 +272,50 @@ class Application(object):
         except:
             pass
 
-    def _command(self, cmd):
+    def _classify(self, line):
+        """Return the scheduling class of a command string
+
+        Only the message name is extracted, the command is parsed later by the
+        main loop thread.
+
+        :param str line: Command string received from the engine
+        :return: The scheduling class
+        :rtype: str
+        """
+
+        if line.startswith('%%>message:'):
+            classes = self.__handler_classes__
+
+        # Watcher notifications are replies without message ID
+        elif line.startswith('%%<message::'):
+            classes = self.__watcher_classes__
+
+        else:
+            return libyate.scheduler.NORMAL
+
+        if not classes:
+            return libyate.scheduler.NORMAL
+
+        name = line.split(':', 4)[3]
+
+        if '%' in name:
+            name = libyate.type.yate_decode(name)
+
+        return classes.get(name, libyate.scheduler.NORMAL)
+
+    def _command(self, cmd, trace=None, received=None):
         """Handler function for command handling threads
 
         :param libyate.engine.Command cmd: A libyate Command object to process
+        :param libyate.metrics.Trace trace: profiling trace of the command
+        :param float received: time the command was received, now if None
         """
 
-        self.logger.debug('Received command: {0!r}'.format(cmd))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Received command: {0!r}'.format(cmd))
+
+        self.metrics.inc('libyate_commands_total',
+                         (('command', type(cmd).__name__), ))
 
         handler = {
             libyate.engine.Error: self._command_error,
@@ -184,12 +332,33 @@ class Application(object):
             self.logger.critical('No handler defined for "{0}" command'
                                  .format(type(cmd).__name__))
 
+        if trace is not None:
+            if handler == self._command_message:
+                trace.name = cmd.name
+            else:
+                trace.name = type(cmd).__name__
+
         try:
-            handler(cmd)
+            if handler == self._command_message:
+                handler(cmd, trace, received)
+
+            else:
+                if trace is not None:
+                    trace.mark('dispatch')
+
+                handler(cmd)
+
+                if trace is not None:
+                    trace.mark('handler')
+
         except:
             self.logger.exception('Error processing command: {0}'
                                   .format(cmd))
 
+        # Traces of commands without reply end here
+        if trace is not None and not trace.pending:
+            self.profiler.finish(trace)
+
     def _command_error(self, cmd):
         """Handler function for Error commands
 
@@ -222,41 +391,295 @@ class Application(object):
             self.logger.error('Error installing handler for "{0}"'
                               .format(cmd.name))
 
-    def _command_message(self, cmd):
+    def _command_message(self, cmd, trace=None, received=None):
         """Handler function for Message and MessageReply commands
 
         :param cmd: A libyate Message or MessageReply object to process
         :type cmd: libyate.cmd.Message or libyate.cmd.MessageReply
+        :param libyate.metrics.Trace trace: profiling trace of the command
+        :param float received: time the command was received, now if None
         """
 
+        kind = None
+        token = None
+
+        # Call states of batched messages are removed on delivery
+        batched = False
+
         try:
             # Message from installed handlers
             if isinstance(cmd, libyate.engine.Message):
+                kind = 'handler'
                 handler = self.__msg_handlers__[cmd.name]
 
+                if cmd.name in self.__handler_batches__:
+                    batched = True
+                    self._command_handler_batch(
+                        cmd, self.__handler_batches__[cmd.name])
+                    return
+
             # Reply from application generated message
             elif cmd.id is not None:
+                kind = 'callback'
                 handler = self.__msg_callback__.pop(cmd.id)
 
             # Notification from installed watchers
             else:
+                kind = 'watcher'
                 handler = self.__msg_watchers__[cmd.name]
+                batch = self.__watcher_batches__.get(cmd.name)
 
-            self.logger.debug('Handler: {0}'.format(handler))
+                if batch is not None:
+                    if batch.sample is not None and \
+                            random.random() >= batch.sample:
+                        self.metrics.inc('libyate_watcher_skipped_total',
+                                         (('name', cmd.name),
+                                          ('reason', 'sampled')))
+                        return
+
+                    if batch.batching:
+                        batched = True
+                        self._command_watcher_batch(cmd, batch)
+                        return
+
+            debug = self.logger.isEnabledFor(logging.DEBUG)
+
+            if debug:
+                self.logger.debug('Handler: {0}'.format(handler))
 
             if handler is not None:
-                result = handler(cmd)
+                labels = (('kind', kind), ('name', cmd.name),
+                          ('handler', getattr(handler, '__name__', '')))
+
+                self.metrics.inc('libyate_messages_total', labels)
+
+                if kind == 'handler' and cmd.name in self.__msg_deadlines__:
+                    deadline, fallback = self.__msg_deadlines__[cmd.name]
+                    token = self._schedule_deadline(cmd, deadline, fallback,
+                                                    received)
+
+                if trace is not None:
+                    trace.mark('dispatch')
+
+                start = time.time()
 
-                self.logger.debug('Result: {0}'.format(result))
+                try:
+                    result = handler(cmd)
+
+                finally:
+                    self.metrics.observe('libyate_handler_seconds',
+                                         time.time() - start, labels)
+
+                if trace is not None:
+                    trace.mark('handler')
+
+                if debug:
+                    self.logger.debug('Result: {0}'.format(result))
+
+                # The message was already answered by the timer thread
+                if token is not None and not token.acquire(False):
+                    self.logger.warning('Discarding late result for "{0}": '
+                                        '{1}'.format(cmd.name, result))
+                    return
 
                 if result is not None:
-                    self._send(result)
+                    self._send(result, trace=trace)
 
         except:
+            self.metrics.inc('libyate_handler_errors_total',
+                             (('kind', kind), ('name', cmd.name)))
             self.logger.exception('Error processing message: {0}'.format(cmd))
-            if isinstance(cmd, libyate.engine.Message):
+            if isinstance(cmd, libyate.engine.Message) and \
+                    (token is None or token.acquire(False)):
                 self._send(cmd.reply())
 
+        finally:
+            if not batched:
+                self._hangup_calls(cmd.name, (cmd, ))
+
+    def _hangup_calls(self, name, items):
+        """Remove the call states of chan.hangup messages, once their
+        handlers and watchers returned
+
+        :param str name: message name
+        :param items: messages delivered
+        """
+
+        if name == 'chan.hangup' and self.calls is not None:
+            for cmd in items:
+                self.calls.hangup(cmd)
+
+    def _command_watcher_batch(self, cmd, batch):
+        """Add a watcher notification to its batch
+
+        :param libyate.engine.MessageReply cmd: notification to add
+        :param NotificationBatch batch: batch of the watcher
+        """
+
+        coalesced, items, generation = batch.add(cmd)
+
+        if coalesced:
+            self.metrics.inc('libyate_watcher_skipped_total',
+                             (('name', cmd.name), ('reason', 'coalesced')))
+
+        if generation is not None:
+            self._schedule(batch.interval, self._flush_batch,
+                           self._deliver_watcher_batch, cmd.name, batch,
+                           generation)
+
+        if items:
+            self._deliver_watcher_batch(cmd.name, items)
+
+    def _deliver_watcher_batch(self, name, items):
+        """Deliver a batch of notifications to their watcher
+
+        :param str name: message name of the watcher
+        :param list items: notifications to deliver
+        """
+
+        handler = self.__msg_watchers__.get(name)
+
+        if handler is None:
+            self._hangup_calls(name, items)
+            return
+
+        labels = (('kind', 'watcher'), ('name', name),
+                  ('handler', getattr(handler, '__name__', '')))
+
+        self.metrics.inc('libyate_messages_total', labels, len(items))
+
+        start = time.time()
+
+        try:
+            handler(items)
+
+        except:
+            self.metrics.inc('libyate_handler_errors_total',
+                             (('kind', 'watcher'), ('name', name)))
+            self.logger.exception('Error processing {0} notifications for '
+                                  '"{1}"'.format(len(items), name))
+
+        finally:
+            self.metrics.observe('libyate_handler_seconds',
+                                 time.time() - start, labels)
+            self._hangup_calls(name, items)
+
+    def _command_handler_batch(self, cmd, batch):
+        """Add a message to the batch of its handler
+
+        :param libyate.engine.Message cmd: message to add
+        :param NotificationBatch batch: batch of the handler
+        """
+
+        _, items, generation = batch.add(cmd)
+
+        if generation is not None:
+            self._schedule(batch.interval, self._flush_batch,
+                           self._deliver_handler_batch, cmd.name, batch,
+                           generation)
+
+        if items:
+            self._deliver_handler_batch(cmd.name, items)
+
+    def _deliver_handler_batch(self, name, items):
+        """Deliver a batch of messages to their handler and send the replies
+
+        Messages without a reply from the handler are answered as not
+        processed.
+
+        :param str name: message name of the handler
+        :param list items: messages to deliver
+        """
+
+        handler = self.__msg_handlers__.get(name)
+        replies = None
+
+        if handler is not None:
+            labels = (('kind', 'handler'), ('name', name),
+                      ('handler', getattr(handler, '__name__', '')))
+
+            self.metrics.inc('libyate_messages_total', labels, len(items))
+
+            start = time.time()
+
+            try:
+                replies = handler(items)
+
+            except:
+                self.metrics.inc('libyate_handler_errors_total',
+                                 (('kind', 'handler'), ('name', name)))
+                self.logger.exception('Error processing {0} messages for '
+                                      '"{1}"'.format(len(items), name))
+
+            finally:
+                self.metrics.observe('libyate_handler_seconds',
+                                     time.time() - start, labels)
+
+        answered = set()
+
+        for reply in replies or ():
+            if reply is not None:
+                answered.add(reply.id)
+                self._send(reply)
+
+        for cmd in items:
+            if cmd.id not in answered:
+                self._send(cmd.reply())
+
+        self._hangup_calls(name, items)
+
+    def _flush_batch(self, deliver, name, batch, generation):
+        """Deliver a batch when its interval expires
+
+        The delivery runs on its own thread to keep the timer thread free.
+
+        :param function deliver: delivery function
+        :param str name: message name of the handler or watcher
+        :param NotificationBatch batch: batch to flush
+        :param int generation: generation of the batch the timer was set for
+        """
+
+        items = batch.flush(generation)
+
+        if items:
+            Thread(target=deliver, args=(name, items),
+                   name='Batch({0})'.format(name)).start()
+
+    def _expire_calls(self):
+        """Remove the idle call states, run periodically on the timer thread
+        """
+
+        removed = self.calls.expire()
+
+        if removed:
+            self.logger.debug('Removed {0} idle call states'.format(removed))
+
+        self._schedule(self.calls.interval, self._expire_calls)
+
+    # noinspection PyShadowingBuiltins
+    def _fail_callbacks(self):
+        """Answer every pending callback with a not processed reply, used
+        when the replies will never arrive"""
+
+        while self.__msg_callback__:
+            try:
+                id, callback = self.__msg_callback__.popitem()
+            except KeyError:
+                break
+
+            if callback is None:
+                continue
+
+            self.metrics.inc('libyate_failed_callbacks_total')
+            self.logger.warning('Failing callback for message: {0}'
+                                .format(id))
+
+            try:
+                callback(libyate.engine.MessageReply(id=id, processed=False))
+            except:
+                self.logger.exception('Error processing callback: {0}'
+                                      .format(id))
+
     def _command_setlocal_reply(self, cmd):
         """Handler function for SetLocalReply commands
 
@@ -313,6 +736,136 @@ class Application(object):
             self.logger.error('Error installing watcher for "{0}"'
                               .format(cmd.name))
 
+    def _deadline(self, token, cmd, fallback):
+        """Answer a message whose handler missed its deadline
+
+        :param threading.Lock token: message reply token
+        :param libyate.engine.Message cmd: message being processed
+        :param function fallback: function returning the automatic reply
+        """
+
+        # Handler finished in time
+        if not token.acquire(False):
+            return
+
+        self.metrics.inc('libyate_deadline_overruns_total',
+                         (('name', cmd.name), ))
+
+        self.logger.warning('Handler for "{0}" missed its deadline, '
+                            'auto-replying'.format(cmd.name))
+
+        result = None
+
+        if fallback is not None:
+            try:
+                result = fallback(cmd)
+            except:
+                self.logger.exception('Error processing fallback: {0}'
+                                      .format(cmd))
+
+        self._send(cmd.reply() if result is None else result)
+
+    def _schedule(self, delay, func, *args):
+        """Run a function on the timer thread after a delay
+
+        The timer thread is started on first use. Functions should return
+        quickly, every other timer waits for them.
+
+        :param float delay: delay in seconds
+        :param function func: function to run
+        :param args: function arguments
+        """
+
+        with self.__timer_cond__:
+            if self.__timer_thread__ is None:
+                self.__timer_thread__ = Thread(target=self._timer,
+                                               name='TimerThread')
+                self.__timer_thread__.daemon = True
+                self.__timer_thread__.start()
+
+            heapq.heappush(self.__timers__, (
+                time.time() + delay, next(self.__timer_seq__), func, args))
+
+            self.__timer_cond__.notify()
+
+    def _schedule_deadline(self, cmd, deadline, fallback=None, received=None):
+        """Schedule the automatic reply of a message
+
+        The message is answered by whoever first acquires the returned token:
+        the handler when it returns or the timer thread when the deadline
+        expires.
+
+        :param libyate.engine.Message cmd: message being processed
+        :param float deadline: time limit in seconds
+        :param function fallback: function returning the automatic reply,
+            cmd.reply() (not processed) is sent if None
+        :param float received: time the message was received, the deadline
+            is measured from now if None
+        :return: The message reply token
+        :rtype: threading.Lock
+        """
+
+        token = Lock()
+
+        # Time spent on the input queue counts
+        if received is not None:
+            deadline -= time.time() - received
+
+        self._schedule(deadline, self._deadline, token, cmd, fallback)
+
+        return token
+
+    def _timer(self):
+        """Handler function for the timer thread"""
+
+        self.logger.debug('Started timer')
+
+        cond = self.__timer_cond__
+        heap = self.__timers__
+
+        while True:
+
+            try:
+                with cond:
+                    # The thread will not receive system signals if a timeout
+                    #   is not specified
+                    timeout = 10
+
+                    if heap:
+                        timeout = heap[0][0] - time.time()
+
+                        if timeout <= 0:
+                            _, _, func, args = heapq.heappop(heap)
+                            timeout = None
+
+                    if timeout is not None:
+                        cond.wait(timeout)
+                        continue
+
+                func(*args)
+
+            except:
+                self.logger.exception('Error processing timer')
+
+    def _enqueue(self, line):
+        """Insert a command string received from the engine into the input
+        queue
+
+        :param str line: Command string
+        """
+
+        received = time.time()
+        trace = None
+
+        if self.profiler is not None:
+            trace = self.profiler.start(received)
+
+        if trace is not None:
+            trace.mark('enqueue')
+
+        self.__input_queue__.put((line, trace, received),
+                                 self._classify(line))
+
     def _input(self):
         """Handler function for the input handling thread"""
 
@@ -321,7 +874,7 @@ class Application(object):
         while True:
 
             try:
-                self.__input_queue__.put(self.readline())
+                self._enqueue(self.readline())
 
             # Interrupt on EOFError
             except EOFError:
@@ -348,39 +901,63 @@ class Application(object):
         while True:
 
             try:
-                cmd = self._receive()
+                cmd, trace, received = self._receive()
 
                 if not cmd:
                     break
 
                 if threaded:
-                    Thread(target=self._command, args=(cmd, ),
+                    Thread(target=self._command, args=(cmd, trace, received),
                            name='{0}({1})'.format(
                                type(cmd).__name__, id(cmd))).start()
 
                 else:
-                    self._command(cmd)
+                    self._command(cmd, trace, received)
 
             except:
                 self.logger.exception('Error processing command')
 
     def _output(self):
-        """Handler function for the output handling thread"""
+        """Handler function for the output handling thread
+
+        The commands already waiting on the queue are joined into a single
+        buffer, reused between writes.
+        """
 
         self.logger.debug('Started output')
 
-        while True:
+        output_queue = self.__output_queue__
+        buf = bytearray()
+        stopping = False
+
+        while not stopping:
 
             try:
-                string = self.__output_queue__.get(timeout=10)
-                self.__output_queue__.task_done()
+                item = output_queue.get(timeout=10)
+                output_queue.task_done()
 
-                if string is None:
+                if item is None:
                     break
 
-                self.write(string)
+                items = [item]
+
+                while len(items) < OUTPUT_BATCH_SIZE:
+                    try:
+                        item = output_queue.get_nowait()
+                    except queue.Empty:
+                        break
+
+                    output_queue.task_done()
 
-            except Queue.Empty:
+                    if item is None:
+                        stopping = True
+                        break
+
+                    items.append(item)
+
+                self._write_commands(items, buf)
+
+            except queue.Empty:
                 # Loop until an item is available on the queue,
                 # the thread will not receive system signals if a timeout is
                 #   not specified
@@ -398,11 +975,50 @@ class Application(object):
         # Shutdown module if the output handling thread stops
         self.stop()
 
+    def _write_commands(self, items, buf):
+        """Join command strings into the buffer and send them, with a single
+        write for each run of commands to the same destination
+
+        :param list items: (string, trace, destination) tuples
+        :param bytearray buf: output buffer
+        """
+
+        i = 0
+        n = len(items)
+
+        while i < n:
+            target = items[i][2]
+            traces = []
+
+            del buf[:]
+
+            while i < n and items[i][2] == target:
+                string, trace = items[i][:2]
+                i += 1
+
+                buf += wire(string)
+
+                if trace is not None:
+                    trace.mark('dequeue_output')
+                    traces.append(trace)
+
+            if target is None:
+                self.write(buf)
+            else:
+                self.write(buf, target)
+
+            self.metrics.inc('libyate_sent_bytes_total', value=len(buf))
+
+            for trace in traces:
+                trace.mark('write')
+                self.profiler.finish(trace)
+
     def _receive(self):
         """Get the next command object from the input queue
 
-        :return: A command object
-        :rtype: libyate.cmd.Command
+        :return: A command object, its profiling trace and the time it was
+            received, (None, None, None) when stopping
+        :rtype: tuple
         """
 
         # Loop until an item is available on the queue, the thread will not
@@ -410,24 +1026,41 @@ class Application(object):
 
         while True:
             try:
-                string = self.__input_queue__.get(timeout=10)
+                item = self.__input_queue__.get(timeout=10)
                 self.__input_queue__.task_done()
 
-                if string is not None:
-                    return libyate.engine.from_string(string)
+                if item is None:
+                    return None, None, None
 
-                break
+                string, trace, received = item
+
+                if trace is not None:
+                    trace.mark('dequeue')
+
+                try:
+                    cmd = libyate.engine.from_string(string)
 
-            except Queue.Empty:
+                except:
+                    self.metrics.inc('libyate_parse_errors_total')
+                    raise
+
+                if trace is not None:
+                    trace.mark('parse')
+
+                return cmd, trace, received
+
+            except queue.Empty:
                 continue
 
-    def _send(self, command, force=False):
+    def _send(self, command, force=False, trace=None):
         """Insert command into the output queue
 
         :param libyate.cmd.Command command: a libyate Command object to send
             to the engine
         :param bool force: force sending to the output queue even if the main
             thread is not yet started
+        :param libyate.metrics.Trace trace: profiling trace of the message
+            being replied
         """
 
         if force or self.__startup_queue__ is None:
@@ -435,7 +1068,25 @@ class Application(object):
         else:
             queue = self.__startup_queue__
 
-        queue.put('{0}\n'.format(command))
+        # Formatted here, so later changes to the command are not sent and
+        #   formatting errors reach the caller
+        string = '{0}\n'.format(command)
+
+        if trace is not None:
+            trace.mark('serialize')
+            trace.pending = True
+
+        queue.put((string, trace, self._route(command)))
+
+    def _route(self, command):
+        """Return the destination of a command for applications writing to
+        several engine connections
+
+        :param libyate.cmd.Command command: a libyate Command object to send
+        :return: Connection identifier, None for the default output
+        """
+
+        return None
 
     # noinspection PyShadowingBuiltins
     def connect(self, role, id=None, type=None):
@@ -448,12 +1099,24 @@ class Application(object):
         """
 
         self.logger.info('Connecting as "{0}"'.format(role))
-        self._send(libyate.engine.Connect(role, id, type), force=True)
+
+        command = libyate.engine.Connect(role, id, type)
+        self.__replay__[('connect', None)] = command
+
+        self._send(command, force=True)
 
     def install(self, handler, name, priority=None, filter_name=None,
-                filter_value=None):
+                filter_value=None, deadline=None, fallback=None,
+                sched_class=libyate.scheduler.NORMAL, cache=None):
         """Install message handler
 
+        If a deadline is given and the handler does not return in time, the
+        message is answered with the fallback reply and the handler result is
+        discarded when it finally returns.
+
+        If a cache is given, messages with a cached reply are answered
+        without calling the handler.
+
         :param function handler: handler function for received messages
         :param str name: name of the messages for that a handler should be
             installed
@@ -461,6 +1124,15 @@ class Application(object):
         :type priority: str or int
         :param str filter_name: name of a variable the handler will filter
         :param str filter_value: matching value for the filtered variable
+        :param float deadline: time limit in seconds for the reply, measured
+            from the reception of the message, so it includes the time spent
+            on the input queue
+        :param function fallback: function receiving the message and returning
+            the reply sent on deadline overrun, cmd.reply() (not processed)
+            is sent if None
+        :param str sched_class: scheduling class of the messages on the input
+            queue: critical, normal or bulk
+        :param libyate.cache.ReplyCache cache: cache of the handler replies
         """
 
         self.logger.info('Installing handler for "{0}"'.format(name))
@@ -468,10 +1140,68 @@ class Application(object):
         if name in self.__msg_handlers__:
             raise KeyError('Handler already defined: {0!r}'.format(name))
 
+        if deadline is None and fallback is not None:
+            raise ValueError('A fallback requires a deadline')
+
+        if sched_class not in self.__input_queue__.weights:
+            raise ValueError('Unknown scheduling class: {0!r}'
+                             .format(sched_class))
+
+        if cache is not None:
+            handler = cache(handler)
+            self.__handler_caches__[name] = cache
+
         self.__msg_handlers__[name] = handler
+        self.__handler_classes__[name] = sched_class
+
+        if deadline is not None:
+            self.__msg_deadlines__[name] = (deadline, fallback)
+
+        command = libyate.engine.Install(priority, name, filter_name,
+                                         filter_value)
+        self.__replay__[('install', name)] = command
+
+        self._send(command)
+
+    def install_batch(self, handler, name, size=100, interval=0.01,
+                      priority=None, filter_name=None, filter_value=None,
+                      sched_class=libyate.scheduler.NORMAL):
+        """Install message handler receiving batches of messages
+
+        The handler receives a list of messages, collected until the batch
+        reaches the size or the interval expires after the first message, and
+        returns a list of replies. Messages without a reply on the list are
+        answered as not processed.
 
-        self._send(
-            libyate.engine.Install(priority, name, filter_name, filter_value))
+        :param function handler: handler function for lists of received
+            messages
+        :param str name: name of the messages for that a handler should be
+            installed
+        :param int size: maximum number of messages per batch
+        :param float interval: maximum time in seconds a message waits in the
+            batch
+        :param priority: priority in chain, default 100 if missing
+        :type priority: str or int
+        :param str filter_name: name of a variable the handler will filter
+        :param str filter_value: matching value for the filtered variable
+        :param str sched_class: scheduling class of the messages on the input
+            queue: critical, normal or bulk
+        """
+
+        if interval is None:
+            raise ValueError('A batch handler requires an interval')
+
+        if name in self.__msg_handlers__:
+            raise KeyError('Handler already defined: {0!r}'.format(name))
+
+        self.__handler_batches__[name] = NotificationBatch(size, interval)
+
+        try:
+            self.install(handler, name, priority, filter_name, filter_value,
+                         sched_class=sched_class)
+        except:
+            self.__handler_batches__.pop(name)
+            raise
 
     # noinspection PyShadowingBuiltins
     def message(self, name, kvp=None, id=None, time=None, retvalue=None,
@@ -481,21 +1211,22 @@ class Application(object):
         :param str name: name of the message
         :param kvp: enumeration of the key-value pairs of the message
         :type kvp: dict, list, set, tuple or libyate.type.OrderedDict
-        :param str id: obscure unique message ID string generated by Yate
+        :param str id: unique message ID, generated by
+            libyate.engine.message_id if None
         :param time: time (in seconds) the message was initially created
         :type time: str, int or datetime.datetime
         :param str retvalue: default textual return value of the message
         :param function callback: handler function for message reply
+        :raise KeyError: if the message ID is already in use
         """
 
         msg = libyate.engine.Message(id, time, name, retvalue, kvp)
 
-        self.logger.debug('Sending message to the engine: {0!r}'.format(msg))
-
-        if msg.id in self.__msg_callback__:
-            raise KeyError('Message ID already in use: {0}'.format(msg.id))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Sending message to the engine: {0!r}'
+                              .format(msg))
 
-        self.__msg_callback__[msg.id] = callback
+        self.__msg_callback__.add(msg.id, callback)
 
         self._send(msg)
 
@@ -523,7 +1254,12 @@ class Application(object):
         else:
             self.logger.info('Querying parameter "{0}"'.format(name))
 
-        self._send(libyate.engine.SetLocal(name, value))
+        command = libyate.engine.SetLocal(name, value)
+
+        if value:
+            self.__replay__[('setlocal', name)] = command
+
+        self._send(command)
 
     def uninstall(self, name):
         """Remove message handler
@@ -533,7 +1269,19 @@ class Application(object):
 
         self.logger.info('Removing handler for "{0}"'.format(name))
 
+        batch = self.__handler_batches__.pop(name, None)
+
+        if batch is not None:
+            items = batch.flush()
+
+            if items:
+                self._deliver_handler_batch(name, items)
+
         self.__msg_handlers__.pop(name)
+        self.__msg_deadlines__.pop(name, None)
+        self.__handler_classes__.pop(name, None)
+        self.__handler_caches__.pop(name, None)
+        self.__replay__.pop(('install', name), None)
 
         self._send(libyate.engine.UnInstall(name))
 
@@ -545,26 +1293,260 @@ class Application(object):
 
         self.logger.debug('Removing watcher for "{0}"'.format(name))
 
+        batch = self.__watcher_batches__.pop(name, None)
+
+        if batch is not None:
+            items = batch.flush()
+
+            if items:
+                self._deliver_watcher_batch(name, items)
+
         self.__msg_watchers__.pop(name)
+        self.__watcher_classes__.pop(name, None)
+        self.__replay__.pop(('watch', name), None)
 
         self._send(libyate.engine.UnWatch(name))
 
-    def watch(self, handler, name):
+    def watch(self, handler, name, sched_class=libyate.scheduler.BULK,
+              batch=None):
         """Install message watcher
 
-        :param function handler: handler function for received notifications
+        :param function handler: handler function for received notifications,
+            it receives a list of notifications if batch size or interval are
+            set
         :param str name: name of the messages for that a watcher should be
             installed
+        :param str sched_class: scheduling class of the notifications on the
+            input queue: critical, normal or bulk
+        :param NotificationBatch batch: batching, coalescing and sampling
+            options for the notifications
         """
 
         self.logger.debug('Installing watcher for "{0}"'.format(name))
 
-        if name in self.__msg_watchers__:
+        # Watchers without handler, like the chan.hangup one of the call
+        #   states, can be replaced
+        watching = name in self.__msg_watchers__
+
+        if watching and (self.__msg_watchers__[name] is not None or
+                         handler is None):
             raise KeyError('Watcher already defined: {0!r}'.format(name))
 
+        if sched_class not in self.__input_queue__.weights:
+            raise ValueError('Unknown scheduling class: {0!r}'
+                             .format(sched_class))
+
         self.__msg_watchers__[name] = handler
+        self.__watcher_classes__[name] = sched_class
+
+        if batch is not None:
+            self.__watcher_batches__[name] = batch
+
+        if watching:
+            return
 
-        self._send(libyate.engine.Watch(name))
+        command = libyate.engine.Watch(name)
+        self.__replay__[('watch', name)] = command
+
+        self._send(command)
+
+
+class NotificationBatch(object):
+    """Batching, coalescing and sampling options of a message watcher, also
+    used to collect the messages of batch handlers
+
+    Notifications are delivered as a list when the batch reaches the size or
+    when the interval expires after the first queued notification, whichever
+    comes first. When coalescing, only the latest notification for each value
+    of the key is kept, notifications without the key are all kept.
+
+    :param int size: number of notifications (or distinct keys) per batch
+    :param float interval: maximum time in seconds a notification waits in
+        the batch
+    :param str coalesce: name of the key-value pair used to coalesce
+    :param float sample: fraction of the notifications accepted, all if None
+    """
+
+    def __init__(self, size=None, interval=None, coalesce=None, sample=None):
+        if size is not None and size < 1:
+            raise ValueError('Invalid batch size: {0!r}'.format(size))
+
+        if interval is not None and interval <= 0:
+            raise ValueError('Invalid batch interval: {0!r}'.format(interval))
+
+        if coalesce is not None and size is None and interval is None:
+            raise ValueError('Coalescing requires a batch size or interval')
+
+        if sample is not None and not 0 < sample <= 1:
+            raise ValueError('Invalid sample fraction: {0!r}'.format(sample))
+
+        self.size = size
+        self.interval = interval
+        self.coalesce = coalesce
+        self.sample = sample
+
+        self._lock = Lock()
+        self._items = libyate.type.OrderedDict()
+        self._seq = count()
+        self._generation = 0
+        self._armed = False
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def batching(self):
+        """True if notifications are delivered in batches
+
+        :rtype: bool
+        """
+
+        return self.size is not None or self.interval is not None
+
+    def add(self, cmd):
+        """Add a notification to the batch
+
+        :param libyate.engine.MessageReply cmd: notification to add
+        :return: A tuple with: True if the notification replaced a previous
+            one, the list of notifications to deliver if the batch is full
+            and the batch generation if an interval timer must be set for it
+        :rtype: tuple
+        """
+
+        key = None
+
+        if self.coalesce is not None and cmd.kvp:
+            key = cmd.kvp.get(self.coalesce)
+
+        with self._lock:
+            if key is None:
+                key = next(self._seq)
+
+            coalesced = key in self._items
+            self._items[key] = cmd
+
+            if self.size is not None and len(self._items) >= self.size:
+                return coalesced, self._take(), None
+
+            if self.interval is not None and not self._armed:
+                self._armed = True
+                return coalesced, None, self._generation
+
+            return coalesced, None, None
+
+    def flush(self, generation=None):
+        """Remove and return the queued notifications
+
+        :param int generation: flush only if the batch was not delivered since
+            this generation
+        :return: The list of notifications
+        :rtype: list
+        """
+
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return []
+
+            return self._take()
+
+    def _take(self):
+        """Start a new batch, the lock must be held
+
+        :return: The list of notifications of the previous batch
+        :rtype: list
+        """
+
+        items = list(self._items.values())
+
+        self._items = libyate.type.OrderedDict()
+        self._generation += 1
+        self._armed = False
+
+        return items
+
+
+class CallbackRegistry(object):
+    """Callbacks of the messages waiting for a reply
+
+    Messages with an ID from the generator are keyed by their sequence
+    number, which takes less memory than the ID string, other IDs are kept as
+    given. Messages sent without a callback are registered too, with None, so
+    their replies are recognized.
+
+    :param libyate.engine.IdGenerator generator: generator of the message
+        IDs, libyate.engine.message_id if None
+    """
+
+    def __init__(self, generator=None):
+        self.generator = generator or libyate.engine.message_id
+
+        self._lock = Lock()
+        self._generated = {}
+        self._other = {}
+
+    def __len__(self):
+        return len(self._generated) + len(self._other)
+
+    def __contains__(self, id):
+        sequence = self.generator.sequence(id)
+
+        if sequence is None:
+            return id in self._other
+
+        return sequence in self._generated
+
+    def add(self, id, callback):
+        """Register the callback of a message
+
+        :param str id: message ID
+        :param function callback: handler function for the message reply, may
+            be None
+        :raise KeyError: if the ID is already registered
+        """
+
+        sequence = self.generator.sequence(id)
+
+        if sequence is None:
+            items, key = self._other, id
+        else:
+            items, key = self._generated, sequence
+
+        with self._lock:
+            if key in items:
+                raise KeyError('Message ID already in use: {0}'.format(id))
+
+            items[key] = callback
+
+    def pop(self, id, *default):
+        """Remove and return the callback of a message
+
+        :param str id: message ID
+        :param default: value returned if the ID is not registered
+        :return: The callback
+        :raise KeyError: if the ID is not registered and no default is given
+        """
+
+        sequence = self.generator.sequence(id)
+
+        if sequence is None:
+            return self._other.pop(id, *default)
+
+        return self._generated.pop(sequence, *default)
+
+    def popitem(self):
+        """Remove and return any registered message
+
+        :return: (message ID, callback) pair
+        :rtype: tuple
+        :raise KeyError: if the registry is empty
+        """
+
+        try:
+            sequence, callback = self._generated.popitem()
+        except KeyError:
+            return self._other.popitem()
+
+        return self.generator.format(sequence), callback
 
 
 # noinspection PyBroadException
@@ -580,38 +1562,43 @@ class Script(Application):
         :raise IOError: on input/output errors
         """
 
-        while '\n' not in self.__input_buffer__:
+        buf = self.__input_buffer__
+        line = buf.readline()
+
+        while line is None:
 
             try:
-                data = sys.stdin.readline(8192)
+                data = getattr(sys.stdin, 'buffer', sys.stdin).readline(8192)
             except ValueError as e:
                 raise IOError(str(e))
 
-            if data == '':
+            if not data:
                 raise EOFError('Received EOF')
 
-            self.logger.debug('Received {0} bytes: {1!r}'
-                              .format(len(data), data))
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('Received {0} bytes: {1!r}'
+                                  .format(len(data), data))
 
-            self.__input_buffer__ += data
+            self.metrics.inc('libyate_received_bytes_total', value=len(data))
 
-        line, self.__input_buffer__ = \
-            self.__input_buffer__.partition('\n')[::2]
+            buf.feed(data)
+            line = buf.readline()
 
         return line
 
     def write(self, string):
         """Send command to the engine
 
-        :param str string: Command string to be sent
+        :param string: Command string or buffer to be sent
         :raise IOError: on input/output errors
         """
 
-        self.logger.debug('Sending {0} bytes: {1!r}'
-                          .format(len(string), string))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Sending {0} bytes: {1!r}'
+                              .format(len(string), string))
 
         try:
-            sys.stdout.write(string)
+            getattr(sys.stdout, 'buffer', sys.stdout).write(wire(string))
 
         except ValueError as e:
             raise IOError(str(e))
@@ -639,13 +1626,32 @@ class SocketClient(Application):
     :param bool restart: restart module if it terminates unexpectedly
     :param str id: channel id to connect this socket to
     :param str type: type of data channel, assuming audio if missing
+    :param libyate.metrics.Metrics metrics: metrics registry, a new one is
+        created if None
+    :param libyate.metrics.Profiler profiler: stage profiler for sampled
+        messages, disabled if None
+    :param dict weights: weight of each scheduling class on the input queue,
+        libyate.scheduler.DEFAULT_WEIGHTS if None
+    :param libyate.state.CallStore calls: per-call state store
+    :param int retries: connection attempts when the connection is lost,
+        before stopping the module, 0 to stop right away and None to retry
+        forever. Connect, setlocal, install and watch commands are replayed
+        on the new connection.
+    :param float backoff: delay before the second attempt, doubled on each
+        following attempt
+    :param float max_backoff: maximum delay between attempts
     """
 
     def __init__(self, role, host_or_path, port=None, name=None, trackparam=None,
-                 restart=None, id=None, type=None):
+                 restart=None, id=None, type=None, metrics=None, profiler=None,
+                 weights=None, retries=0, backoff=0.05, max_backoff=5.0,
+                 calls=None):
+
+        self._init_connection(None, retries)
 
         super(SocketClient, self).__init__(
-            name=name, trackparam=trackparam, restart=restart)
+            name=name, trackparam=trackparam, restart=restart, metrics=metrics,
+            profiler=profiler, weights=weights, calls=calls)
 
         self.connect(role=role, id=id, type=type)
 
@@ -654,115 +1660,211 @@ class SocketClient(Application):
         if host_or_path[0] not in ['.', '/'] and port is None:
             raise ValueError('Port number must be specified for tcp hosts')
 
+        self.host_or_path = host_or_path
+        self.port = port
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.metrics.describe('libyate_reconnections_total',
+                              'Connections re-established to the engine')
+
         # Try to connect the socket
         try:
+            self.__socket__ = libyate.net.connect(host_or_path, port)
 
-            # UNIX socket
-            if host_or_path[0] in ['.', '/']:
-                self.__socket__ = socket.socket(family=socket.AF_UNIX)
-                self.__socket__.connect(host_or_path)
+        # Failed to connect the socket, the input thread retries if enabled
+        except:
+            self.logger.exception('Failed to connect')
 
-            # INET/INET6 socket
-            else:
-                # Get protocols and addresses
-                l = socket.getaddrinfo(host_or_path, port, socket.AF_UNSPEC,
-                                       socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    def __del__(self):
+        if self.__socket__ is not None:
+            self.__socket__.close()
+            self.__socket__ = None
 
-                while l:
+    def _init_connection(self, sock, retries=0):
+        """Initialize the connection state
 
-                    # Get connection data
-                    f, t, p, c, a = l.pop()
+        :param socket.socket sock: connected socket, None if not connected
+        :param int retries: reconnection attempts, 0 to disable reconnection
+        """
 
-                    # Try to create the socket
-                    try:
-                        self.__socket__ = socket.socket(f, t, p)
+        self.__socket__ = sock
+        self.__closed__ = False
+        self.__connection_id__ = 0
+        self.__reconnect_lock__ = Lock()
+        self.__write_lock__ = Lock()
 
-                    # Error creating the socket
-                    except socket.error:
+        self.retries = retries
 
-                        # Try next resource
-                        if l:
-                            continue
+    def _reconnect(self, connection_id):
+        """Establish a new connection and replay the module state
 
-                        # No resources left
-                        raise
+        Connect, setlocal, install and watch commands are sent again before
+        any other output and pending callbacks are answered as not processed.
+        Nothing is done if the connection was already replaced.
+
+        :param int connection_id: identifier of the failed connection
+        :raise IOError: if reconnection is disabled, the client is closed or
+            the retries are exhausted
+        """
 
-                    # Try to connect to the address
+        with self.__reconnect_lock__:
+            if connection_id != self.__connection_id__:
+                return
+
+            if self.__closed__ or self.retries == 0:
+                raise IOError('Connection lost')
+
+            self._fail_callbacks()
+
+            with self.__write_lock__:
+                if self.__socket__ is not None:
+                    self.__socket__.close()
+                    self.__socket__ = None
+
+                attempt = 0
+
+                while True:
                     try:
-                        self.__socket__.connect(a)
+                        sock = libyate.net.connect(self.host_or_path,
+                                                   self.port)
+                        break
 
-                    # Error connecting to the address
-                    except socket.error:
-                        self.__socket__.close()
+                    except (socket.error, ValueError) as e:
+                        attempt += 1
 
-                        # Try next resource
-                        if l:
-                            continue
+                        if self.retries is not None and \
+                                attempt >= self.retries:
+                            raise IOError(str(e))
 
-                        # No resources left
-                        raise
+                        delay = min(self.backoff * 2 ** (attempt - 1),
+                                    self.max_backoff)
 
-                    # Socket connected, continue execution
-                    break
+                        self.logger.warning(
+                            'Reconnection attempt {0} failed, retrying in '
+                            '{1:.2f} s: {2}'.format(attempt, delay, e))
 
-        # Failed to connect the socket
-        except:
-            self.logger.exception('Failed to connect')
+                        time.sleep(delay)
 
-    def __del__(self):
-        if self.__socket__ is not None:
-            self.__socket__.close()
-            self.__socket__ = None
+                        if self.__closed__:
+                            raise IOError('Client closed')
+
+                # Connect must be the first command
+                commands = sorted(self.__replay__.values(),
+                                  key=lambda c: not isinstance(
+                                      c, libyate.engine.Connect))
+
+                buf = bytearray()
+
+                for command in commands:
+                    command.write_to(buf)
+
+                try:
+                    sock.sendall(buf)
+                except socket.error as e:
+                    sock.close()
+                    raise IOError(str(e))
+
+                self.__socket__ = sock
+                self.__connection_id__ += 1
+
+            self.metrics.inc('libyate_reconnections_total')
+            self.logger.info('Reconnected, replayed {0} commands'
+                             .format(len(commands)))
 
     def readline(self):
         """Get the next command from the engine
 
+        Lost connections are re-established if retries are enabled.
+
         :return: Command string
         :rtype: str
         :raise EOFError: on input exhaustion
         :raise IOError: on input/output errors
         """
 
+        buf = self.__input_buffer__
+        line = buf.readline()
+
         # Continue receiving until '\n' is received
-        while '\n' not in self.__input_buffer__:
+        while line is None:
+
+            connection_id = self.__connection_id__
+            error = None
 
             try:
+                if self.__socket__ is None:
+                    raise socket.error('Not connected')
+
                 data = self.__socket__.recv(8192)
+
             except socket.error as e:
-                raise IOError(str(e))
+                error = IOError(str(e))
 
-            if data == '':
-                raise EOFError('Socket closed')
+            else:
+                if not data:
+                    error = EOFError('Socket closed')
 
-            self.logger.debug('Received {0} bytes: {1!r}'
-                              .format(len(data), data))
+            if error is not None:
+                if self.__closed__ or self.retries == 0:
+                    raise error
+
+                self.logger.warning('Connection lost: {0}'.format(error))
+
+                self._reconnect(connection_id)
+
+                # Discard the partial line of the previous connection
+                buf.clear()
+                continue
 
-            self.__input_buffer__ += data
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('Received {0} bytes: {1!r}'
+                                  .format(len(data), data))
 
-        line, self.__input_buffer__ = \
-            self.__input_buffer__.partition('\n')[::2]
+            self.metrics.inc('libyate_received_bytes_total', value=len(data))
+
+            buf.feed(data)
+            line = buf.readline()
 
         return line
 
     def write(self, string):
         """Send command to the engine
 
-        :param str string: Command string to be sent
+        Commands written while the connection is lost are dropped if retries
+        are enabled.
+
+        :param string: Command string or buffer to be sent
         :raise IOError: on input/output errors
         """
 
-        self.logger.debug('Sending {0} bytes: {1!r}'
-                          .format(len(string), string))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Sending {0} bytes: {1!r}'
+                              .format(len(string), string))
+
+        connection_id = self.__connection_id__
 
         try:
-            self.__socket__.sendall(string)
+            with self.__write_lock__:
+                if self.__socket__ is None:
+                    raise socket.error('Not connected')
+
+                self.__socket__.sendall(wire(string))
 
         except socket.error as e:
-            raise IOError(str(e))
+            if self.__closed__ or self.retries == 0:
+                raise IOError(str(e))
+
+            self.logger.warning('Dropping {0} bytes, connection lost: {1}'
+                                .format(len(string), e))
+
+            self._reconnect(connection_id)
 
     def close(self):
         """Close input and stop receiving commands"""
 
+        self.__closed__ = True
+
         if self.__socket__ is not None:
 
             try:
@@ -771,3 +1873,254 @@ class SocketClient(Application):
 
             except socket.error:
                 pass
+
+
+# noinspection PyBroadException
+class MultiSocketClient(Application):
+    """Yate external module client using several socket connections
+
+    Every connection is a separate external module for the engine. Handlers
+    and watchers are spread across the connections, each one installed on the
+    connection with the fewest of them, while the messages generated by the
+    application are sent round-robin. Messages are answered on the connection
+    they were received from, output and local parameter queries are sent on
+    the first connection and the remaining commands, like connect and local
+    parameter assignments, are sent on every connection. All the connections
+    share the input queue, the dispatcher and the output thread.
+
+    :param str role: role of the connections: global, channel, play,
+        record, playrec
+    :param str host_or_path: Yate listener host address or path to the Yate
+        listener unix socket
+    :param int port: Yate listener port number
+    :param int connections: number of connections
+    :param str name: Application name for logging purposes
+    :param str trackparam: value for handler tracking parameter
+    :param bool restart: restart module if it terminates unexpectedly
+    :param libyate.metrics.Metrics metrics: metrics registry, a new one is
+        created if None
+    :param libyate.metrics.Profiler profiler: stage profiler for sampled
+        messages, disabled if None
+    :param dict weights: weight of each scheduling class on the input queue,
+        libyate.scheduler.DEFAULT_WEIGHTS if None
+    :param libyate.state.CallStore calls: per-call state store
+    :raise ValueError: if the host, the port or the connections are invalid
+    :raise socket.error: if a connection could not be established
+    """
+
+    def __init__(self, role, host_or_path, port=None, connections=2,
+                 name=None, trackparam=None, restart=None, metrics=None,
+                 profiler=None, weights=None, calls=None):
+
+        self.__sockets__ = []
+
+        if connections < 1:
+            raise ValueError('Invalid number of connections: {0!r}'
+                             .format(connections))
+
+        try:
+            for _ in xrange(connections):
+                self.__sockets__.append(
+                    libyate.net.connect(host_or_path, port))
+
+        except:
+            self.__del__()
+            raise
+
+        self.__buffers__ = [libyate.net.LineBuffer()
+                            for _ in xrange(connections)]
+        self.__origins__ = {}
+        self.__assignments__ = {}
+        self.__next_connection__ = count()
+
+        super(MultiSocketClient, self).__init__(
+            name=name, trackparam=trackparam, restart=restart, metrics=metrics,
+            profiler=profiler, weights=weights, calls=calls)
+
+        self.connect(role=role)
+
+    def __del__(self):
+        for sock in self.__sockets__:
+            sock.close()
+
+        self.__sockets__ = []
+
+    def _input(self):
+        """Handler function for the input handling thread, runs one input
+        thread for each connection"""
+
+        threads = []
+
+        for index in xrange(len(self.__sockets__)):
+            thread = Thread(target=self._input_connection, args=(index, ),
+                            name='InputThread({0})'.format(index))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(60)
+
+    # noinspection PyShadowingBuiltins
+    def _input_connection(self, index):
+        """Handler function for the input handling thread of a connection
+
+        :param int index: connection index
+        """
+
+        self.logger.debug('Started input of connection {0}'.format(index))
+
+        while True:
+
+            try:
+                line = self.readline(index)
+
+                # Replies must be sent on the connection of the message
+                if line.startswith('%%>message:'):
+                    id = line.split(':', 2)[1]
+
+                    if '%' in id:
+                        id = libyate.type.yate_decode(id)
+
+                    self.__origins__[id] = index
+
+                self._enqueue(line)
+
+            # Interrupt on EOFError
+            except EOFError:
+                self.logger.debug('Stopping input of connection {0}'
+                                  .format(index))
+                break
+
+            # Interrupt on IOError
+            except IOError:
+                self.logger.exception('Stopping input of connection {0}'
+                                      .format(index))
+                break
+
+            # Log exceptions
+            except:
+                self.logger.exception('Error processing input')
+
+        # Shutdown module if any connection stops
+        self.stop()
+
+    def _route(self, command):
+        """Return the connection of a command
+
+        :param libyate.cmd.Command command: a libyate Command object to send
+        :return: Connection index, None for every connection
+        :rtype: int
+        """
+
+        if isinstance(command, libyate.engine.MessageReply):
+            index = self.__origins__.pop(command.id, None)
+
+            if index is None:
+                self.logger.warning('Unknown connection for reply: {0}'
+                                    .format(command.id))
+                index = 0
+
+            return index
+
+        elif isinstance(command, libyate.engine.Message):
+            return next(self.__next_connection__) % len(self.__sockets__)
+
+        elif isinstance(command, (libyate.engine.Install,
+                                  libyate.engine.Watch)):
+            key = (type(command).__name__, command.name)
+
+            if key not in self.__assignments__:
+                load = [0] * len(self.__sockets__)
+
+                for index in self.__assignments__.values():
+                    load[index] += 1
+
+                self.__assignments__[key] = load.index(min(load))
+
+            return self.__assignments__[key]
+
+        elif isinstance(command, libyate.engine.UnInstall):
+            return self.__assignments__.pop(('Install', command.name), None)
+
+        elif isinstance(command, libyate.engine.UnWatch):
+            return self.__assignments__.pop(('Watch', command.name), None)
+
+        # Output and queries need a single connection, assignments must apply
+        #   to every one
+        elif isinstance(command, libyate.engine.Output):
+            return 0
+
+        elif isinstance(command, libyate.engine.SetLocal) and \
+                not command.value:
+            return 0
+
+        return None
+
+    def readline(self, index=0):
+        """Get the next command from the engine
+
+        :param int index: connection index
+        :return: Command string
+        :rtype: str
+        :raise EOFError: on input exhaustion
+        :raise IOError: on input/output errors
+        """
+
+        buf = self.__buffers__[index]
+        line = buf.readline()
+
+        # Continue receiving until '\n' is received
+        while line is None:
+
+            try:
+                data = self.__sockets__[index].recv(8192)
+            except socket.error as e:
+                raise IOError(str(e))
+
+            if not data:
+                raise EOFError('Socket closed')
+
+            self.metrics.inc('libyate_received_bytes_total', value=len(data))
+
+            buf.feed(data)
+            line = buf.readline()
+
+        return line
+
+    def write(self, string, index=None):
+        """Send command to the engine
+
+        :param string: Command string or buffer to be sent
+        :param int index: connection index, every connection if None
+        :raise IOError: on input/output errors
+        """
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Sending {0} bytes to connection {1}: {2!r}'
+                              .format(len(string), index, string))
+
+        if index is None:
+            sockets = self.__sockets__
+        else:
+            sockets = (self.__sockets__[index], )
+
+        try:
+            for sock in sockets:
+                sock.sendall(wire(string))
+
+        except socket.error as e:
+            raise IOError(str(e))
+
+    def close(self):
+        """Close input and stop receiving commands"""
+
+        for sock in self.__sockets__:
+
+            try:
+                # Close socket for read operations
+                sock.shutdown(socket.SHUT_RD)
+
+            except socket.error:
+                pass
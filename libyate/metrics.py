@@ -0,0 +1,499 @@
+"""
+libyate - application metrics
+"""
+
+import logging
+import random
+import time
+
+from bisect import bisect_left
+from collections import deque
+from threading import Event, Lock, Thread
+
+from libyate.compat import wire
+
+try:
+    # noinspection PyUnresolvedReferences,PyCompatibility
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    # noinspection PyUnresolvedReferences,PyCompatibility
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+# Latency histogram upper bounds in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+#
+# Helper functions
+#
+
+def format_labels(labels, extra=()):
+    """Return the Prometheus representation of the labels
+
+    :param tuple labels: (name, value) pairs
+    :param tuple extra: additional (name, value) pairs
+    :return: The labels string, including the braces
+    :rtype: str
+    """
+
+    labels = tuple(labels) + tuple(extra)
+
+    if not labels:
+        return ''
+
+    return '{{{0}}}'.format(','.join(
+        '{0}="{1}"'.format(k, str(v).replace('\\', '\\\\')
+                           .replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in labels))
+
+
+def format_value(value):
+    """Return the Prometheus representation of a sample value
+
+    :param value: A number
+    :rtype: str
+    """
+
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+#
+# Metric types
+#
+
+class Histogram(object):
+    """Distribution of observed values in fixed buckets
+
+    Not thread safe, the registry serializes the updates with the lock of
+    the metric.
+
+    :param tuple buckets: sorted bucket upper bounds
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Account a value
+
+        :param float value: observed value
+        """
+
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Return the cumulative count for each bucket
+
+        :return: (upper bound, count) pairs, ending with +Inf
+        :rtype: list
+        """
+
+        result = []
+        total = 0
+
+        for bound, count in zip(self.buckets + (float('inf'), ),
+                                self.counts):
+            total += count
+            result.append((bound, total))
+
+        return result
+
+
+class Metrics(object):
+    """Registry of counters, gauges and histograms
+
+    Series are identified by a metric name and a tuple of (label, value)
+    pairs. Gauges are functions evaluated only when the metrics are
+    exported, so they cost nothing on the hot path. Each counter and
+    histogram has its own lock, so threads updating different metrics do
+    not wait for each other.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+
+        # (lock, series by labels) by metric name
+        self._counters = {}
+        self._histograms = {}
+
+        self._gauges = {}
+        self._help = {}
+
+    def _metric(self, metrics, name):
+        """Return the lock and series of a counter or histogram, created on
+        first use
+
+        :param dict metrics: counters or histograms
+        :param str name: metric name
+        :return: (lock, series by labels) tuple
+        :rtype: tuple
+        """
+
+        with self._lock:
+            metric = metrics.get(name)
+
+            if metric is None:
+                metric = metrics[name] = (Lock(), {})
+
+            return metric
+
+    def describe(self, name, text):
+        """Set the help text of a metric
+
+        :param str name: metric name
+        :param str text: help text
+        """
+
+        self._help[name] = text
+
+    def inc(self, name, labels=(), value=1):
+        """Increment a counter
+
+        :param str name: metric name
+        :param tuple labels: (label, value) pairs
+        :param value: amount to add
+        :type value: int or float
+        """
+
+        metric = self._counters.get(name)
+
+        if metric is None:
+            metric = self._metric(self._counters, name)
+
+        lock, series = metric
+
+        with lock:
+            series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name, value, labels=()):
+        """Account a value on a histogram
+
+        :param str name: metric name
+        :param float value: observed value
+        :param tuple labels: (label, value) pairs
+        """
+
+        metric = self._histograms.get(name)
+
+        if metric is None:
+            metric = self._metric(self._histograms, name)
+
+        lock, series = metric
+
+        with lock:
+            histogram = series.get(labels)
+
+            if histogram is None:
+                histogram = series[labels] = Histogram()
+
+            histogram.observe(value)
+
+    def gauge(self, name, func):
+        """Register a gauge
+
+        :param str name: metric name
+        :param function func: function returning the gauge value or a
+            dictionary of values keyed by labels
+        """
+
+        self._gauges[name] = func
+
+    def counter(self, name, labels=()):
+        """Return the current value of a counter
+
+        :param str name: metric name
+        :param tuple labels: (label, value) pairs
+        :rtype: int or float
+        """
+
+        metric = self._counters.get(name)
+
+        if metric is None:
+            return 0
+
+        return metric[1].get(labels, 0)
+
+    def snapshot(self):
+        """Return a copy of every series
+
+        :return: Dictionary with the counters, gauges and histograms, each
+            one keyed by metric name and labels
+        :rtype: dict
+        """
+
+        gauges = {}
+
+        for name, func in self._gauges.items():
+            try:
+                value = func()
+            except Exception:
+                continue
+
+            gauges[name] = value if isinstance(value, dict) else {(): value}
+
+        with self._lock:
+            counter_items = list(self._counters.items())
+            histogram_items = list(self._histograms.items())
+
+        counters = {}
+        histograms = {}
+
+        for name, (lock, series) in counter_items:
+            with lock:
+                counters[name] = dict(series)
+
+        for name, (lock, series) in histogram_items:
+            with lock:
+                histograms[name] = dict(
+                    (labels, {'count': h.count, 'sum': h.sum,
+                              'buckets': h.cumulative()})
+                    for labels, h in series.items())
+
+        return {
+            'counters': counters,
+            'gauges': gauges,
+            'histograms': histograms,
+        }
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format
+
+        :rtype: str
+        """
+
+        snapshot = self.snapshot()
+        lines = []
+
+        for kind, metric_type in (('counters', 'counter'),
+                                  ('gauges', 'gauge')):
+            for name, series in sorted(snapshot[kind].items()):
+                if name in self._help:
+                    lines.append('# HELP {0} {1}'.format(
+                        name, self._help[name]))
+
+                lines.append('# TYPE {0} {1}'.format(name, metric_type))
+
+                for labels, value in sorted(series.items()):
+                    lines.append('{0}{1} {2}'.format(
+                        name, format_labels(labels), format_value(value)))
+
+        for name, series in sorted(snapshot['histograms'].items()):
+            if name in self._help:
+                lines.append('# HELP {0} {1}'.format(name, self._help[name]))
+
+            lines.append('# TYPE {0} histogram'.format(name))
+
+            for labels, h in sorted(series.items()):
+                for bound, count in h['buckets']:
+                    lines.append('{0}_bucket{1} {2}'.format(
+                        name, format_labels(labels,
+                                            (('le', format_value(bound)), )),
+                        count))
+
+                lines.append('{0}_sum{1} {2}'.format(
+                    name, format_labels(labels), format_value(h['sum'])))
+                lines.append('{0}_count{1} {2}'.format(
+                    name, format_labels(labels), h['count']))
+
+        lines.append('')
+
+        return '\n'.join(lines)
+
+
+#
+# Profiling
+#
+
+class Trace(object):
+    """Timestamps of a message through the application stages
+
+    :param float start: time the message line was read, now if None
+    """
+
+    def __init__(self, start=None):
+        self.name = None
+        self.pending = False
+        self.marks = [('read', time.time() if start is None else start)]
+
+    def mark(self, stage):
+        """Timestamp a stage
+
+        :param str stage: stage name
+        """
+
+        self.marks.append((stage, time.time()))
+
+    def breakdown(self):
+        """Return the time spent between each stage and the previous one
+
+        :return: (stage, seconds) pairs, ending with the total time
+        :rtype: list
+        """
+
+        result = [(stage, t - self.marks[i][1])
+                  for i, (stage, t) in enumerate(self.marks[1:])]
+        result.append(('total', self.marks[-1][1] - self.marks[0][1]))
+
+        return result
+
+
+class Profiler(object):
+    """Sample messages and account the time spent on each stage
+
+    Stages are: read (line read from the engine), enqueue (input queue),
+    dequeue, parse, dispatch (handler started), handler (handler returned),
+    serialize (reply formatted and queued), dequeue_output and write (reply
+    written to the engine). The time of each stage, measured from the
+    previous one, is accounted on the libyate_stage_seconds histogram.
+    Traces start once the line is read, the time spent waiting for and
+    reading it is not measured.
+
+    :param Metrics metrics: registry receiving the stage histograms
+    :param float sample: fraction of the messages to trace
+    :param float threshold: total time in seconds above which the trace is
+        logged and kept as slow, disabled if None
+    :param int keep: number of slow traces to keep
+    :param logging.Logger logger: logger for slow traces
+    """
+
+    def __init__(self, metrics, sample=0.01, threshold=None, keep=100,
+                 logger=None):
+        self.metrics = metrics
+        self.sample = sample
+        self.threshold = threshold
+        self.logger = logger or logging.getLogger('libyate.profiler')
+
+        self.slow = deque(maxlen=keep)
+
+        metrics.describe('libyate_stage_seconds',
+                         'Time spent on each stage by sampled messages')
+
+    def start(self, start=None):
+        """Start tracing a message if selected by the sampling
+
+        :param float start: time the message line was read, now if None
+        :return: A Trace object or None if not sampled
+        :rtype: Trace
+        """
+
+        if random.random() < self.sample:
+            return Trace(start)
+
+    def finish(self, trace):
+        """Account the trace stages
+
+        :param Trace trace: A finished trace
+        """
+
+        breakdown = trace.breakdown()
+        name = trace.name or ''
+
+        for stage, elapsed in breakdown:
+            self.metrics.observe('libyate_stage_seconds', elapsed,
+                                 (('stage', stage), ('name', name)))
+
+        total = breakdown[-1][1]
+
+        if self.threshold is not None and total >= self.threshold:
+            self.slow.append((name, breakdown))
+            self.logger.warning('Slow message "{0}" ({1:.3f} ms): {2}'.format(
+                name, total * 1000, ', '.join(
+                    '{0}={1:.3f}'.format(stage, elapsed * 1000)
+                    for stage, elapsed in breakdown[:-1])))
+
+
+#
+# Exporters
+#
+
+class LogExporter(Thread):
+    """Periodically write the metrics to a logger
+
+    :param Metrics metrics: metrics registry
+    :param float interval: time between dumps in seconds
+    :param logging.Logger logger: destination logger
+    :param int level: logging level
+    """
+
+    def __init__(self, metrics, interval=60, logger=None,
+                 level=logging.INFO):
+        super(LogExporter, self).__init__(name='MetricsLogExporter')
+        self.daemon = True
+
+        self.metrics = metrics
+        self.interval = interval
+        self.logger = logger or logging.getLogger('libyate.metrics')
+        self.level = level
+
+        self._stop_event = Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.dump()
+
+    def dump(self):
+        """Write the current metrics to the logger"""
+
+        for line in self.metrics.to_prometheus().splitlines():
+            if line and not line.startswith('#'):
+                self.logger.log(self.level, line)
+
+    def stop(self):
+        """Stop the exporter thread"""
+
+        self._stop_event.set()
+
+
+class PrometheusExporter(Thread):
+    """Serve the metrics over HTTP in the Prometheus text format
+
+    :param Metrics metrics: metrics registry
+    :param str host: listening address
+    :param int port: listening port, 0 to choose any free port
+    """
+
+    def __init__(self, metrics, host='127.0.0.1', port=9102):
+        super(PrometheusExporter, self).__init__(
+            name='MetricsPrometheusExporter')
+        self.daemon = True
+
+        self.metrics = metrics
+
+        registry = metrics
+
+        # noinspection PyPep8Naming,PyDocstring
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = wire(registry.to_prometheus())
+
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                pass
+
+        self.server = HTTPServer((host, port), Handler)
+        self.address = self.server.server_address
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        """Stop serving the metrics"""
+
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,235 @@
+"""
+libyate - network helpers
+"""
+
+import errno
+import os
+import select
+import socket
+import time
+
+from libyate.compat import native
+
+
+# Delay before starting the next connection attempt (RFC 8305)
+CONNECTION_ATTEMPT_DELAY = 0.25
+
+CONNECT_IN_PROGRESS = (0, errno.EINPROGRESS, errno.EWOULDBLOCK,
+                       errno.EALREADY, getattr(errno, 'WSAEWOULDBLOCK', 0))
+
+
+def interleave_addresses(addresses):
+    """Reorder addresses alternating between address families while keeping
+    the resolver preference order inside each family
+
+    :param list addresses: socket.getaddrinfo results
+    :return: The reordered addresses
+    :rtype: list
+    """
+
+    families = []
+    by_family = {}
+
+    for address in addresses:
+        if address[0] not in by_family:
+            families.append(address[0])
+            by_family[address[0]] = []
+
+        by_family[address[0]].append(address)
+
+    result = []
+
+    while any(by_family.values()):
+        for family in families:
+            if by_family[family]:
+                result.append(by_family[family].pop(0))
+
+    return result
+
+
+def create_connection(host, port, timeout=None,
+                      delay=CONNECTION_ATTEMPT_DELAY):
+    """Connect to a TCP host trying every resolved address
+
+    Connection attempts are started in parallel, each one after the previous
+    has failed or `delay` seconds elapsed, the first established connection
+    is returned and the others are discarded ("Happy Eyeballs").
+
+    :param str host: host address
+    :param int port: host port
+    :param float timeout: time limit to establish the connection, wait
+        indefinitely if None
+    :param float delay: time to wait before starting the next attempt
+    :return: A connected socket in blocking mode
+    :rtype: socket.socket
+    :raise socket.error: if no connection could be established
+    :raise socket.timeout: if the timeout expired
+    """
+
+    addresses = interleave_addresses(socket.getaddrinfo(
+        host, port,
+        socket.AF_UNSPEC, socket.SOCK_STREAM, socket.IPPROTO_TCP))
+
+    deadline = None if timeout is None else time.time() + timeout
+    next_attempt = 0
+    pending = {}
+    error = None
+
+    try:
+        while addresses or pending:
+            now = time.time()
+
+            if deadline is not None and now >= deadline:
+                break
+
+            # Start the next connection attempt
+            if addresses and now >= next_attempt:
+                f, t, p, c, a = addresses.pop(0)
+
+                try:
+                    sock = socket.socket(f, t, p)
+
+                except socket.error as e:
+                    error = e
+                    continue
+
+                sock.setblocking(0)
+                err = sock.connect_ex(a)
+
+                if err not in CONNECT_IN_PROGRESS:
+                    sock.close()
+                    error = socket.error(err, os.strerror(err))
+                    continue
+
+                pending[sock] = a
+                next_attempt = now + delay
+
+            # Wait for the pending attempts
+            wait = []
+
+            if addresses:
+                wait.append(next_attempt - now)
+            if deadline is not None:
+                wait.append(deadline - now)
+
+            _, w, x = select.select([], list(pending), list(pending),
+                                    max(min(wait), 0) if wait else None)
+
+            for sock in set(w + x):
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+                # Connection established
+                if err == 0:
+                    del pending[sock]
+                    sock.setblocking(1)
+                    return sock
+
+                # Connection failed, start the next attempt right away
+                del pending[sock]
+                sock.close()
+                error = socket.error(err, os.strerror(err))
+                next_attempt = 0
+
+    finally:
+        for sock in pending:
+            sock.close()
+
+    if deadline is not None and time.time() >= deadline:
+        raise socket.timeout('timed out')
+
+    if error is None:
+        error = socket.error('No address found for {0}'.format(host))
+
+    raise error
+
+
+def connect(host_or_path, port=None, timeout=None):
+    """Connect to a Yate listener
+
+    :param str host_or_path: listener host address or path to the listener
+        unix socket
+    :param int port: listener port number, required for tcp hosts
+    :param float timeout: time limit to establish the connection, wait
+        indefinitely if None
+    :return: A connected socket in blocking mode
+    :rtype: socket.socket
+    :raise ValueError: if the host or the port are missing
+    :raise socket.error: if no connection could be established
+    """
+
+    if not host_or_path:
+        raise ValueError('Either a host or a path must be specified')
+
+    # UNIX socket
+    if host_or_path[0] in ['.', '/']:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        try:
+            sock.settimeout(timeout)
+            sock.connect(host_or_path)
+            sock.settimeout(None)
+
+        except:
+            sock.close()
+            raise
+
+        return sock
+
+    if port is None:
+        raise ValueError('Port number must be specified for tcp hosts')
+
+    return create_connection(host_or_path, port, timeout)
+
+
+class LineBuffer(object):
+    """Split a byte stream into lines
+
+    Received data is appended once and lines are sliced out of it without
+    copying the rest of the buffer on each line. Lines are returned as native
+    strings, so on Python 3 every line is decoded here and its reply encoded
+    again when written, a cost the byte strings of Python 2 do not have.
+    """
+
+    def __init__(self):
+        self._buffer = b''
+        self._offset = 0
+
+    def __len__(self):
+        return len(self._buffer) - self._offset
+
+    def feed(self, data):
+        """Append received data
+
+        :param bytes data: received bytes
+        """
+
+        if self._offset:
+            self._buffer = self._buffer[self._offset:] + data
+            self._offset = 0
+
+        else:
+            self._buffer += data
+
+    def readline(self):
+        """Remove and return the next complete line
+
+        :return: The line without the line terminator or None if there is no
+            complete line
+        :rtype: str
+        """
+
+        end = self._buffer.find(b'\n', self._offset)
+
+        if end < 0:
+            return None
+
+        line = self._buffer[self._offset:end]
+        self._offset = end + 1
+
+        return native(line)
+
+    def clear(self):
+        """Discard the buffered data"""
+
+        self._buffer = b''
+        self._offset = 0
@@ -5,7 +5,52 @@ libyate - remote manager client
 import logging
 import re
 import socket
-import telnetlib
+import time
+
+from collections import deque
+from threading import Condition, Event, Lock
+
+import libyate.net
+import libyate.type
+
+from libyate.compat import native, string_types, wire
+
+
+# Telnet commands
+IAC = b'\xff'
+DONT = b'\xfe'
+DO = b'\xfd'
+WONT = b'\xfc'
+WILL = b'\xfb'
+SB = b'\xfa'
+SE = b'\xf0'
+
+# Telnet parser states
+TELNET_DATA = 0
+TELNET_IAC = 1
+TELNET_OPT = 2
+TELNET_SB = 3
+TELNET_SB_IAC = 4
+
+# Commands sent again after a reconnection by default, running them twice is
+#   harmless
+IDEMPOTENT_COMMANDS = frozenset(('auth', 'color', 'debug', 'help', 'output',
+                                 'status', 'uptime', 'version'))
+
+# Canonical decimal numbers, converted on status snapshots
+NUMBER_RE = re.compile(r'^-?(?:0|[1-9]\d*)(?:\.\d+)?$')
+
+# Status details fields kept as strings even if numeric, like phone numbers
+IDENTIFIER_FIELDS = frozenset(('Address', 'BillId', 'Called', 'Caller',
+                               'Peer'))
+
+# Reply of the debug command
+DEBUG_LEVEL_RE = re.compile(r'^Debug level: (?P<level>\d+)')
+
+# Yate log line: [timestamp] <source[:level]> message
+LOG_RE = re.compile(r'^(?:(?P<time>\d\S*) )?'
+                    r'<(?P<source>[^:>]+)(?::(?P<level>[A-Z]+))?> '
+                    r'(?P<message>.*)$')
 
 
 class RManagerException(Exception):
@@ -33,50 +78,490 @@ class SyntaxException(RManagerException):
     pass
 
 
-class RManagerSession(object):
-    """Yate rmanager client"""
+#
+# Helper functions
+#
 
-    def __init__(self, host='127.0.0.1', port=5038, password=None):
-        self.logger = logging.getLogger(self.__class__.__name__)
+def parse_status(status_list):
+    """Parse the reply of the status command
 
-        self.__input_buffer__ = ''
-        self._socket = None
-        self._auth_level = None
+    :param str status_list: The status command reply
+    :return: A list of dictionaries containing the modules status
+    :rtype: list
+    """
 
-        self.connect(host, port)
+    result = []
 
-        # Get greeting message
-        self.header = self.readline()
+    for line in status_list.splitlines():
+        # Definition, status and details groups are separated by ';'
+        definition, status = line.partition(';')[::2]
+        status, details = status.partition(';')[::2]
 
-        # Disable local output (authenticated as 'user' if successful)
-        self.write('output off\r\n')
-        for line in self:
-            if line == 'Output mode: off':
-                self._auth_level = 'user'
-                break
+        # Attributes are represented by key=value pairs separated by ','
+        definition = dict((x.partition('=')[::2])
+                          for x in definition.split(','))
 
-            elif line == 'Not authenticated!':
-                break
+        if status:
+            status = dict((x.partition('=')[::2])
+                          for x in status.split(','))
 
-        if self._auth_level is None and password is None:
-            raise AuthenticationException('Server requires authentication')
+        if details:
+            details = dict((x.partition('=')[::2])
+                           for x in details.split(','))
 
-        # Disable debugging output (authenticated as 'admin' if successful)
-        self.write('debug off\r\n')
-        for line in self:
-            if line.startswith('Debug level: '):
-                self._auth_level = 'admin'
-                break
+            # Nodes attributes are separated by '|'
+            # Attributes names are optionally defined on the 'format'
+            # attribute
+            if definition.get('format') is not None:
+                fmt = definition.get('format').split('|')
+                for k, v in details.items():
+                    details[k] = dict(zip(fmt, v.split('|')))
 
-            elif line == 'Not authenticated!':
-                break
+        result.append({
+            'definition': definition,
+            'status': status or {},
+            'details': details or {},
+        })
 
-        # Try authenticating with the provided password
-        if password:
-            self.auth(password)
+    return result
+
+
+def str_to_number(string):
+    """Convert canonical decimal strings into int or float, leave other
+    values unchanged
+
+    Only plain decimals are converted, so values like '0800123456',
+    '+5511987654321', '1_000' or 'nan' stay strings.
+
+    :param str string: A string
+    :return: An integer, a float or the original value
+    :rtype: int, float or str
+    """
+
+    if not isinstance(string, string_types) or \
+            NUMBER_RE.match(string) is None:
+        return string
+
+    if '.' in string:
+        return float(string)
+
+    return int(string)
+
+
+#
+# Status snapshots
+#
+
+class ModuleStatus(object):
+    """Typed status of a single module
+
+    :param dict definition: module definition attributes
+    :param dict status: module status attributes
+    :param dict details: module details (channels, accounts, etc.)
+    """
+
+    def __init__(self, definition=None, status=None, details=None):
+        definition = definition or {}
+
+        self.name = definition.get('name')
+        self.type = definition.get('type')
+
+        self.definition = dict(
+            (k, str_to_number(v)) for k, v in definition.items())
+        self.status = dict(
+            (k, str_to_number(v)) for k, v in (status or {}).items())
+        self.details = {}
+
+        for k, v in (details or {}).items():
+            if isinstance(v, dict):
+                v = dict((x, y if x in IDENTIFIER_FIELDS else
+                          str_to_number(y)) for x, y in v.items())
+            else:
+                v = str_to_number(v)
+
+            self.details[k] = v
+
+    def __eq__(self, other):
+        return isinstance(other, ModuleStatus) and \
+            (self.definition, self.status, self.details) == \
+            (other.definition, other.status, other.details)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return '<{0}.{1} "{2}">'.format(
+            self.__class__.__module__, self.__class__.__name__, self.name)
+
+
+class StatusDiff(object):
+    """Differences between two status snapshots
+
+    Every attribute is a dictionary keyed by module name:
+
+    - added: {id: details} of channels present only on the newer snapshot
+    - removed: {id: details} of channels present only on the older snapshot
+    - changed: {id: {attribute: (old, new)}} of modified channels
+    - status: {attribute: (old, new)} of modified module status attributes
+    """
+
+    def __init__(self):
+        self.added = {}
+        self.removed = {}
+        self.changed = {}
+        self.status = {}
+
+    def __len__(self):
+        return sum(len(x) for d in (self.added, self.removed, self.changed,
+                                    self.status)
+                   for x in d.values())
+
+    def __nonzero__(self):
+        return bool(self.added or self.removed or self.changed or
+                    self.status)
+
+    __bool__ = __nonzero__
+
+    def __repr__(self):
+        return '<{0}.{1} +{2} -{3} ~{4}>'.format(
+            self.__class__.__module__, self.__class__.__name__,
+            sum(len(x) for x in self.added.values()),
+            sum(len(x) for x in self.removed.values()),
+            sum(len(x) for x in self.changed.values()))
+
+
+class StatusSnapshot(object):
+    """Typed snapshot of the status command reply
+
+    :param list status: parsed status command reply, as returned by
+        RManagerSession.status
+    :param float timestamp: snapshot time, defaults to the current time
+    """
+
+    def __init__(self, status=(), timestamp=None):
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.modules = libyate.type.OrderedDict()
+
+        for entry in status:
+            module = ModuleStatus(**entry)
+            self.modules[module.name] = module
+
+    def __contains__(self, item):
+        return item in self.modules
+
+    def __getitem__(self, item):
+        return self.modules[item]
+
+    def __iter__(self):
+        return iter(self.modules.values())
+
+    def __len__(self):
+        return len(self.modules)
+
+    def __repr__(self):
+        return '<{0}.{1} ({2})>'.format(
+            self.__class__.__module__, self.__class__.__name__,
+            ', '.join(self.modules))
+
+    def diff(self, previous):
+        """Compare this snapshot against a previous one
+
+        Modules missing from either snapshot have all their channels reported
+        as added or removed.
+
+        :param StatusSnapshot previous: the older snapshot, None to report
+            every channel as added
+        :return: The differences between the snapshots
+        :rtype: StatusDiff
+        """
+
+        result = StatusDiff()
+
+        if previous is None:
+            previous = StatusSnapshot(timestamp=self.timestamp)
+
+        for name in set(self.modules).union(previous.modules):
+            new = self.modules.get(name) or ModuleStatus()
+            old = previous.modules.get(name) or ModuleStatus()
+
+            # Unchanged modules
+            if new == old:
+                continue
+
+            status = dict(
+                (k, (old.status.get(k), new.status.get(k)))
+                for k in set(new.status).union(old.status)
+                if old.status.get(k) != new.status.get(k))
+
+            added = dict((k, v) for k, v in new.details.items()
+                         if k not in old.details)
+
+            removed = dict((k, v) for k, v in old.details.items()
+                           if k not in new.details)
+
+            changed = {}
+
+            for k, v in new.details.items():
+                o = old.details.get(k)
+
+                if k not in old.details or o == v:
+                    continue
+
+                if isinstance(v, dict) and isinstance(o, dict):
+                    changed[k] = dict(
+                        (x, (o.get(x), v.get(x)))
+                        for x in set(v).union(o) if o.get(x) != v.get(x))
+
+                else:
+                    changed[k] = {None: (o, v)}
 
-        # Disable output coloring
-        self.color(False)
+            if status:
+                result.status[name] = status
+            if added:
+                result.added[name] = added
+            if removed:
+                result.removed[name] = removed
+            if changed:
+                result.changed[name] = changed
+
+        return result
+
+
+#
+# Log events
+#
+
+class LogEvent(object):
+    """Log line received from the engine output
+
+    :param str message: log message
+    :param str source: component that generated the message
+    :param str level: debug level name (eg: WARN, NOTE, INFO)
+    :param str time: timestamp string, if enabled on the engine
+    """
+
+    def __init__(self, message=None, source=None, level=None, time=None):
+        self.message = message
+        self.source = source
+        self.level = level
+        self.time = time
+
+    def __repr__(self):
+        return '{0}.{1}({2!r}, {3!r}, {4!r}, {5!r})'.format(
+            self.__class__.__module__, self.__class__.__name__,
+            self.message, self.source, self.level, self.time)
+
+    @classmethod
+    def from_string(cls, string):
+        """Parse a line in the Yate log format
+
+        :param str string: A log line
+        :return: A LogEvent object or None if the line is not in the log
+            format
+        :rtype: LogEvent
+        """
+
+        m = LOG_RE.match(string)
+
+        if m is None:
+            return
+
+        return cls(**m.groupdict())
+
+
+#
+# Query cache
+#
+
+class _Flight(object):
+    """Query in progress, shared by the threads waiting for its result"""
+
+    def __init__(self):
+        self.event = Event()
+        self.error = None
+        self.value = None
+
+
+class QueryCache(object):
+    """Read-through cache for rmanager query results
+
+    Results are keyed by node and command and kept for the time to live of
+    the command. Concurrent identical queries are coalesced: only the first
+    one is sent to the host and the others wait for its result. The same
+    cache may be shared by several sessions. Expired results are removed
+    when found and whenever a new result is stored.
+
+    :param dict ttl: time to live (in seconds) by command name, commands
+        without a time to live are not cached
+    """
+
+    ttl = {
+        'status': 1.0,
+        'uptime': 1.0,
+    }
+
+    def __init__(self, ttl=None):
+        if ttl is not None:
+            self.ttl = dict(ttl)
+
+        self._lock = Lock()
+        self._entries = {}
+        self._flights = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _expire(self, now):
+        """Remove the expired results, the lock must be held
+
+        :param float now: current time
+        """
+
+        for key in [k for k, v in self._entries.items() if v[0] <= now]:
+            del self._entries[key]
+
+    def get(self, node, command, query):
+        """Get the command result from the cache or execute the query
+
+        :param node: host identification (eg: (host, port) tuple)
+        :param str command: command string
+        :param function query: function returning the command result
+        :return: The command result
+        """
+
+        ttl = self.ttl.get(command.split(' ', 1)[0])
+
+        if not ttl:
+            return query()
+
+        key = (node, command.strip())
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                if entry[0] > time.time():
+                    self.hits += 1
+                    return entry[1]
+
+                del self._entries[key]
+
+            flight = self._flights.get(key)
+
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                leader = True
+                self.misses += 1
+
+            else:
+                leader = False
+                self.coalesced += 1
+
+        # Wait for the query in progress
+        if not leader:
+            flight.event.wait()
+
+            if flight.error is not None:
+                raise flight.error
+
+            return flight.value
+
+        try:
+            flight.value = query()
+
+        except Exception as e:
+            flight.error = e
+            raise
+
+        else:
+            now = time.time()
+
+            with self._lock:
+                self._expire(now)
+                self._entries[key] = (now + ttl, flight.value)
+
+        finally:
+            with self._lock:
+                del self._flights[key]
+
+            flight.event.set()
+
+        return flight.value
+
+    def invalidate(self, node=None):
+        """Discard cached results
+
+        :param node: discard only the results of this node if provided
+        """
+
+        with self._lock:
+            if node is None:
+                self._entries.clear()
+
+            else:
+                for key in [k for k in self._entries if k[0] == node]:
+                    del self._entries[key]
+
+
+class RManagerSession(object):
+    """Yate rmanager client
+
+    :param str host: host address
+    :param int port: host port
+    :param str password: authentication password
+    :param float timeout: time limit for socket operations, wait indefinitely
+        if None
+    :param float connect_timeout: time limit to establish the connection,
+        wait indefinitely if None
+    :param int retries: reconnection attempts when the connection is lost, 0
+        to disable reconnection or None to retry indefinitely
+    :param float backoff: delay before the second reconnection attempt,
+        doubled on each failed attempt
+    :param float max_backoff: maximum delay between reconnection attempts
+    :param QueryCache cache: cache for query results, disabled if None
+    """
+
+    def __init__(self, host='127.0.0.1', port=5038, password=None,
+                 timeout=None, connect_timeout=None, retries=0, backoff=0.05,
+                 max_backoff=5.0, cache=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self._read_cond = Condition(Lock())
+        self._reading = False
+        self._reconnect_lock = Lock()
+        self._reset_input()
+        self._socket = None
+        self._auth_level = None
+        self._connecting = False
+        self._connection_id = 0
+
+        self._host = host
+        self._port = port
+        self._password = password
+
+        self._events = None
+        self._events_maxsize = None
+        self._events_level = None
+        self._restore_level = None
+        self._pending_cmds = 0
+
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.cache = cache
+
+        self.events_dropped = 0
+        self.events_received = 0
+        self.reconnections = 0
+
+        self.connect(host, port)
+        self._setup()
 
     def __del__(self):
         self.close()
@@ -85,106 +570,393 @@ class RManagerSession(object):
         while True:
             yield self.readline()
 
+    def _setup(self):
+        """Initialize a newly connected session"""
+
+        self._connecting = True
+        self._auth_level = None
+
+        with self._read_cond:
+            self._pending_cmds += 1
+
+        try:
+            # Get greeting message
+            self.header = self.readline()
+
+            # Disable local output (authenticated as 'user' if successful)
+            self.write('output off\r\n')
+            for line in self:
+                if line == 'Output mode: off':
+                    self._auth_level = 'user'
+                    break
+
+                elif line == 'Not authenticated!':
+                    break
+
+            if self._auth_level is None and self._password is None:
+                raise AuthenticationException(
+                    'Server requires authentication')
+
+            # Disable debugging output (authenticated as 'admin' if
+            # successful)
+            self.write('debug off\r\n')
+            for line in self:
+                if line.startswith('Debug level: '):
+                    self._auth_level = 'admin'
+                    break
+
+                elif line == 'Not authenticated!':
+                    break
+
+            # Try authenticating with the provided password
+            if self._password:
+                self.auth(self._password)
+
+            # Disable output coloring
+            self.color(False)
+
+            # Resume the log events subscription
+            if self._events is not None:
+                self.send_cmd('output on')
+
+                if self._events_level is not None:
+                    self.send_cmd('debug {0}'.format(self._events_level))
+
+        finally:
+            with self._read_cond:
+                self._pending_cmds -= 1
+
+            self._connecting = False
+
     def connect(self, host, port):
         """Open a socket connection to the provided host and port
 
+        Every resolved address is tried in parallel, the first established
+        connection is used. Commands still waiting for a reply on the previous
+        connection fail with EOFError.
+
         :param str host: host address
         :param int port: host port
         """
 
         if self._socket is not None:
             self._socket.close()
+            self._socket = None
 
-        # Get protocols and addresses
-        l = socket.getaddrinfo(
-            host, port,
-            socket.AF_UNSPEC, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+        self._host = host
+        self._port = port
 
-        while l:
+        self._socket = libyate.net.create_connection(
+            host, port, timeout=self.connect_timeout)
+        self._socket.settimeout(self.timeout)
 
-            # Get connection data
-            f, t, p, c, a = l.pop()
+        with self._read_cond:
+            self._connection_id += 1
+            self._read_cond.notify_all()
 
-            # Try to create the socket
-            try:
-                self._socket = socket.socket(f, t, p)
+    def reconnect(self, connection_id=None):
+        """Reconnect to the host with exponential backoff and restore the
+        session (authentication and log events subscription)
 
-            # Error creating the socket
-            except socket.error:
+        :param int connection_id: connection that failed, skip reconnecting
+            if another thread already replaced it
+        :raise socket.error: if the reconnection attempts are exhausted
+        """
 
-                # Try next resource
-                if l:
-                    continue
+        with self._reconnect_lock:
+            if connection_id is not None and \
+                    connection_id != self._connection_id:
+                return
 
-                # No resources left
-                raise
+            delay = self.backoff
+            attempt = 0
 
-            # Try to connect to the address
-            try:
-                self._socket.connect(a)
+            while True:
+                attempt += 1
 
-            # Error connecting to the address
-            except socket.error:
-                self._socket.close()
+                try:
+                    with self._read_cond:
+                        self._reset_input()
 
-                # Try next resource
-                if l:
-                    continue
+                    self.connect(self._host, self._port)
+                    self._setup()
+
+                except (socket.error, IOError, EOFError) as e:
+                    if self.retries is not None and attempt >= self.retries:
+                        raise
 
-                # No resources left
-                raise
+                    self.logger.warning(
+                        'Reconnection attempt {0} failed: {1}'.format(
+                            attempt, e))
 
-            # Socket connected, continue execution
-            break
+                    time.sleep(delay)
+                    delay = min(delay * 2, self.max_backoff)
+
+                else:
+                    self.reconnections += 1
+                    self.logger.info('Reconnected to {0}:{1}'.format(
+                        self._host, self._port))
+                    return
 
     def readline(self):
+        """Receive the next line that is not a log event
+
+        :return: A line of data
+        :rtype: str
+        """
+
+        return self._receive()
+
+    def _receive(self, events=False, connection_id=None):
+        """Return the next command reply line or log event, reading from the
+        host if no other thread is
+
+        Only one thread reads at a time, without holding the lock while
+        blocked on the socket, and queues what it reads for the others. A
+        command waiting for its reply gets it as soon as it is read, even by
+        the thread waiting for log events. Lines read from a connection that
+        has been replaced meanwhile are discarded.
+
+        :param bool events: return the next log event instead of a line
+        :param int connection_id: connection the line is expected from
+        :return: A line of data, a LogEvent object or None if not subscribed
+            to log events
+        :raise EOFError: if the connection has been replaced
+        """
+
+        cond = self._read_cond
+
+        while True:
+            with cond:
+                while True:
+                    if connection_id is not None and \
+                            connection_id != self._connection_id:
+                        raise EOFError('Connection replaced')
+
+                    queue = self._events if events else self._replies
+
+                    if queue is None:
+                        return None
+
+                    if queue:
+                        return queue.popleft()
+
+                    if not self._reading:
+                        break
+
+                    cond.wait()
+
+                self._reading = True
+                reading_id = self._connection_id
+
+            line = None
+
+            try:
+                line = self._readline()
+
+            finally:
+                with cond:
+                    self._reading = False
+
+                    if line is not None and \
+                            reading_id == self._connection_id and \
+                            not self._route_event(line):
+                        self._replies.append(line)
+
+                    cond.notify_all()
+
+    def _readline(self):
         """Receive data from the host and process Telnet commands
 
         :return: A line of data
         :rtype: str
         """
 
+        buf = self.__input_buffer__
+
         # Continue receiving until '\r\n' is received
-        while '\r\n' not in self.__input_buffer__:
+        while True:
+            # Resume the search where the previous one stopped, a '\r' may
+            # have been received alone at the end of the buffer
+            pos = buf.find(b'\r\n', max(self._input_scan, self._input_offset))
+
+            if pos >= 0:
+                break
+
+            self._input_scan = max(len(buf) - 1, 0)
 
             if self._socket is None:
-                data = ''
+                data = b''
 
             else:
                 try:
                     data = self._socket.recv(8192)
+
+                # Keep timeouts apart, an idle events reader is not a lost
+                #   connection
+                except socket.timeout:
+                    raise
+
                 except socket.error as e:
                     raise IOError(str(e))
 
-            if data == '':
+            if not data:
                 raise EOFError('Socket closed')
 
             self.logger.debug('Received {0} bytes: {1!r}'
                               .format(len(data), data))
 
-            # Telnet commands
-            while telnetlib.IAC in data:
-                iac_pos = data.find(telnetlib.IAC)
-                cmd = data[iac_pos + 1]
+            self._telnet_process(data)
+
+        line = native(bytes(buf[self._input_offset:pos]))
+        self._input_offset = self._input_scan = pos + 2
+
+        # Discard consumed data once it takes over half of the buffer
+        if self._input_offset * 2 > len(buf):
+            del buf[:self._input_offset]
+            self._input_offset = self._input_scan = 0
+
+        return line
+
+    def _reset_input(self):
+        """Discard buffered input and reset the Telnet parser"""
+
+        self.__input_buffer__ = bytearray()
+        self._replies = deque()
+        self._reply_body = False
+        self._input_offset = 0
+        self._input_scan = 0
+        self._telnet_cmd = None
+        self._telnet_state = TELNET_DATA
+
+    def _route_event(self, line):
+        """Queue the line as a log event when subscribed
+
+        Lines of multi-line command replies are never events. Other lines in
+        the Yate log format are always events, as the engine output is
+        interleaved with the replies, and the remaining lines are events only
+        if no command is waiting for a reply.
+
+        :param str line: A line of data
+        :return: True if the line has been handled as an event
+        :rtype: bool
+        """
+
+        if self._reply_body:
+            if line.startswith('%%-'):
+                self._reply_body = False
+
+            return False
+
+        if self._pending_cmds and line.startswith('%%+'):
+            self._reply_body = True
+            return False
+
+        events = self._events
+
+        if events is None:
+            return False
+
+        event = LogEvent.from_string(line)
+
+        if event is None:
+            if self._pending_cmds:
+                return False
+
+            event = LogEvent(message=line)
+
+        self.events_received += 1
+
+        # Discard the oldest event if the queue is full
+        if len(events) >= self._events_maxsize:
+            events.popleft()
+            self.events_dropped += 1
+
+        events.append(event)
+
+        return True
+
+    def _telnet_process(self, data):
+        """Process Telnet commands in a single pass and append the remaining
+        data to the input buffer
+
+        The parser state is kept between calls so commands split across
+        received chunks are handled. Replies to option negotiation are sent
+        in a single write.
+
+        :param bytes data: Data received from the host
+        """
+
+        buf = self.__input_buffer__
+        state = self._telnet_state
+        replies = []
+
+        i = 0
+        n = len(data)
+
+        while i < n:
+
+            # Plain data, copy everything up to the next IAC
+            if state == TELNET_DATA:
+                j = data.find(IAC, i)
+
+                if j < 0:
+                    buf += data[i:]
+                    break
+
+                buf += data[i:j]
+                i = j + 1
+                state = TELNET_IAC
+                continue
+
+            # Subnegotiation data, skip everything up to the next IAC
+            elif state == TELNET_SB:
+                j = data.find(IAC, i)
+
+                if j < 0:
+                    break
+
+                i = j + 1
+                state = TELNET_SB_IAC
+                continue
+
+            c = data[i:i + 1]
+            i += 1
+
+            if state == TELNET_IAC:
+                # Escaped IAC byte
+                if c == IAC:
+                    buf += c
+                    state = TELNET_DATA
 
                 # Option negotiation
-                if cmd in [telnetlib.DO, telnetlib.DONT,
-                           telnetlib.WILL, telnetlib.WONT]:
+                elif c in (DO, DONT, WILL, WONT):
+                    self._telnet_cmd = c
+                    state = TELNET_OPT
 
-                    opt = data[iac_pos + 2]
-                    data = data[:iac_pos] + data[iac_pos+3:]
+                # Subnegotiation
+                elif c == SB:
+                    state = TELNET_SB
 
-                    if cmd == telnetlib.DO:
-                        self.write(telnetlib.IAC + telnetlib.WONT + opt)
-                    elif cmd == telnetlib.WILL:
-                        self.write(telnetlib.IAC + telnetlib.DONT + opt)
+                # Other commands have no arguments (NOP, GA, etc.)
+                else:
+                    state = TELNET_DATA
 
-            self.__input_buffer__ += data
+            elif state == TELNET_OPT:
+                if self._telnet_cmd == DO:
+                    replies.append(IAC + WONT + c)
+                elif self._telnet_cmd == WILL:
+                    replies.append(IAC + DONT + c)
 
-        line, self.__input_buffer__ = \
-            self.__input_buffer__.partition('\r\n')[::2]
+                state = TELNET_DATA
 
-        return line
+            elif state == TELNET_SB_IAC:
+                state = TELNET_DATA if c == SE else TELNET_SB
+
+        self._telnet_state = state
+
+        if replies:
+            self.write(native(b''.join(replies)))
 
     def write(self, string):
         """Send data to the host
@@ -200,7 +972,7 @@ class RManagerSession(object):
                           .format(len(string), string))
 
         try:
-            self._socket.sendall(string)
+            self._socket.sendall(wire(string))
 
         except socket.error as e:
             raise IOError(str(e))
@@ -210,7 +982,7 @@ class RManagerSession(object):
 
         if self._socket is not None:
             try:
-                reply = self.send_cmd('quit')
+                reply = self._send_cmd('quit')
 
                 if reply != 'Goodbye!':
                     self.logger.error(reply)
@@ -221,42 +993,205 @@ class RManagerSession(object):
             self._socket.close()
             self._socket = None
 
-        self.__input_buffer__ = ''
+        self._events = None
+        self._reset_input()
+
+    def send_cmd(self, command, retry=None):
+        """Send commands to the host and get the reply
+
+        If the connection fails and reconnection is enabled the session is
+        restored and, if retrying, the command is sent again. Otherwise the
+        error is raised once reconnected, as the command may have run. Query
+        results are served from the cache when enabled.
+
+        :param str command: Command to send to the host
+        :param bool retry: send the command again after a reconnection, by
+            default only the IDEMPOTENT_COMMANDS are
+        :return: The command reply
+        :rtype: str
+        """
+
+        if retry is None:
+            retry = command.split(' ', 1)[0] in IDEMPOTENT_COMMANDS
 
-    def send_cmd(self, command):
+        if self.cache is not None and not self._connecting:
+            return self.cache.get((self._host, self._port), command,
+                                  lambda: self._send_cmd_retry(command, retry))
+
+        return self._send_cmd_retry(command, retry)
+
+    def _send_cmd_retry(self, command, retry=True):
+        """Send commands to the host and get the reply, reconnecting if
+        enabled
+
+        :param str command: Command to send to the host
+        :param bool retry: send the command again after a reconnection
+        :return: The command reply
+        :rtype: str
+        """
+
+        while True:
+            connection_id = self._connection_id
+
+            try:
+                return self._send_cmd(command)
+
+            except (IOError, EOFError):
+                # Commands of the session setup are not retried, commands of
+                #   a replaced connection wait for the reconnection
+                if self.retries == 0 or (
+                        self._connecting and
+                        connection_id == self._connection_id):
+                    raise
+
+                self.logger.exception('Connection lost')
+                self.reconnect(connection_id)
+
+                if not retry:
+                    raise
+
+    def _send_cmd(self, command):
         """Send commands to the host and get the reply
 
         :param str command: Command to send to the host
         :return: The command reply
         :rtype: str
+        :raise EOFError: if the connection is lost or replaced before the
+            reply
+        """
+
+        with self._read_cond:
+            self._pending_cmds += 1
+            connection_id = self._connection_id
+
+        try:
+            # Send the command through the socket
+            self.write('{0}\r\n'.format(command))
+
+            # Read reply
+            for line in self._reply_lines(connection_id):
+
+                # Invalid command
+                if line.startswith('Cannot understand: '):
+                    raise SyntaxException(line)
+
+                # Not authorized to execute the command
+                elif line == 'Not authenticated!':
+                    raise PermissionException(line)
+
+                # Multi-line replies (eg: status command)
+                elif line.startswith('%%+'):
+                    result = []
+
+                    for next_line in self._reply_lines(connection_id):
+
+                        if next_line.startswith('%%-'):
+                            return '\r\n'.join(result)
+
+                        result.append(next_line)
+
+                return line
+
+        finally:
+            with self._read_cond:
+                self._pending_cmds -= 1
+
+    def _reply_lines(self, connection_id):
+        """Iterate over the lines received on a connection
+
+        :param int connection_id: connection the command was sent on
+        :return: A generator of lines
+        :rtype: generator
+        :raise EOFError: once the connection is replaced
+        """
+
+        while True:
+            yield self._receive(connection_id=connection_id)
+
+    def subscribe(self, level=None, maxsize=1000):
+        """Enable the engine output and queue the received lines as log events
+
+        Events are kept apart from command replies and can be consumed with
+        the events method. Once the queue is full the oldest events are
+        discarded and accounted in events_dropped.
+
+        :param int level: debug level to enable, restored by unsubscribe,
+            keep the current level if None (requires admin authentication)
+        :param int maxsize: maximum number of queued events
+        :raise PermissionException: if not authorized to change the debug
+            level
         """
 
-        # Send the command through the socket
-        self.write('{0}\r\n'.format(command))
+        with self._read_cond:
+            self._events_maxsize = maxsize
+            self.events_dropped = 0
+            self.events_received = 0
+
+            if self._events is None:
+                self._events = deque()
+
+        self.send_cmd('output on')
+
+        if level is not None:
+            # Level before the first subscription
+            if self._restore_level is None:
+                m = DEBUG_LEVEL_RE.match(self.send_cmd('debug'))
 
-        # Read reply
-        for line in self:
+                if m is not None:
+                    self._restore_level = int(m.group('level'))
 
-            # Invalid command
-            if line.startswith('Cannot understand: '):
-                raise SyntaxException(line)
+            self.send_cmd('debug {0}'.format(level))
+            self._events_level = level
 
-            # Not authorized to execute the command
-            elif line == 'Not authenticated!':
-                raise PermissionException(line)
+    def unsubscribe(self):
+        """Disable the engine output, restore the debug level changed by
+        subscribe and discard queued log events"""
 
-            # Multi-line replies (eg: status command)
-            elif line.startswith('%%+'):
-                result = []
+        self.send_cmd('output off')
 
-                for next_line in self:
+        if self._restore_level is not None:
+            self.send_cmd('debug {0}'.format(self._restore_level))
 
-                    if next_line.startswith('%%-'):
-                        return '\r\n'.join(result)
+        with self._read_cond:
+            self._events = None
+            self._events_level = None
+            self._restore_level = None
 
-                    result.append(next_line)
+    def events(self):
+        """Iterate over the received log events
 
-            return line
+        Blocks waiting for the engine output, command replies received
+        meanwhile are kept for the command waiting for them. Read timeouts
+        are ignored while no command is waiting for a reply.
+
+        :return: A generator of LogEvent objects
+        :rtype: generator
+        """
+
+        while True:
+            connection_id = self._connection_id
+
+            try:
+                event = self._receive(events=True)
+
+            except (IOError, EOFError) as e:
+                # No engine output for a while is not a lost connection
+                if isinstance(e, socket.timeout):
+                    with self._read_cond:
+                        if not self._pending_cmds:
+                            continue
+
+                if self.retries == 0:
+                    raise
+
+                self.logger.exception('Connection lost')
+                self.reconnect(connection_id)
+                continue
+
+            if event is None:
+                break
+
+            yield event
 
     def auth(self, password=None):
         """Show the authentication level or authenticate so you can access
@@ -390,43 +1325,21 @@ class RManagerSession(object):
         :return: A dictionary containing the modules status
         :rtype: dict
         """
-        status_list = self.send_cmd('status {0} {1}'.format(
-            'overview' if overview else '', module))
-
-        result = []
+        return parse_status(self.send_cmd('status {0} {1}'.format(
+            'overview' if overview else '', module)))
 
-        for line in status_list.splitlines():
-            # Definition, status and details groups are separated by ';'
-            definition, status = line.partition(';')[::2]
-            status, details = status.partition(';')[::2]
+    def status_snapshot(self, module='', overview=False):
+        """Shows status of all or selected modules or channels as a typed
+        snapshot
 
-            # Attributes are represented by key=value pairs separated by ','
-            definition = dict((x.partition('=')[::2])
-                              for x in definition.split(','))
-
-            if status:
-                status = dict((x.partition('=')[::2])
-                              for x in status.split(','))
-
-            if details:
-                details = dict((x.partition('=')[::2])
-                               for x in details.split(','))
-
-                # Nodes attributes are separated by '|'
-                # Attributes names are optionally defined on the 'format'
-                # attribute
-                if definition.get('format') is not None:
-                    fmt = definition.get('format').split('|')
-                    for k, v in details.items():
-                        details[k] = dict(zip(fmt, v.split('|')))
-
-            result.append({
-                'definition': definition,
-                'status': status or {},
-                'details': details or {},
-            })
+        :param str module: Which module status will be retrieved
+        :param bool overview: Get only the status overview if True, get the
+        details if False
+        :return: A snapshot of the modules status
+        :rtype: StatusSnapshot
+        """
 
-        return result
+        return StatusSnapshot(self.status(module, overview))
 
     def stop(self, exitcode=''):
         """Stops the engine with optionally provided exit code
@@ -0,0 +1,413 @@
+"""
+libyate - call routing tables
+
+A routing table is a text file with one route per line: the called number
+pattern, the caller number pattern, the target (return value of the routed
+call.route messages) and optional name=value parameters set on the message.
+Fields are separated by white space and lines starting with '#' are
+comments::
+
+    # called        caller  target                      parameters
+    0800            *       sip/sip:{called}@10.0.0.1
+    55              *       sip/sip:{1}@10.0.0.2        line=gw2
+    /^9(\\d{4})$/    100     sip/sip:{1}@10.0.0.3
+    *               *       -                           error=noroute
+
+Patterns are number prefixes, '*' for any number or /regular expressions/.
+Targets and parameters may reference the {called} and {caller} numbers and
+the groups of the called number match: {0} is the matched prefix or
+expression and {1} is the rest of the number after a prefix or the first
+group of an expression.
+
+The longest matching called prefix wins, its routes are tried in order until
+one matches the caller. The expressions are tried in order when no prefix
+matches, then the routes for any called number.
+"""
+
+import logging
+import os
+import re
+
+from threading import Event, Lock, Thread
+
+from libyate.compat import native
+
+
+# Pattern matching any number
+ANY = '*'
+
+
+class Route(object):
+    """Routing table entry
+
+    :param str called: called number pattern
+    :param str caller: caller number pattern
+    :param str target: return value of the routed messages
+    :param tuple params: (name, value) pairs set on the routed messages
+    :param int line: line number on the table file
+    :raise ValueError: on invalid regular expressions or templates
+    """
+
+    def __init__(self, called, caller=ANY, target='', params=(), line=None):
+        self.called = called
+        self.caller = caller
+        self.target = target
+        self.params = tuple(params)
+        self.line = line
+
+        self.called_prefix, self.called_regex = self._compile(called)
+        self.caller_prefix, self.caller_regex = self._compile(caller)
+
+        self._templates = '{' in target or \
+            any('{' in v for k, v in self.params)
+
+        if self._templates:
+            groups = 2 if self.called_regex is None else \
+                self.called_regex.groups + 1
+
+            try:
+                self.resolve(('', ) * groups, '', '')
+            except (AttributeError, IndexError, KeyError, ValueError) as e:
+                raise ValueError('Invalid template: {0!r}'.format(e))
+
+    def __repr__(self):
+        return '<{0}.{1} {2} {3} {4}>'.format(
+            self.__class__.__module__, self.__class__.__name__,
+            self.called, self.caller, self.target)
+
+    @staticmethod
+    def _compile(pattern):
+        """Return the prefix or the compiled expression of a pattern
+
+        :param str pattern: number pattern
+        :return: (prefix, None) or (None, regular expression object)
+        :rtype: tuple
+        """
+
+        if pattern == ANY:
+            return '', None
+
+        if len(pattern) > 1 and pattern[0] == '/' and pattern[-1] == '/':
+            try:
+                return None, re.compile(pattern[1:-1])
+            except re.error as e:
+                raise ValueError('Invalid expression {0!r}: {1}'
+                                 .format(pattern, e))
+
+        return pattern, None
+
+    def match_caller(self, caller):
+        """Return True if the caller number matches the caller pattern
+
+        :param str caller: caller number
+        :rtype: bool
+        """
+
+        if self.caller_regex is None:
+            return caller.startswith(self.caller_prefix)
+
+        return self.caller_regex.search(caller) is not None
+
+    def resolve(self, groups, called, caller):
+        """Return the target and parameters for a call
+
+        :param tuple groups: groups of the called number match
+        :param str called: called number
+        :param str caller: caller number
+        :return: (target, params) tuple
+        :rtype: tuple
+        """
+
+        if not self._templates:
+            return self.target, self.params
+
+        groups = tuple('' if g is None else g for g in groups)
+
+        def expand(template):
+            if '{' not in template:
+                return template
+
+            return template.format(*groups, called=called, caller=caller)
+
+        return (expand(self.target),
+                tuple((k, expand(v)) for k, v in self.params))
+
+
+class RoutingTable(object):
+    """Compiled set of routes
+
+    The prefixes are indexed by length, so a lookup costs a dictionary access
+    for each distinct prefix length, whatever the number of routes. Tables
+    are not modified after built, a new table is built to change the routes.
+
+    :param routes: Route objects, in the table order
+    """
+
+    def __init__(self, routes=()):
+        self.routes = tuple(routes)
+
+        self._prefixes = {}
+        self._regexes = []
+        self._defaults = []
+
+        for route in self.routes:
+            if route.called == ANY:
+                self._defaults.append(route)
+            elif route.called_regex is None:
+                self._prefixes.setdefault(route.called_prefix,
+                                          []).append(route)
+            else:
+                self._regexes.append(route)
+
+        self._lengths = sorted(set(len(p) for p in self._prefixes),
+                               reverse=True)
+
+    def __len__(self):
+        return len(self.routes)
+
+    @classmethod
+    def parse(cls, text, source='<string>'):
+        """Build a table from its text
+
+        :param str text: routing table text
+        :param str source: file name for the error messages
+        :rtype: RoutingTable
+        :raise ValueError: on invalid lines
+        """
+
+        routes = []
+
+        for number, line in enumerate(text.splitlines(), 1):
+            fields = line.split()
+
+            if not fields or fields[0].startswith('#'):
+                continue
+
+            try:
+                if len(fields) < 3:
+                    raise ValueError('Missing fields, expected called, '
+                                     'caller and target')
+
+                params = []
+
+                for field in fields[3:]:
+                    name, sep, value = field.partition('=')
+
+                    if not name or not sep:
+                        raise ValueError('Invalid parameter: {0!r}'
+                                         .format(field))
+
+                    params.append((name, value))
+
+                routes.append(Route(fields[0], fields[1], fields[2], params,
+                                    number))
+
+            except ValueError as e:
+                raise ValueError('{0}:{1}: {2}'.format(source, number, e))
+
+        return cls(routes)
+
+    @classmethod
+    def load(cls, path):
+        """Build a table from a file
+
+        :param str path: routing table file
+        :rtype: RoutingTable
+        :raise IOError: if the file can not be read
+        :raise ValueError: on invalid lines
+        """
+
+        with open(path, 'rb') as f:
+            return cls.parse(native(f.read()), path)
+
+    def lookup(self, called, caller=''):
+        """Return the target and parameters for a call
+
+        :param str called: called number
+        :param str caller: caller number
+        :return: (target, params) tuple or None if there is no route
+        :rtype: tuple
+        """
+
+        size = len(called)
+        prefixes = self._prefixes
+
+        for n in self._lengths:
+            if n > size:
+                continue
+
+            routes = prefixes.get(called[:n])
+
+            if routes is not None:
+                for route in routes:
+                    if route.match_caller(caller):
+                        return route.resolve((called[:n], called[n:]),
+                                             called, caller)
+
+        for route in self._regexes:
+            match = route.called_regex.search(called)
+
+            if match is not None and route.match_caller(caller):
+                return route.resolve((match.group(0), ) + match.groups(),
+                                     called, caller)
+
+        for route in self._defaults:
+            if route.match_caller(caller):
+                return route.resolve(('', called), called, caller)
+
+
+class Router(object):
+    """call.route handler routing with a table file
+
+    The table is reloaded by reload() or, if an interval is given, by a
+    background thread when the file changes. A new table replaces the
+    current one only once it is fully loaded, so messages are never blocked
+    and the ones being routed finish with the table they started with. A
+    table with errors is logged and ignored.
+
+    :param str path: routing table file
+    :param float interval: time between checks of the file for changes in
+        seconds, started by start()
+    :param str called: name of the called number parameter
+    :param str caller: name of the caller number parameter
+    :param logging.Logger logger: logger for the table reloads
+    :raise IOError: if the file can not be read
+    :raise ValueError: on invalid lines
+    """
+
+    def __init__(self, path, interval=None, called='called', caller='caller',
+                 logger=None):
+        self.path = path
+        self.interval = interval
+        self.called = called
+        self.caller = caller
+        self.logger = logger or logging.getLogger('libyate.routing')
+
+        self._stamp = None
+        self._lock = Lock()
+        self._stop_event = Event()
+        self._thread = None
+
+        self.table = RoutingTable()
+        self.reload()
+
+    def _file_stamp(self):
+        """Return the modification time and size of the table file
+
+        :rtype: tuple
+        """
+
+        st = os.stat(self.path)
+
+        return st.st_mtime, st.st_size
+
+    def reload(self):
+        """Load the table file and replace the current table
+
+        :rtype: RoutingTable
+        :raise IOError: if the file can not be read
+        :raise ValueError: on invalid lines
+        """
+
+        with self._lock:
+            self._stamp = self._file_stamp()
+            table = RoutingTable.load(self.path)
+
+            # Replacing the reference is atomic
+            self.table = table
+
+        self.logger.info('Loaded {0} routes from "{1}"'
+                         .format(len(table), self.path))
+
+        return table
+
+    def check(self):
+        """Reload the table file if changed since the last load attempt
+
+        :return: True if a new table was loaded
+        :rtype: bool
+        """
+
+        try:
+            if self._file_stamp() == self._stamp:
+                return False
+
+            self.reload()
+            return True
+
+        except (IOError, OSError, ValueError):
+            self.logger.exception('Error loading routes from "{0}", keeping '
+                                  'the current table'.format(self.path))
+            return False
+
+    def start(self):
+        """Start checking the table file for changes, does nothing if
+        already started
+
+        :raise ValueError: if the check interval is not set
+        """
+
+        if self.interval is None:
+            raise ValueError('Starting requires a check interval')
+
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            # A new event, so a stopped thread still waking up ends
+            self._stop_event = Event()
+
+            self._thread = Thread(target=self._watch,
+                                  args=(self._stop_event, ),
+                                  name='RouterReload')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _watch(self, stop_event):
+        """Handler function for the table checking thread
+
+        :param threading.Event stop_event: event set to stop the thread
+        """
+
+        while not stop_event.wait(self.interval):
+            self.check()
+
+    def stop(self):
+        """Stop checking the table file"""
+
+        with self._lock:
+            self._stop_event.set()
+            self._thread = None
+
+    def route(self, msg):
+        """Handler function for call.route messages
+
+        :param libyate.engine.Message msg: A call.route message
+        :return: A processed reply with the route target as return value and
+            its parameters, or not processed if there is no route
+        :rtype: libyate.engine.MessageReply
+        """
+
+        kvp = msg.kvp
+
+        if kvp:
+            result = self.table.lookup(kvp.get(self.called) or '',
+                                       kvp.get(self.caller) or '')
+
+            if result is not None:
+                target, params = result
+                return msg.reply(True, retvalue=target, kvp=params)
+
+        return msg.reply()
+
+    def install(self, app, name='call.route', priority=None, **kwargs):
+        """Install the router as message handler of an application
+
+        :param libyate.extmodule.Application app: application
+        :param str name: name of the routed messages
+        :param priority: priority in chain, default 100 if missing
+        :type priority: str or int
+        :param kwargs: other Application.install arguments
+        """
+
+        app.install(self.route, name, priority, **kwargs)
@@ -0,0 +1,173 @@
+"""
+libyate - command scheduling
+"""
+
+import time
+
+from collections import deque
+from threading import Condition, Lock
+
+from libyate.compat import queue
+
+
+# Scheduling classes
+CRITICAL = 'critical'
+NORMAL = 'normal'
+BULK = 'bulk'
+
+# Share of the dequeued items for each class when all of them are backlogged
+DEFAULT_WEIGHTS = {
+    CRITICAL: 8,
+    NORMAL: 4,
+    BULK: 1,
+}
+
+
+class FairQueue(object):
+    """Multi-class queue with weighted fair dequeuing
+
+    Items are kept in a separate FIFO queue per class. When several classes
+    have items waiting, they are dequeued with the smooth weighted round-robin
+    algorithm, so each class gets a share proportional to its weight and a
+    flood on one class can not starve the others. The interface is compatible
+    with queue.Queue for the methods used by the application.
+
+    :param dict weights: weight of each scheduling class
+    """
+
+    def __init__(self, weights=None):
+        if weights is None:
+            weights = DEFAULT_WEIGHTS
+
+        for name, weight in weights.items():
+            if weight <= 0:
+                raise ValueError('Invalid weight for class "{0}": {1!r}'
+                                 .format(name, weight))
+
+        self.weights = dict(weights)
+
+        self._queues = dict((name, deque()) for name in self.weights)
+        self._current = dict((name, 0) for name in self.weights)
+        self._last = deque()
+        self._size = 0
+        self._not_empty = Condition(Lock())
+
+    def put(self, item, sched_class=NORMAL):
+        """Queue an item
+
+        :param item: item to queue
+        :param str sched_class: scheduling class of the item
+        :raise KeyError: on unknown scheduling classes
+        """
+
+        with self._not_empty:
+            self._queues[sched_class].append(item)
+            self._size += 1
+            self._not_empty.notify()
+
+    def put_last(self, item):
+        """Queue an item served only once every class is empty, like the
+        stop sentinel
+
+        :param item: item to queue
+        """
+
+        with self._not_empty:
+            self._last.append(item)
+            self._size += 1
+            self._not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        """Remove and return an item
+
+        :param bool block: wait for an item if the queue is empty
+        :param float timeout: maximum time to wait in seconds
+        :return: The next item
+        :raise queue.Empty: if no item is available
+        """
+
+        with self._not_empty:
+            if not block:
+                if not self._size:
+                    raise queue.Empty
+
+            elif timeout is None:
+                while not self._size:
+                    self._not_empty.wait()
+
+            else:
+                end = time.time() + timeout
+
+                while not self._size:
+                    remaining = end - time.time()
+
+                    if remaining <= 0:
+                        raise queue.Empty
+
+                    self._not_empty.wait(remaining)
+
+            return self._pop()
+
+    def _pop(self):
+        """Remove the next item, the lock must be held and the queue must not
+        be empty
+
+        :return: The next item
+        """
+
+        best = None
+        total = 0
+
+        for name, items in self._queues.items():
+            if not items:
+                continue
+
+            weight = self.weights[name]
+            total += weight
+            self._current[name] += weight
+
+            # Ties go to the lightest class, whatever the dictionary order
+            if best is None or ((self._current[name], -weight) >
+                                (self._current[best], -self.weights[best])):
+                best = name
+
+        self._size -= 1
+
+        if best is None:
+            return self._last.popleft()
+
+        self._current[best] -= total
+
+        items = self._queues[best]
+        item = items.popleft()
+
+        # Idle classes do not keep credit or debt
+        if not items:
+            self._current[best] = 0
+
+        return item
+
+    def task_done(self):
+        """Compatibility with queue.Queue, nothing to do"""
+
+        pass
+
+    def qsize(self, sched_class=None):
+        """Return the number of queued items
+
+        :param str sched_class: count only the items of this class
+        :rtype: int
+        """
+
+        if sched_class is None:
+            return self._size
+
+        return len(self._queues[sched_class])
+
+    def empty(self):
+        """Return True if the queue is empty
+
+        :rtype: bool
+        """
+
+        return not self._size
@@ -0,0 +1,543 @@
+"""
+libyate - engine simulator for load testing external modules
+
+Speaks the external module protocol with a module started as a script
+(stdin/stdout) or connected to a TCP/UNIX listener, acknowledges its
+requests and generates message traffic for the installed handlers::
+
+    python -m libyate.simulator -r 500 -d 30 -- ./my_script.py
+    python -m libyate.simulator -r 500 -d 30 -l /tmp/yate.sock
+"""
+
+import logging
+import optparse
+import random
+import socket
+import subprocess
+import sys
+import time
+
+from threading import Lock, Thread
+
+import libyate
+import libyate.engine
+import libyate.type
+
+from libyate.compat import native, wire
+
+
+#
+# Helper functions
+#
+
+def percentile(values, fraction):
+    """Return the percentile of a sorted list using the nearest rank
+
+    :param list values: sorted values
+    :param float fraction: percentile as a fraction (eg: 0.99)
+    :return: The percentile value or None if the list is empty
+    """
+
+    if not values:
+        return
+
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+#
+# Message templates
+#
+
+class MessageTemplate(object):
+    """Message generated by the simulator
+
+    :param str name: name of the message
+    :param kvp: key-value pairs or function returning the key-value pairs of
+        each message (receives the message sequence number)
+    :type kvp: dict, list, tuple, libyate.type.OrderedDict or function
+    :param int weight: relative frequency of this message
+    """
+
+    def __init__(self, name, kvp=None, weight=1):
+        self.name = name
+        self.kvp = kvp
+        self.weight = weight
+
+    def build(self, seq):
+        """Return the key-value pairs for a message
+
+        :param int seq: message sequence number
+        :return: the key-value pairs
+        :rtype: libyate.type.OrderedDict
+        """
+
+        kvp = self.kvp(seq) if callable(self.kvp) else self.kvp
+
+        return libyate.type.OrderedDict(kvp or ())
+
+
+def call_kvp(seq):
+    """Key-value pairs similar to the ones of a SIP call
+
+    :param int seq: message sequence number
+    :rtype: list
+    """
+
+    return [
+        ('id', 'sip/{0}'.format(seq)),
+        ('module', 'sip'),
+        ('status', 'incoming'),
+        ('address', '10.0.{0}.{1}:5060'.format(seq // 256 % 256, seq % 256)),
+        ('billid', '1095112796-{0}'.format(seq)),
+        ('answered', 'false'),
+        ('direction', 'incoming'),
+        ('caller', '55{0:08d}'.format(random.randint(0, 10**8 - 1))),
+        ('called', '55{0:08d}'.format(random.randint(0, 10**8 - 1))),
+        ('callername', 'Simulated caller {0}'.format(seq)),
+        ('antiloop', '19'),
+        ('ip_host', '10.0.{0}.{1}'.format(seq // 256 % 256, seq % 256)),
+        ('ip_port', '5060'),
+        ('ip_transport', 'UDP'),
+        ('sip_uri', 'sip:55{0:08d}@10.0.0.1'.format(seq % 10**8)),
+        ('sip_from', 'sip:1000@10.0.0.2'),
+        ('sip_to', 'sip:2000@10.0.0.1'),
+        ('sip_callid', '{0:x}@10.0.0.2'.format(random.getrandbits(64))),
+        ('sip_contact', '<sip:1000@10.0.0.2:5060>'),
+        ('sip_user-agent', 'libyate simulator'),
+        ('rtp_addr', '10.0.0.2'),
+        ('rtp_port', str(16384 + seq % 16384)),
+        ('formats', 'alaw,mulaw,g729'),
+        ('media', 'yes'),
+        ('handlers', 'javascript:15,regexroute:100,cdrbuild:50'),
+    ]
+
+
+def timer_kvp(seq):
+    """Key-value pairs of the engine.timer message
+
+    :param int seq: message sequence number
+    :rtype: list
+    """
+
+    return [
+        ('time', str(int(time.time()))),
+        ('nodename', 'simulator'),
+        ('handlers', 'register:90,monitoring:90,queues:90'),
+    ]
+
+
+DEFAULT_TEMPLATES = {
+    'call.route': call_kvp,
+    'call.execute': call_kvp,
+    'call.preroute': call_kvp,
+    'call.cdr': call_kvp,
+    'chan.hangup': call_kvp,
+    'chan.startup': call_kvp,
+    'engine.timer': timer_kvp,
+}
+
+
+#
+# Engine simulator
+#
+
+# noinspection PyBroadException
+class Engine(object):
+    """Fake Yate engine
+
+    Messages are generated only for names with handlers installed by the
+    module, using the registered templates (see add_message) or a default
+    template. Watched messages are notified after each generated message.
+
+    :param float rate: messages per second
+    :param float duration: traffic generation time in seconds
+    :param float timeout: time to wait for replies after the traffic ends
+    :param dict params: local parameters returned to setlocal queries
+    :param str name: name for logging purposes
+    :param str prefix: message ID prefix, engines simulating a single engine
+        to the same module must use different prefixes
+    """
+
+    def __init__(self, rate=100, duration=10, timeout=5, params=None,
+                 name=None, prefix='sim'):
+
+        self.rate = rate
+        self.duration = duration
+        self.timeout = timeout
+        self.prefix = prefix
+
+        self.params = {
+            'engine.version': '5.0.0',
+            'engine.release': 'simulator',
+            'engine.nodename': 'simulator',
+        }
+
+        if params is not None:
+            self.params.update(params)
+
+        self.logger = logging.getLogger(name or self.__class__.__name__)
+
+        self.handlers = {}
+        self.templates = {}
+        self.watchers = set()
+
+        self._lock = Lock()
+        self._pending = {}
+        self._write = None
+        self._seq = 0
+
+        self.latencies = []
+        self.received = {}
+        self.sent = 0
+        self.errors = 0
+
+    def add_message(self, name, kvp=None, weight=1):
+        """Register a message template
+
+        :param str name: name of the message
+        :param kvp: key-value pairs or function returning the key-value pairs
+            of each message (receives the message sequence number)
+        :type kvp: dict, list, tuple, libyate.type.OrderedDict or function
+        :param int weight: relative frequency of this message
+        """
+
+        self.templates[name] = MessageTemplate(name, kvp, weight)
+
+    def run_script(self, args):
+        """Start a module as a script and generate traffic
+
+        :param list args: command line of the module
+        :return: The traffic report
+        :rtype: dict
+        """
+
+        proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, bufsize=0)
+
+        def write(string):
+            proc.stdin.write(string)
+            proc.stdin.flush()
+
+        try:
+            return self.run(proc.stdout, write)
+
+        finally:
+            try:
+                proc.stdin.close()
+            except IOError:
+                pass
+
+            proc.wait()
+
+    def serve(self, host_or_path, port=None):
+        """Wait for a module connection on a listener and generate traffic
+
+        :param str host_or_path: listener host address or unix socket path
+        :param int port: listener port number
+        :return: The traffic report
+        :rtype: dict
+        """
+
+        if host_or_path[0] in ['.', '/']:
+            listener = socket.socket(socket.AF_UNIX)
+            listener.bind(host_or_path)
+
+        else:
+            listener = socket.socket()
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((host_or_path, port))
+
+        listener.listen(1)
+
+        self.logger.info('Waiting for module connection')
+        conn, address = listener.accept()
+        listener.close()
+
+        self.logger.info('Module connected from {0!r}'.format(address))
+
+        try:
+            return self.run(conn.makefile('rb'), conn.sendall)
+
+        finally:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+            conn.close()
+
+    def run(self, stream, write):
+        """Generate traffic over an already established transport
+
+        :param stream: binary file object receiving the module commands
+        :param function write: function sending bytes to the module
+        :return: The traffic report
+        :rtype: dict
+        """
+
+        write_lock = Lock()
+
+        def locked_write(string):
+            with write_lock:
+                write(wire(string))
+
+        self._write = locked_write
+
+        reader = Thread(target=self._input, args=(stream, ),
+                        name='SimulatorInput')
+        reader.daemon = True
+        reader.start()
+
+        # Wait for the module startup
+        deadline = time.time() + self.timeout
+        while not self.handlers and time.time() < deadline and \
+                reader.is_alive():
+            time.sleep(0.01)
+
+        if not self.handlers:
+            self.logger.warning('No handlers installed by the module')
+
+        start = time.time()
+        self._generate(start)
+        elapsed = time.time() - start
+
+        # Wait for the remaining replies
+        deadline = time.time() + self.timeout
+        while self._pending and time.time() < deadline and \
+                reader.is_alive():
+            time.sleep(0.01)
+
+        return self.report(elapsed)
+
+    def report(self, elapsed=None):
+        """Summarize the traffic
+
+        :param float elapsed: traffic generation time
+        :return: Messages sent, replies received, unanswered messages and
+            reply latency percentiles (in milliseconds)
+        :rtype: dict
+        """
+
+        with self._lock:
+            latencies = sorted(self.latencies)
+            unanswered = len(self._pending)
+
+        result = {
+            'sent': self.sent,
+            'replied': len(latencies),
+            'unanswered': unanswered,
+            'errors': self.errors,
+            'received': dict(self.received),
+            'elapsed': elapsed,
+            'rate': self.sent / elapsed if elapsed else None,
+        }
+
+        for key, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99),
+                              ('p999', 0.999), ('max', 1)):
+            value = percentile(latencies, fraction)
+            result[key] = None if value is None else value * 1000
+
+        return result
+
+    def _generate(self, start):
+        """Send messages at the configured rate"""
+
+        interval = 1.0 / self.rate
+        next_time = start
+        end = start + self.duration
+
+        while True:
+            now = time.time()
+
+            if now >= end:
+                break
+
+            if next_time > now:
+                time.sleep(next_time - now)
+
+            next_time += interval
+
+            names = list(self.handlers)
+
+            if not names:
+                continue
+
+            template = self._choose(names)
+
+            try:
+                self._send_message(template)
+            except Exception:
+                self.logger.exception('Error sending message')
+                break
+
+    def _choose(self, names):
+        """Pick a template among the installed handlers by weight"""
+
+        templates = [self.templates.get(n) or
+                     MessageTemplate(n, DEFAULT_TEMPLATES.get(n, call_kvp))
+                     for n in names]
+
+        total = sum(t.weight for t in templates)
+        point = random.uniform(0, total)
+
+        for template in templates:
+            point -= template.weight
+
+            if point <= 0:
+                return template
+
+        return templates[-1]
+
+    def _send_message(self, template):
+        """Send a message and its watcher notification"""
+
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+
+        msg = libyate.engine.Message(
+            id='{0}.{1}'.format(self.prefix, seq), time=int(time.time()),
+            name=template.name, kvp=template.build(seq))
+
+        line = '{0}\n'.format(msg)
+
+        with self._lock:
+            self._pending[msg.id] = time.time()
+            self.sent += 1
+
+        self._write(line)
+
+        if template.name in self.watchers:
+            self._write('{0}\n'.format(libyate.engine.MessageReply(
+                processed=True, name=msg.name, kvp=msg.kvp)))
+
+    def _input(self, stream):
+        """Handle the commands received from the module"""
+
+        while True:
+            line = stream.readline()
+
+            if not line:
+                self.logger.info('Module closed the connection')
+                break
+
+            line = native(line).rstrip('\n')
+
+            try:
+                cmd = libyate.engine.from_string(line)
+
+            except Exception:
+                self.errors += 1
+                self.logger.error('Invalid command: {0}'.format(line))
+                self._write('Error in:{0}\n'.format(line))
+                continue
+
+            name = type(cmd).__name__
+            self.received[name] = self.received.get(name, 0) + 1
+
+            try:
+                self._command(cmd)
+            except Exception:
+                self.logger.exception('Error processing command')
+
+    def _command(self, cmd):
+        """Reply to a command received from the module"""
+
+        if isinstance(cmd, libyate.engine.MessageReply):
+            with self._lock:
+                sent = self._pending.pop(cmd.id, None)
+
+                if sent is not None:
+                    self.latencies.append(time.time() - sent)
+
+            if sent is None:
+                self.logger.warning('Unexpected reply: {0}'.format(cmd.id))
+
+        elif isinstance(cmd, libyate.engine.Message):
+            # Module generated message, nobody else handles it
+            self._write('{0}\n'.format(libyate.engine.MessageReply(
+                id=cmd.id, processed=False, name=cmd.name,
+                retvalue=cmd.retvalue, kvp=cmd.kvp)))
+
+        elif isinstance(cmd, libyate.engine.Install):
+            self.handlers[cmd.name] = cmd.priority or 100
+            self._write('{0}\n'.format(libyate.engine.InstallReply(
+                cmd.priority or 100, cmd.name, True)))
+
+        elif isinstance(cmd, libyate.engine.UnInstall):
+            priority = self.handlers.pop(cmd.name, None)
+            self._write('{0}\n'.format(libyate.engine.UnInstallReply(
+                priority or 100, cmd.name, priority is not None)))
+
+        elif isinstance(cmd, libyate.engine.Watch):
+            self.watchers.add(cmd.name)
+            self._write('{0}\n'.format(libyate.engine.WatchReply(
+                cmd.name, True)))
+
+        elif isinstance(cmd, libyate.engine.UnWatch):
+            success = cmd.name in self.watchers
+            self.watchers.discard(cmd.name)
+            self._write('{0}\n'.format(libyate.engine.UnWatchReply(
+                cmd.name, success)))
+
+        elif isinstance(cmd, libyate.engine.SetLocal):
+            if cmd.value is not None:
+                self.params[cmd.name] = cmd.value
+
+            value = self.params.get(cmd.name)
+
+            self._write('%%<setlocal:{0}:{1}:{2}\n'.format(
+                libyate.type.yate_encode(cmd.name),
+                libyate.type.yate_encode(value or ''),
+                'true' if value is not None else 'false'))
+
+        elif isinstance(cmd, libyate.engine.Output):
+            self.logger.info('Module output: {0}'.format(cmd.output))
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        'usage: %prog [options] [-l <host or path> [-p port] | -- <script> '
+        '[args]]')
+    parser.add_option('-l', '--listen', help='wait for a module connection '
+                                             'on the host or unix socket path')
+    parser.add_option('-p', '--port', type='int', help='listener port number')
+    parser.add_option('-r', '--rate', type='float', default=100,
+                      help='messages per second (default: %default)')
+    parser.add_option('-d', '--duration', type='float', default=10,
+                      help='traffic duration in seconds (default: %default)')
+    parser.add_option('-t', '--timeout', type='float', default=5,
+                      help='time to wait for replies (default: %default)')
+    parser.add_option('-v', '--verbose', action='store_true', default=False,
+                      help='increase logging verbosity')
+
+    options, args = parser.parse_args(argv)
+
+    if not options.listen and not args:
+        parser.error('either a listener or a script must be specified')
+
+    logging.basicConfig(
+        level=logging.INFO if options.verbose else logging.WARN,
+        format='%(asctime)s <%(name)s[%(threadName)s]:%(levelname)s> '
+               '%(message)s')
+
+    engine = Engine(rate=options.rate, duration=options.duration,
+                    timeout=options.timeout)
+
+    if options.listen:
+        result = engine.serve(options.listen, options.port)
+    else:
+        result = engine.run_script(args)
+
+    for key in ('sent', 'replied', 'unanswered', 'errors', 'elapsed',
+                'rate', 'p50', 'p90', 'p99', 'p999', 'max'):
+        value = result[key]
+        print('{0:<12} {1}'.format(
+            key, '-' if value is None else
+            '{0:.3f}'.format(value) if isinstance(value, float) else value))
+
+    return 1 if result['unanswered'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,262 @@
+"""
+libyate - per-call state
+"""
+
+import time
+
+from collections import OrderedDict
+from threading import Lock
+
+
+def channel_id(msg):
+    """Return the channel ID of a message
+
+    :param msg: A libyate Message or MessageReply object
+    :return: The "id" parameter or None if missing
+    :rtype: str
+    """
+
+    kvp = msg.kvp
+
+    if kvp:
+        return kvp.get('id')
+
+
+class _Stripe(object):
+    """Part of the call states, with its own lock
+
+    :param int size: maximum number of states
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = Lock()
+
+        # [state, last access] by call, least recently used first
+        self.entries = OrderedDict()
+
+        self.hangups = 0
+        self.expirations = 0
+        self.evictions = 0
+
+
+class CallStore(object):
+    """Store of per-call state
+
+    Holds a dictionary for each call, shared by the handlers of the messages
+    of the call (call.route, call.answered, chan.hangup...). The states are
+    spread over stripes, each one with its own lock, so handlers of
+    different calls seldom wait for each other.
+
+    A state is removed when the call hangs up, after the idle timeout since
+    its last access or, to keep the store bounded, when it is the least
+    recently used one of its stripe and the stripe is full.
+
+    :param float timeout: idle time in seconds after that a state is removed,
+        no expiration if None
+    :param int size: maximum number of states
+    :param int stripes: number of independently locked stripes
+    :param float interval: time between removals of the idle states in
+        seconds, by the application timer thread
+    :param function key: function receiving a message and returning the ID of
+        its call or None, channel_id() if None
+    """
+
+    def __init__(self, timeout=3600, size=100000, stripes=16, interval=60,
+                 key=None):
+
+        if stripes < 1:
+            raise ValueError('Invalid number of stripes: {0!r}'
+                             .format(stripes))
+
+        self.timeout = timeout
+        self.size = size
+        self.interval = interval
+        self.key = channel_id if key is None else key
+
+        stripe_size = -(-size // stripes)
+
+        self._stripes = tuple(_Stripe(stripe_size) for _ in range(stripes))
+
+    def __len__(self):
+        return sum(len(s.entries) for s in self._stripes)
+
+    def __contains__(self, id):
+        return id in self._stripe(id).entries
+
+    @property
+    def hangups(self):
+        """Number of states removed on hang up
+
+        :rtype: int
+        """
+
+        return sum(s.hangups for s in self._stripes)
+
+    @property
+    def expirations(self):
+        """Number of states removed after the idle timeout
+
+        :rtype: int
+        """
+
+        return sum(s.expirations for s in self._stripes)
+
+    @property
+    def evictions(self):
+        """Number of states removed to keep the store within its size
+
+        :rtype: int
+        """
+
+        return sum(s.evictions for s in self._stripes)
+
+    def _stripe(self, id):
+        """Return the stripe of a call
+
+        :param str id: call ID
+        :rtype: _Stripe
+        """
+
+        return self._stripes[hash(id) % len(self._stripes)]
+
+    def get(self, id, default=None):
+        """Return the state of a call
+
+        :param str id: call ID
+        :param default: value returned if the call has no state
+        :rtype: dict
+        """
+
+        stripe = self._stripe(id)
+
+        with stripe.lock:
+            entry = stripe.entries.pop(id, None)
+
+            if entry is None:
+                return default
+
+            entry[1] = time.time()
+            stripe.entries[id] = entry
+
+            return entry[0]
+
+    def state(self, id):
+        """Return the state of a call, created if missing
+
+        :param str id: call ID
+        :rtype: dict
+        """
+
+        stripe = self._stripe(id)
+        now = time.time()
+
+        with stripe.lock:
+            entries = stripe.entries
+            entry = entries.pop(id, None)
+
+            if entry is None:
+                entry = [{}, now]
+                entries[id] = entry
+
+                self._evict(stripe, now)
+
+            else:
+                entry[1] = now
+                entries[id] = entry
+
+            return entry[0]
+
+    def pop(self, id, default=None):
+        """Remove and return the state of a call
+
+        :param str id: call ID
+        :param default: value returned if the call has no state
+        :rtype: dict
+        """
+
+        stripe = self._stripe(id)
+
+        with stripe.lock:
+            entry = stripe.entries.pop(id, None)
+
+        return default if entry is None else entry[0]
+
+    def for_message(self, msg):
+        """Return the state of the call of a message, created if missing
+
+        :param msg: A libyate Message or MessageReply object
+        :return: The call state or None if the message has no call ID
+        :rtype: dict
+        """
+
+        id = self.key(msg)
+
+        if id is not None:
+            return self.state(id)
+
+    def hangup(self, msg):
+        """Remove the state of the call of a chan.hangup message
+
+        :param msg: A libyate Message or MessageReply object
+        :return: The removed state or None
+        :rtype: dict
+        """
+
+        id = self.key(msg)
+
+        if id is None:
+            return
+
+        stripe = self._stripe(id)
+
+        with stripe.lock:
+            entry = stripe.entries.pop(id, None)
+
+            if entry is not None:
+                stripe.hangups += 1
+                return entry[0]
+
+    def expire(self):
+        """Remove the states idle for longer than the timeout
+
+        :return: Number of removed states
+        :rtype: int
+        """
+
+        now = time.time()
+        removed = 0
+
+        for stripe in self._stripes:
+            with stripe.lock:
+                removed += self._evict(stripe, now)
+
+        return removed
+
+    def _evict(self, stripe, now):
+        """Remove the idle states of a stripe and the least recently used
+        ones over its size, the stripe lock must be held
+
+        :param _Stripe stripe: A stripe
+        :param float now: current time
+        :return: Number of removed states
+        :rtype: int
+        """
+
+        entries = stripe.entries
+        removed = 0
+
+        if self.timeout is not None:
+            limit = now - self.timeout
+
+            while entries and entries[next(iter(entries))][1] <= limit:
+                entries.popitem(last=False)
+                stripe.expirations += 1
+                removed += 1
+
+        while len(entries) > stripe.size:
+            entries.popitem(last=False)
+            stripe.evictions += 1
+            removed += 1
+
+        return removed
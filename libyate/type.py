@@ -3,11 +3,14 @@ libyate - custom types and descriptors
 """
 
 import re
+import sys
 
 from abc import ABCMeta, abstractmethod
-from collections import MutableMapping
 from datetime import datetime
 
+from libyate.compat import PY3, MutableMapping, string_types, text_type, \
+    xrange
+
 
 #
 # Helper functions
@@ -24,9 +27,16 @@ def obj_to_str(obj):
     if obj is None:
         return ''
 
-    elif isinstance(obj, (str, unicode)):
+    elif isinstance(obj, str):
         return obj
 
+    # Text is sent to the engine as UTF-8
+    elif isinstance(obj, text_type):
+        return obj.encode('utf-8')
+
+    elif isinstance(obj, bytes):
+        return obj.decode('utf-8', 'surrogateescape')
+
     elif isinstance(obj, bool):
         return 'true' if obj else 'false'
 
@@ -53,53 +63,140 @@ def timestamp_as_str(dt):
 
     td = dt - datetime(1970, 1, 1)
     seconds = (td.microseconds +
-               (td.seconds + td.days * 24 * 3600) * 10**6) / 10**6
+               (td.seconds + td.days * 24 * 3600) * 10**6) // 10**6
     return str(seconds)
 
 
 def yate_decode(string):
     """Decode Yate up-coded strings
 
+    Strings without escape sequences are returned unchanged.
+
     :param str string: An encoded (Yate up-coded) string
     :return: A decoded (Yate down-coded) string
     :rtype: str
+    :raise ValueError: if the string has invalid escape sequences
     """
 
-    # noinspection PyDocstring
-    def replace(m):
-        if m.group(1) == '%':
-            return '%'
+    if '%' not in string:
+        return string
+
+    parts = string.split('%')
+    result = [parts[0]]
+    count = len(parts)
+    i = 1
+
+    while i < count:
+        part = parts[i]
+
+        # Escaped '%', the next part is not an escape sequence
+        if not part:
+            if i + 1 == count:
+                raise ValueError('Incomplete escape sequence')
+
+            result.append('%')
+            result.append(parts[i + 1])
+            i += 2
+
         else:
-            return chr(ord(m.group(1)) - 64)
+            result.append(chr(ord(part[0]) - 64))
+            result.append(part[1:])
+            i += 1
+
+    return ''.join(result)
 
-    return re.sub(r'%(.?)', replace, string)
+
+# Characters escaped by the Yate up-coding and their escape sequences
+ENCODE_RE = re.compile(r'[\x00-\x1f%:]')
+ENCODE_MAP = dict([(chr(i), '%{0:c}'.format(i + 64)) for i in xrange(32)] +
+                  [('%', '%%'), (':', '%z')])
 
 
 def yate_encode(string):
     """Encode string using Yate up-coded representation
 
+    Strings without special characters are returned unchanged.
+
     :param str string: A string
     :return: A encoded (Yate up-coded) string
     :rtype: str
     """
 
-    special_chars = ''.join([chr(i) for i in xrange(32)] + ['%', ':'])
+    if ENCODE_RE.search(string) is None:
+        return string
+
+    return ENCODE_RE.sub(lambda m: ENCODE_MAP[m.group()], string)
+
+
+def iter_kvp(string, raw_size=None):
+    """Iterate over the pairs of a key-value enumeration
+
+    The pairs are decoded one at a time, as they are consumed, without
+    splitting the whole enumeration first.
+
+    :param str string: An encoded key-value enumeration, pairs separated by
+        ':' and keys separated from values by '='
+    :param int raw_size: encoded values longer than this are yielded as
+        RawValue objects, to be decoded only if read; disabled if None
+    :return: An iterator of (key, value) tuples
+    :raise ValueError: if any key in the key-value pairs is empty
+    :raise ValueError: if any key or value has invalid escape sequences
+    """
+
+    end = len(string)
+    start = 0
+
+    while True:
+        stop = string.find(':', start)
 
-    # noinspection PyDocstring
-    def replace(m):
-        if m.group() == '%':
-            return '%%'
+        if stop < 0:
+            stop = end
+
+        sep = string.find('=', start, stop)
+
+        if sep < 0:
+            key = string[start:stop]
+            value = ''
+        else:
+            key = string[start:sep]
+            value = string[sep + 1:stop]
+
+        if key == '':
+            raise ValueError('Key on key-value pair cannot be empty')
+
+        if raw_size is not None and len(value) > raw_size and '%' in value:
+            value = RawValue(value)
         else:
-            return '%{0:c}'.format(ord(m.group()) + 64)
+            value = yate_decode(value)
+
+        yield yate_decode(key), value
 
-    return re.sub(r'[{0}]'.format(special_chars), replace, string)
+        if stop == end:
+            break
+
+        start = stop + 1
 
 
 #
 # Custom types
 #
 
-class OrderedDict(MutableMapping, dict):
+class RawValue(str):
+    """Key-value pair value still in its encoded (Yate up-coded) form"""
+
+    __slots__ = ()
+
+    def decode(self):
+        """Return the decoded value
+
+        :rtype: str
+        :raise ValueError: if the value has invalid escape sequences
+        """
+
+        return yate_decode(str(self))
+
+
+class _OrderedDict(MutableMapping, dict):
     """Dictionary that remembers insertion order. Useful for editing XML files
     and config files where there are (key, value) pairs but the original order
     should be preserved.
@@ -146,6 +243,150 @@ class OrderedDict(MutableMapping, dict):
         return self.__class__(self)
 
 
+# noinspection PyDocstring
+class _NativeOrderedDict(dict):
+    """Dictionary that remembers insertion order, as the built-in dict does
+    since Python 3.7"""
+
+    def __repr__(self):
+        return '{0}.{1}({2})'.format(
+            self.__class__.__module__, self.__class__.__name__,
+            tuple(tuple((k, v)) for k, v in self.items()))
+
+    def copy(self):
+        """D.copy() -> a shallow copy of D"""
+
+        return self.__class__(self)
+
+    if not hasattr(dict, '__reversed__'):
+        def __reversed__(self):
+            return reversed(list(self))
+
+
+if sys.version_info >= (3, 7):
+    OrderedDict = _NativeOrderedDict
+else:
+    OrderedDict = _OrderedDict
+
+OrderedDict.__name__ = 'OrderedDict'
+
+
+# noinspection PyDocstring
+class TrackedDict(OrderedDict):
+    """OrderedDict recording the keys set or deleted after its creation
+
+    Used for the key-value pairs of received messages, so the reply can carry
+    only the changes made while handling the message. Setting a key to its
+    current value is not a change.
+    """
+
+    # Changed keys, created on the first change
+    _changed = None
+
+    # The recipe fills the dictionary through __setitem__
+    if OrderedDict is _OrderedDict:
+        def __init__(self, seq=(), **kwargs):
+            super(TrackedDict, self).__init__(seq, **kwargs)
+            self._changed = None
+
+    def __setitem__(self, key, value):
+        if key not in self or self[key] != value:
+            self._change(key)
+
+        super(TrackedDict, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super(TrackedDict, self).__delitem__(key)
+        self._change(key)
+
+    def _change(self, key):
+        if self._changed is None:
+            self._changed = OrderedDict()
+
+        self._changed[key] = None
+
+    # The dict methods would bypass __setitem__ and __delitem__
+    update = MutableMapping.update
+    setdefault = MutableMapping.setdefault
+    pop = MutableMapping.pop
+    popitem = MutableMapping.popitem
+    clear = MutableMapping.clear
+
+    @property
+    def modified(self):
+        """True if any key was set or deleted since the creation
+
+        :rtype: bool
+        """
+
+        return bool(self._changed)
+
+    def changes(self):
+        """Return the pairs set since the creation, deleted keys have a None
+        value so they are serialized as delete markers
+
+        :rtype: OrderedDict
+        """
+
+        return OrderedDict((k, self.get(k)) for k in self._changed or ())
+
+
+# noinspection PyDocstring
+class LazyDict(OrderedDict):
+    """OrderedDict holding RawValue values, decoded on the first read
+
+    Built from key-value enumerations with large encoded values, that the
+    handlers seldom read. Values are read through the mapping interface, so
+    no raw value is ever returned.
+
+    Python 3 only: on Python 2 the dict constructor and keyword argument
+    expansion copy the values without calling __getitem__, so KeyValueList
+    decodes every value there.
+    """
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+
+        if isinstance(value, RawValue):
+            value = value.decode()
+            dict.__setitem__(self, key, value)
+
+        return value
+
+    # Not inheriting the dict fast paths, that would return raw values,
+    # also when copied by the dict constructor
+    def __iter__(self):
+        return super(LazyDict, self).__iter__()
+
+    get = MutableMapping.get
+    keys = MutableMapping.keys
+    items = MutableMapping.items
+    values = MutableMapping.values
+    pop = MutableMapping.pop
+    popitem = MutableMapping.popitem
+    setdefault = MutableMapping.setdefault
+    __eq__ = MutableMapping.__eq__
+    __ne__ = MutableMapping.__ne__
+    __hash__ = None
+
+    @property
+    def raw(self):
+        """Keys of the values not decoded yet
+
+        :rtype: list
+        """
+
+        return [k for k in self
+                if isinstance(dict.__getitem__(self, k), RawValue)]
+
+
+# noinspection PyDocstring
+class LazyTrackedDict(LazyDict, TrackedDict):
+    """TrackedDict holding RawValue values, decoded on the first read"""
+
+    pass
+
+
 #
 # Meta classes
 #
@@ -279,7 +520,7 @@ class Boolean(Descriptor):
         elif isinstance(value, bool):
             return value
 
-        elif isinstance(value, (str, unicode)):
+        elif isinstance(value, string_types):
             if value in ['true', 'false']:
                 return value == 'true'
 
@@ -311,8 +552,8 @@ class DateTime(Descriptor):
         elif isinstance(value, bool):
             raise TypeError
 
-        elif isinstance(value, (int, str, unicode)):
-            if isinstance(value, (str, unicode)):
+        elif isinstance(value, (int, ) + string_types):
+            if isinstance(value, string_types):
                 value = int(value)
 
             return datetime.utcfromtimestamp(value)
@@ -343,14 +584,32 @@ class Integer(Descriptor):
 
             return value
 
-        elif isinstance(value, (str, unicode)):
+        elif isinstance(value, string_types):
             return int(value)
 
         raise TypeError
 
 
 class KeyValueList(Descriptor):
-    """Descriptor representing an ordered dictionary"""
+    """Descriptor representing an ordered dictionary
+
+    :param bool blank: Allow value to be None
+    :param bool tracked: Store a TrackedDict when a new dictionary is built
+    :param int raw_size: encoded values longer than this are kept encoded
+        until read, see LazyDict; disabled if None and on Python 2
+    """
+
+    tracked = False
+    raw_size = None
+
+    def __init__(self, blank=None, tracked=None, raw_size=None):
+        super(KeyValueList, self).__init__(blank=blank)
+
+        if tracked is not None:
+            self.tracked = tracked
+
+        if raw_size is not None:
+            self.raw_size = raw_size
 
     def format(self, value):
         """Format value before assignment
@@ -371,9 +630,20 @@ class KeyValueList(Descriptor):
             return value
 
         elif isinstance(value, (dict, list, set, tuple)):
-            return OrderedDict(value)
+            return (TrackedDict if self.tracked else OrderedDict)(value)
+
+        elif isinstance(value, string_types):
+            raw_size = self.raw_size
+
+            if raw_size is not None and PY3 and len(value) > raw_size:
+                result = list(iter_kvp(value, raw_size))
+
+                if any(isinstance(v, RawValue) for k, v in result):
+                    return (LazyTrackedDict if self.tracked
+                            else LazyDict)(result)
+
+                return (TrackedDict if self.tracked else OrderedDict)(result)
 
-        elif isinstance(value, (str, unicode)):
             result = []
 
             for k, v in (x.partition('=')[::2] for x in value.split(':')):
@@ -383,7 +653,7 @@ class KeyValueList(Descriptor):
                 result.append((yate_decode(k),
                                yate_decode(v)))
 
-            return OrderedDict(result)
+            return (TrackedDict if self.tracked else OrderedDict)(result)
 
         raise TypeError
 
@@ -440,7 +710,7 @@ class String(Descriptor):
         elif isinstance(value, datetime):
             value = timestamp_as_str(value)
 
-        if isinstance(value, (str, unicode)):
+        if isinstance(value, string_types):
             if value or self.blank:
                 if self.min_length and len(value) < self.min_length:
                     raise ValueError('String too short for {0!r}'.format(self))
@@ -0,0 +1,21 @@
+"""
+Helpers shared by the test cases and the benchmarks
+"""
+
+import libyate.extmodule
+
+
+# noinspection PyDocstring
+class PairClient(libyate.extmodule.SocketClient):
+    """Socket client using an already connected socket"""
+
+    # noinspection PyMissingConstructor
+    def __init__(self, sock):
+        libyate.extmodule.Application.__init__(self)
+        self._init_connection(sock)
+
+    def call_route(self, msg):
+        return msg.reply(True, retvalue='sip/{0}'.format(msg.kvp['called']))
+
+    def ignore(self, msg):
+        pass
@@ -0,0 +1,126 @@
+"""
+Test cases for libyate.cache
+"""
+
+import libyate.cache
+import libyate.engine
+
+from unittest import TestCase
+
+from tests.helpers import PairClient
+
+
+def route_message(called, caller='100'):
+    return libyate.engine.Message(
+        name='call.route', kvp={'called': called, 'caller': caller})
+
+
+class TestReplyCache(TestCase):
+
+    def setUp(self):
+        self.calls = 0
+
+    def route(self, msg):
+        self.calls += 1
+        msg.kvp['location'] = 'sip/' + msg.kvp['called']
+        return msg.reply(True, retvalue='sip/' + msg.kvp['called'])
+
+    def test_hit(self):
+        cache = libyate.cache.ReplyCache(('called', ))
+        handler = cache(self.route)
+
+        first = route_message('200')
+        second = route_message('200', caller='101')
+
+        self.assertEqual(str(handler(first)),
+                         '%%<message:{0}:true::sip/200:location=sip/200'
+                         .format(first.id))
+        self.assertEqual(str(handler(second)),
+                         '%%<message:{0}:true::sip/200:location=sip/200'
+                         .format(second.id))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (1, 1, 1))
+        self.assertEqual(handler.__name__, 'route')
+
+        handler(route_message('300'))
+        self.assertEqual(self.calls, 2)
+
+    def test_key(self):
+        cache = libyate.cache.ReplyCache(
+            key=lambda msg: msg.kvp['called'][:2] or None)
+        handler = cache(self.route)
+
+        handler(route_message('200'))
+        handler(route_message('201'))
+        handler(route_message(''))
+        handler(route_message(''))
+
+        self.assertEqual(self.calls, 3)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertRaises(ValueError, libyate.cache.ReplyCache)
+
+    def test_uncached_results(self):
+        cache = libyate.cache.ReplyCache(('called', ))
+
+        msg = route_message('200')
+        cache.put(msg, None)
+        cache.put(msg, route_message('200').reply())
+
+        self.assertEqual(len(cache), 0)
+        self.assertTrue(cache.get(msg) is None)
+
+    def test_ttl(self):
+        cache = libyate.cache.ReplyCache(('called', ), ttl=0)
+        handler = cache(self.route)
+
+        handler(route_message('200'))
+        handler(route_message('200'))
+
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(cache.hits, 0)
+
+    def test_lru(self):
+        cache = libyate.cache.ReplyCache(('called', ), size=2)
+        handler = cache(self.route)
+
+        for called in ('200', '300', '200', '400', '200', '300'):
+            handler(route_message(called))
+
+        self.assertEqual(self.calls, 4)
+        self.assertEqual((cache.hits, cache.evictions, len(cache)), (2, 2, 2))
+
+    def test_max_bytes(self):
+        cache = libyate.cache.ReplyCache(
+            ('called', ), max_bytes=libyate.cache.ENTRY_OVERHEAD * 3)
+        handler = cache(self.route)
+
+        for i in range(10):
+            handler(route_message(str(i)))
+
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cache.bytes <= cache.max_bytes)
+
+        cache.clear()
+        self.assertEqual((len(cache), cache.bytes), (0, 0))
+
+
+class TestApplicationCache(TestCase):
+
+    def test_install(self):
+        app = PairClient(None)
+        app.install(app.call_route, 'call.route',
+                    cache=libyate.cache.ReplyCache(('called', )))
+
+        for _ in range(3):
+            app._command_message(route_message('200'))
+
+        labels = (('name', 'call.route'), )
+        gauges = app.metrics.snapshot()['gauges']
+
+        self.assertEqual(gauges['libyate_cache_hits'], {labels: 2})
+        self.assertEqual(gauges['libyate_cache_misses'], {labels: 1})
+        self.assertEqual(gauges['libyate_cache_entries'], {labels: 1})
+
+        app.uninstall('call.route')
+        self.assertEqual(app.metrics.snapshot()['gauges']
+                         ['libyate_cache_hits'], {})
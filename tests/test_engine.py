@@ -8,6 +8,8 @@ import libyate.type
 from datetime import datetime
 from unittest import TestCase
 
+from libyate.compat import text_type, wire, with_metaclass
+
 
 #
 # Meta classes
@@ -71,8 +73,7 @@ class CmdCaseMeta(type):
 # Test cases
 #
 
-class TestYateCmd(TestCase):
-    __metaclass__ = CmdCaseMeta
+class TestYateCmd(with_metaclass(CmdCaseMeta, TestCase)):
 
     cmd_class = None
     strings = ()
@@ -103,16 +104,15 @@ class TestYateCmd(TestCase):
                                        'p:done=75%%')),
                          "libyate.engine.Message('myapp55251%', datetime.datet"
                          "ime(2004, 9, 13, 21, 59, 54), 'app.job:', None, liby"
-                         "ate.type.OrderedDict((('path', '/bin:/usr/bin'), ('j"
+                         "ate.type.TrackedDict((('path', '/bin:/usr/bin'), ('j"
                          "ob', 'cleanup'), ('done', '75%'))))")
 
     def test_cmd_unicode(self):
-        self.assertTrue(isinstance(unicode(
-            libyate.engine.from_string('%%>connect:test')), unicode))
+        self.assertTrue(isinstance(text_type(
+            libyate.engine.from_string('%%>connect:test')), text_type))
 
 
-class TestYateCmdConnect(TestCase):
-    __metaclass__ = CmdCaseMeta
+class TestYateCmdConnect(with_metaclass(CmdCaseMeta, TestCase)):
 
     cmd_class = libyate.engine.Connect
     strings = (
@@ -129,8 +129,7 @@ class TestYateCmdConnect(TestCase):
         self.assertRaises(ValueError, self.cmd_class, '')
 
 
-class TestYateCmdError(TestCase):
-    __metaclass__ = CmdCaseMeta
+class TestYateCmdError(with_metaclass(CmdCaseMeta, TestCase)):
 
     cmd_class = libyate.engine.Error
     strings = (
@@ -143,8 +142,7 @@ class TestYateCmdError(TestCase):
         self.assertRaises(ValueError, self.cmd_class, '')
 
 
-class TestYateCmdInstall(TestCase):
-    __metaclass__ = CmdCaseMeta
+class TestYateCmdInstall(with_metaclass(CmdCaseMeta, TestCase)):
 
     cmd_class = libyate.engine.Install
     strings = (
@@ -167,8 +165,7 @@ class TestYateCmdInstall(TestCase):
         self.assertRaises(ValueError, self.cmd_class, priority='ok')
 
 
-class TestYateCmdInstallReply(TestCase):
-    __metaclass__ = CmdCaseMeta
+class TestYateCmdInstallReply(with_metaclass(CmdCaseMeta, TestCase)):
 
     cmd_class = libyate.engine.InstallReply
     strings = (
@@ -192,8 +189,7 @@ class TestYateCmdInstallReply(TestCase):
                           name='test', success='no')
 
 
-class TestYateCmdMessage(TestCase):
-    __metaclass__ = CmdCaseMeta
+class TestYateCmdMessage(with_metaclass(CmdCaseMeta, TestCase)):
 
     cmd_class = libyate.engine.Message
     strings = (
@@ -231,9 +227,97 @@ class TestYateCmdMessage(TestCase):
         self.assertTrue(isinstance(self.cmd_class().reply(),
                                    libyate.engine.MessageReply))
 
+    def test_cmd_reply_prepared(self):
+        msg = libyate.engine.from_string(
+            '%%>message:app%z1:1095112796:call.route::called=100')
+
+        for kwargs in (dict(), dict(processed=True),
+                       dict(processed=True, retvalue='sip/a:b'),
+                       dict(processed=False, retvalue='')):
+            reply = msg.reply(**kwargs)
+            expected = libyate.engine.MessageReply(
+                id=msg.id, **dict(dict(processed=False), **kwargs))
+
+            self.assertTrue(isinstance(reply, libyate.engine.PreparedReply))
+            self.assertEqual(str(reply), str(expected))
+            self.assertEqual(
+                [getattr(reply, d.__name__) for d in reply.__descriptors__],
+                [getattr(expected, d.__name__)
+                 for d in expected.__descriptors__])
+
+        self.assertFalse(isinstance(msg.reply(kvp={'a': 'b'}),
+                                    libyate.engine.PreparedReply))
+        self.assertFalse(isinstance(msg.reply(name='call.execute'),
+                                    libyate.engine.PreparedReply))
+
+    def test_cmd_reply_prepared_update(self):
+        reply = libyate.engine.from_string(
+            '%%>message:1:1095112796:call.route::').reply()
+
+        reply.kvp = {'error': 'busy'}
+        self.assertEqual(str(reply), '%%<message:1:false:::error=busy')
+
+    def test_cmd_reply_changes(self):
+        msg = libyate.engine.from_string(
+            '%%>message:1:1095112796:call.route::caller=100:called=200:'
+            'billid=1')
+
+        msg.kvp['called'] = '300'
+        del msg.kvp['billid']
+
+        self.assertEqual(str(msg.reply(True, retvalue='sip/300')),
+                         '%%<message:1:true::sip/300:called=300:billid')
+        self.assertEqual(str(msg.reply(kvp={'called': '400', 'x': 'y'})),
+                         '%%<message:1:false:::called=400:billid:x=y')
+
+    def test_cmd_write_to(self):
+        msg = libyate.engine.from_string(
+            '%%>message:1:1095112796:call.route::caller=100')
+
+        buf = bytearray(b'x')
+
+        self.assertEqual(msg.write_to(buf), 47)
+        self.assertEqual(msg.reply().write_to(buf), 22)
+        self.assertEqual(bytes(buf), b'x' + wire(str(msg)) + b'\n'
+                         b'%%<message:1:false:::\n')
+
+
+class TestIdGenerator(TestCase):
+
+    def test_generate(self):
+        generator = libyate.engine.IdGenerator()
+
+        ids = [generator() for _ in range(1000)]
+
+        self.assertEqual(len(set(ids)), 1000)
+        self.assertEqual([generator.sequence(x) for x in ids[:3]], [1, 2, 3])
+        self.assertEqual(generator.format(3), ids[2])
+        self.assertEqual(libyate.type.yate_encode(ids[0]), ids[0])
+
+    def test_sequence(self):
+        generator = libyate.engine.IdGenerator('app.')
+
+        self.assertEqual(generator.sequence('app.10'), 10)
+        self.assertEqual(generator.sequence('app.010'), None)
+        self.assertEqual(generator.sequence('app.1_0'), None)
+        self.assertEqual(generator.sequence('app.x'), None)
+        self.assertEqual(generator.sequence('other.10'), None)
+
+    def test_reset(self):
+        generator = libyate.engine.IdGenerator()
+        first = generator()
+
+        generator.reset()
+
+        self.assertNotEqual(generator(), first)
+        self.assertEqual(generator.sequence(first), None)
+
+    def test_message(self):
+        self.assertNotEqual(libyate.engine.Message().id,
+                            libyate.engine.Message().id)
+
 
-class TestYateCmdMessageReply(TestCase):
-    __metaclass__ = CmdCaseMeta
+class TestYateCmdMessageReply(with_metaclass(CmdCaseMeta, TestCase)):
 
     cmd_class = libyate.engine.MessageReply
     strings = (
@@ -272,8 +356,7 @@ class TestYateCmdMessageReply(TestCase):
         self.assertRaises(ValueError, self.cmd_class, processed='ok')
 
 
-class TestYateCmdOutput(TestCase):
-    __metaclass__ = CmdCaseMeta
+class TestYateCmdOutput(with_metaclass(CmdCaseMeta, TestCase)):
 
     cmd_class = libyate.engine.Output
     strings = (
@@ -286,8 +369,7 @@ class TestYateCmdOutput(TestCase):
         self.assertRaises(ValueError, self.cmd_class, '')
 
 
-class TestYateCmdSetLocal(TestCase):
-    __metaclass__ = CmdCaseMeta
+class TestYateCmdSetLocal(with_metaclass(CmdCaseMeta, TestCase)):
 
     cmd_class = libyate.engine.SetLocal
     strings = (
@@ -301,8 +383,7 @@ class TestYateCmdSetLocal(TestCase):
         self.assertRaises(ValueError, self.cmd_class, '')
 
 
-class TestYateCmdSetLocalReply(TestCase):
-    __metaclass__ = CmdCaseMeta
+class TestYateCmdSetLocalReply(with_metaclass(CmdCaseMeta, TestCase)):
 
     cmd_class = libyate.engine.SetLocalReply
     strings = (
@@ -322,8 +403,7 @@ class TestYateCmdSetLocalReply(TestCase):
                           value='true', success='ok')
 
 
-class TestYateCmdUnInstall(TestCase):
-    __metaclass__ = CmdCaseMeta
+class TestYateCmdUnInstall(with_metaclass(CmdCaseMeta, TestCase)):
 
     cmd_class = libyate.engine.UnInstall
     strings = (
@@ -336,8 +416,7 @@ class TestYateCmdUnInstall(TestCase):
         self.assertRaises(ValueError, self.cmd_class, '')
 
 
-class TestYateCmdUnInstallReply(TestCase):
-    __metaclass__ = CmdCaseMeta
+class TestYateCmdUnInstallReply(with_metaclass(CmdCaseMeta, TestCase)):
 
     cmd_class = libyate.engine.UnInstallReply
     strings = (
@@ -361,8 +440,7 @@ class TestYateCmdUnInstallReply(TestCase):
                           name='test', success='no')
 
 
-class TestYateCmdUnWatch(TestCase):
-    __metaclass__ = CmdCaseMeta
+class TestYateCmdUnWatch(with_metaclass(CmdCaseMeta, TestCase)):
 
     cmd_class = libyate.engine.UnWatch
     strings = (
@@ -375,8 +453,7 @@ class TestYateCmdUnWatch(TestCase):
         self.assertRaises(ValueError, self.cmd_class, '')
 
 
-class TestYateCmdUnWatchReply(TestCase):
-    __metaclass__ = CmdCaseMeta
+class TestYateCmdUnWatchReply(with_metaclass(CmdCaseMeta, TestCase)):
 
     cmd_class = libyate.engine.UnWatchReply
     strings = (
@@ -393,8 +470,7 @@ class TestYateCmdUnWatchReply(TestCase):
                           success='no')
 
 
-class TestYateCmdWatch(TestCase):
-    __metaclass__ = CmdCaseMeta
+class TestYateCmdWatch(with_metaclass(CmdCaseMeta, TestCase)):
 
     cmd_class = libyate.engine.Watch
     strings = (
@@ -407,8 +483,7 @@ class TestYateCmdWatch(TestCase):
         self.assertRaises(ValueError, self.cmd_class, '')
 
 
-class TestYateCmdWatchReply(TestCase):
-    __metaclass__ = CmdCaseMeta
+class TestYateCmdWatchReply(with_metaclass(CmdCaseMeta, TestCase)):
 
     cmd_class = libyate.engine.WatchReply
     strings = (
@@ -0,0 +1,574 @@
+"""
+Test cases for libyate.extmodule
+"""
+
+import socket
+import time
+
+import libyate.engine
+import libyate.extmodule
+import libyate.net
+import libyate.simulator
+
+from threading import Event, Thread
+from unittest import TestCase
+
+from libyate.compat import native
+from tests.helpers import PairClient
+
+
+# noinspection PyDocstring
+class SlowClient(PairClient):
+    """Socket client with a handler slower than its deadline"""
+
+    def __init__(self, sock, delay):
+        PairClient.__init__(self, sock)
+        self.delay = delay
+        self.fallbacks = 0
+
+    def slow_route(self, msg):
+        time.sleep(self.delay)
+        return msg.reply(True, retvalue='late')
+
+    def busy(self, msg):
+        self.fallbacks += 1
+        return msg.reply(True, retvalue='busy')
+
+
+def run_engine(app, engine_sock, engine, threaded=True):
+    result = {}
+
+    def run():
+        try:
+            result.update(engine.run(engine_sock.makefile('rb'),
+                                     engine_sock.sendall))
+        finally:
+            engine_sock.shutdown(socket.SHUT_RDWR)
+            engine_sock.close()
+
+    thread = Thread(target=run)
+    thread.start()
+    app.main(threaded=threaded)
+    thread.join()
+
+    return result
+
+
+class TestDeadline(TestCase):
+
+    def test_overrun(self):
+        engine_sock, app_sock = socket.socketpair()
+
+        app = SlowClient(app_sock, 0.3)
+        app.install(app.slow_route, 'call.route', deadline=0.02)
+
+        engine = libyate.simulator.Engine(rate=100, duration=0.05, timeout=1)
+        result = run_engine(app, engine_sock, engine)
+
+        self.assertTrue(result['sent'] > 0)
+        self.assertEqual(result['replied'], result['sent'])
+        self.assertEqual(result['errors'], 0)
+        self.assertTrue(result['max'] < 300)
+        self.assertEqual(app.metrics.counter(
+            'libyate_deadline_overruns_total', (('name', 'call.route'), )),
+            result['sent'])
+
+    def test_fallback(self):
+        engine_sock, app_sock = socket.socketpair()
+
+        app = SlowClient(app_sock, 0.3)
+        app.install(app.slow_route, 'call.route', deadline=0.02,
+                    fallback=app.busy)
+
+        engine = libyate.simulator.Engine(rate=100, duration=0.05, timeout=1)
+        result = run_engine(app, engine_sock, engine)
+
+        self.assertEqual(result['replied'], result['sent'])
+        self.assertEqual(app.fallbacks, result['sent'])
+
+    def test_in_time(self):
+        engine_sock, app_sock = socket.socketpair()
+
+        app = SlowClient(app_sock, 0)
+        app.install(app.slow_route, 'call.route', deadline=1,
+                    fallback=app.busy)
+
+        engine = libyate.simulator.Engine(rate=1000, duration=0.05,
+                                          timeout=2)
+        result = run_engine(app, engine_sock, engine, threaded=False)
+
+        self.assertEqual(result['replied'], result['sent'])
+        self.assertEqual(result['errors'], 0)
+        self.assertEqual(app.fallbacks, 0)
+        self.assertEqual(app.metrics.counter(
+            'libyate_deadline_overruns_total', (('name', 'call.route'), )), 0)
+
+    def test_queue_wait(self):
+        app = SlowClient(None, 0.1)
+        app.install(app.slow_route, 'call.route', deadline=0.2,
+                    fallback=app.busy)
+        app.__startup_queue__.get()
+
+        # The deadline runs while the message waits on the input queue
+        app._enqueue('%%>message:1:1095112794:call.route::')
+        time.sleep(0.15)
+        app._command(*app._receive())
+
+        self.assertEqual(app.fallbacks, 1)
+        self.assertEqual(app.__startup_queue__.get(timeout=1)[0],
+                         '%%<message:1:true::busy:\n')
+        self.assertTrue(app.__startup_queue__.empty())
+
+    def test_fallback_requires_deadline(self):
+        app = SlowClient(None, 0)
+        self.assertRaises(ValueError, app.install, app.slow_route,
+                          'call.route', fallback=app.busy)
+
+
+class TestScheduling(TestCase):
+
+    def test_classify(self):
+        app = SlowClient(None, 0)
+        app.install(app.slow_route, 'call.route', sched_class='critical')
+        app.install(app.slow_route, 'a:b', sched_class='bulk')
+        app.watch(app.busy, 'engine.timer')
+
+        self.assertEqual(app._classify(
+            '%%>message:1:1095112794:call.route::called=1'), 'critical')
+        self.assertEqual(app._classify(
+            '%%>message:2:1095112794:a%zb::'), 'bulk')
+        self.assertEqual(app._classify(
+            '%%>message:3:1095112794:chan.notify::'), 'normal')
+        self.assertEqual(app._classify(
+            '%%<message::false:engine.timer::time=1'), 'bulk')
+        self.assertEqual(app._classify(
+            '%%<message:4:true:call.route::'), 'normal')
+        self.assertEqual(app._classify('%%<install:100:call.route:true'),
+                         'normal')
+
+    def test_stop(self):
+        app = SlowClient(None, 0)
+        app.install(app.slow_route, 'call.route', sched_class='critical')
+        app.install(app.busy, 'chan.notify')
+
+        while not app.__startup_queue__.empty():
+            app.__startup_queue__.get()
+
+        for i in range(20):
+            app._enqueue('%%>message:{0}:1095112794:chan.notify::'.format(i))
+            app._enqueue('%%>message:r{0}:1095112794:call.route::'.format(i))
+
+        app.stop()
+        app._main(threaded=False)
+
+        # Every queued message is answered before the main loop ends
+        self.assertEqual(app.__startup_queue__.qsize(), 40)
+
+        replies = [app.__startup_queue__.get()[0].split(':')[1]
+                   for _ in range(40)]
+
+        self.assertEqual(sorted(replies),
+                         sorted([str(i) for i in range(20)] +
+                                ['r{0}'.format(i) for i in range(20)]))
+
+    def test_invalid_class(self):
+        app = SlowClient(None, 0)
+        self.assertRaises(ValueError, app.install, app.slow_route,
+                          'call.route', sched_class='urgent')
+        self.assertRaises(ValueError, app.watch, app.busy, 'engine.timer',
+                          sched_class='urgent')
+
+
+class TestOutput(TestCase):
+
+    def test_write(self):
+        app = SlowClient(None, 0)
+        writes = []
+
+        app.write = lambda data: writes.append(bytes(data))
+
+        msg = libyate.engine.Message('1', 0, 'call.route', '', None)
+        reply = msg.reply(True, retvalue='sip/1')
+
+        app._send(reply, force=True)
+        app._send(msg.reply(), force=True)
+        app.__output_queue__.put(None)
+
+        # Sent as formatted by _send
+        reply.retvalue = 'sip/2'
+        app._output()
+
+        self.assertEqual(writes, [b'%%<message:1:true::sip/1:\n'
+                                  b'%%<message:1:false:::\n'])
+
+
+class TestNotificationBatch(TestCase):
+
+    def setUp(self):
+        self.app = SlowClient(None, 0)
+        self.batches = []
+        self.delivered = Event()
+
+    def collect(self, items):
+        self.batches.append(items)
+        self.delivered.set()
+
+    def notify(self, name, **kvp):
+        self.app._command_message(libyate.engine.MessageReply(
+            '', False, name, '', kvp))
+
+    def test_size(self):
+        self.app.watch(self.collect, 'engine.timer',
+                       batch=libyate.extmodule.NotificationBatch(size=3))
+
+        for i in range(7):
+            self.notify('engine.timer', time=str(i))
+
+        self.assertEqual([[m.kvp['time'] for m in b] for b in self.batches],
+                         [['0', '1', '2'], ['3', '4', '5']])
+
+        self.app.unwatch('engine.timer')
+        self.assertEqual(self.batches[-1][0].kvp['time'], '6')
+
+    def test_coalesce(self):
+        self.app.watch(self.collect, 'chan.hangup',
+                       batch=libyate.extmodule.NotificationBatch(
+                           size=2, coalesce='id'))
+
+        self.notify('chan.hangup', id='sip/1', reason='a')
+        self.notify('chan.hangup', id='sip/1', reason='b')
+        self.notify('chan.hangup', reason='c')
+
+        self.assertEqual([[m.kvp['reason'] for m in b] for b in self.batches],
+                         [['b', 'c']])
+        self.assertEqual(self.app.metrics.counter(
+            'libyate_watcher_skipped_total',
+            (('name', 'chan.hangup'), ('reason', 'coalesced'))), 1)
+
+    def test_interval(self):
+        self.app.watch(self.collect, 'engine.timer',
+                       batch=libyate.extmodule.NotificationBatch(
+                           size=100, interval=0.02))
+
+        self.notify('engine.timer', time='1')
+        self.notify('engine.timer', time='2')
+
+        self.assertTrue(self.delivered.wait(5))
+        self.assertEqual([[m.kvp['time'] for m in b] for b in self.batches],
+                         [['1', '2']])
+
+    def test_sample(self):
+        handled = []
+
+        self.app.watch(handled.append, 'engine.timer',
+                       batch=libyate.extmodule.NotificationBatch(sample=0.5))
+
+        for i in range(200):
+            self.notify('engine.timer', time=str(i))
+
+        skipped = self.app.metrics.counter(
+            'libyate_watcher_skipped_total',
+            (('name', 'engine.timer'), ('reason', 'sampled')))
+
+        self.assertTrue(0 < len(handled) < 200)
+        self.assertEqual(len(handled) + skipped, 200)
+        self.assertTrue(isinstance(handled[0], libyate.engine.MessageReply))
+
+    def test_invalid(self):
+        cls = libyate.extmodule.NotificationBatch
+
+        self.assertRaises(ValueError, cls, size=0)
+        self.assertRaises(ValueError, cls, interval=0)
+        self.assertRaises(ValueError, cls, coalesce='id')
+        self.assertRaises(ValueError, cls, sample=0)
+
+
+class TestBatchHandler(TestCase):
+
+    def test_round_trip(self):
+        engine_sock, app_sock = socket.socketpair()
+
+        app = PairClient(app_sock)
+        batches = []
+
+        def route(messages):
+            batches.append(len(messages))
+            return [app.call_route(msg) for msg in messages]
+
+        app.install_batch(route, 'call.route', size=10, interval=0.005)
+
+        engine = libyate.simulator.Engine(rate=1000, duration=0.1, timeout=2)
+        result = run_engine(app, engine_sock, engine, threaded=False)
+
+        self.assertTrue(result['sent'] > 0)
+        self.assertEqual(result['replied'], result['sent'])
+        self.assertEqual(result['errors'], 0)
+        self.assertEqual(sum(batches), result['sent'])
+        self.assertTrue(max(batches) <= 10)
+
+    def test_missing_replies(self):
+        app = SlowClient(None, 0)
+
+        def auth(messages):
+            return [messages[1].reply(True, retvalue='secret'), None]
+
+        app.install_batch(auth, 'user.auth', size=3)
+
+        for i in range(3):
+            app._command_message(libyate.engine.Message(
+                str(i), 0, 'user.auth', '', {'username': str(i)}))
+
+        queue = app.__startup_queue__
+        queue.get()  # Install command
+
+        replies = [queue.get()[0] for _ in range(3)]
+
+        self.assertEqual(replies, ['%%<message:1:true::secret:\n',
+                                   '%%<message:0:false:::\n',
+                                   '%%<message:2:false:::\n'])
+        self.assertTrue(queue.empty())
+
+    def test_error(self):
+        app = SlowClient(None, 0)
+
+        def auth(messages):
+            raise RuntimeError
+
+        app.install_batch(auth, 'user.auth', size=100, interval=10)
+        app._command_message(libyate.engine.Message(
+            '1', 0, 'user.auth', '', None))
+        app.uninstall('user.auth')
+
+        queue = app.__startup_queue__
+        queue.get()  # Install command
+
+        self.assertEqual(queue.get()[0], '%%<message:1:false:::\n')
+        self.assertEqual(app.metrics.counter(
+            'libyate_handler_errors_total',
+            (('kind', 'handler'), ('name', 'user.auth'))), 1)
+
+
+class TestMultiSocketClient(TestCase):
+
+    def test_round_trip(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(2)
+
+        engines = [libyate.simulator.Engine(rate=500, duration=0.1, timeout=2,
+                                            prefix='sim{0}'.format(i))
+                   for i in range(2)]
+        results = [None, None]
+
+        for engine in engines:
+            engine.add_message('call.cdr', {'billid': '1'})
+
+        def run():
+            socks = [listener.accept()[0] for _ in engines]
+            threads = []
+
+            def run_engine_socket(i):
+                results[i] = engines[i].run(socks[i].makefile('rb'),
+                                            socks[i].sendall)
+
+            for i in range(len(engines)):
+                threads.append(Thread(target=run_engine_socket, args=(i, )))
+                threads[-1].start()
+
+            for t in threads:
+                t.join()
+
+            for sock in socks:
+                sock.shutdown(socket.SHUT_RDWR)
+                sock.close()
+
+        thread = Thread(target=run)
+        thread.start()
+
+        app = libyate.extmodule.MultiSocketClient(
+            'global', '127.0.0.1', listener.getsockname()[1], connections=2)
+
+        def route(msg):
+            return msg.reply(True, retvalue='sip/{0}'.format(msg.kvp['called']))
+
+        def cdr(msg):
+            return msg.reply(True)
+
+        app.install(route, 'call.route')
+        app.install(cdr, 'call.cdr')
+        app.set_local('engine.version')
+        app.set_local('timeout', 1000)
+        app.output('started')
+
+        app.main(threaded=False)
+        thread.join()
+        listener.close()
+
+        # Each connection got one handler and every reply went back to the
+        #   connection that sent the message
+        self.assertEqual(sorted(list(e.handlers)[0] for e in engines),
+                         ['call.cdr', 'call.route'])
+
+        for engine, result in zip(engines, results):
+            self.assertEqual(len(engine.handlers), 1)
+            self.assertTrue(result['sent'] > 0)
+            self.assertEqual(result['replied'], result['sent'])
+            self.assertEqual(result['errors'], 0)
+            self.assertEqual(result['received']['Connect'], 1)
+
+        # Output and queries went to the first connection only, assignments
+        #   to both
+        self.assertEqual(results[0]['received']['SetLocal'], 2)
+        self.assertEqual(results[0]['received']['Output'], 1)
+        self.assertEqual(results[1]['received']['SetLocal'], 1)
+        self.assertTrue('Output' not in results[1]['received'])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, libyate.extmodule.MultiSocketClient,
+                          'global', '127.0.0.1', 5039, connections=0)
+        self.assertRaises(ValueError, libyate.extmodule.MultiSocketClient,
+                          'global', '127.0.0.1')
+
+
+class TestReconnect(TestCase):
+
+    def test_replay(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+
+        received = []
+
+        def serve():
+            # First connection: wait for the module setup and drop it
+            sock = listener.accept()[0]
+            stream = sock.makefile('rb')
+
+            while not stream.readline().startswith(b'%%>message:'):
+                pass
+
+            sock.shutdown(socket.SHUT_RDWR)
+            sock.close()
+
+            # Second connection: the state must be replayed
+            sock = listener.accept()[0]
+            stream = sock.makefile('rb')
+
+            for _ in range(4):
+                received.append(native(stream.readline()).rstrip('\n'))
+
+            sock.sendall(b'%%>message:m1:0:call.route::called=100\n')
+            received.append(native(stream.readline()).rstrip('\n'))
+
+            listener.close()
+            sock.shutdown(socket.SHUT_RDWR)
+            sock.close()
+
+        thread = Thread(target=serve)
+        thread.start()
+
+        app = libyate.extmodule.SocketClient(
+            'global', '127.0.0.1', listener.getsockname()[1],
+            trackparam='test', retries=2, backoff=0.01)
+
+        replies = []
+
+        def route(msg):
+            return msg.reply(True, retvalue='sip/{0}'.format(msg.kvp['called']))
+
+        app.install(route, 'call.route', 90)
+        app.watch(replies.append, 'engine.timer')
+        app.message('call.execute', callback=replies.append)
+
+        app.main(threaded=False)
+        thread.join()
+
+        self.assertEqual(received, [
+            '%%>connect:global::',
+            '%%>setlocal:trackparam:test',
+            '%%>install:90:call.route::',
+            '%%>watch:engine.timer',
+            '%%<message:m1:true::sip/100:',
+        ])
+
+        self.assertEqual(len(replies), 1)
+        self.assertFalse(replies[0].processed)
+        self.assertEqual(app.metrics.counter('libyate_reconnections_total'),
+                         1)
+
+    def test_disabled(self):
+        engine_sock, app_sock = socket.socketpair()
+        engine_sock.close()
+
+        app = PairClient(app_sock)
+        app.__input_buffer__ = libyate.net.LineBuffer()
+
+        self.assertRaises(EOFError, app.readline)
+
+
+class TestLineBuffer(TestCase):
+
+    def test_readline(self):
+        buf = libyate.net.LineBuffer()
+
+        buf.feed(b'%%>message:1:')
+        self.assertEqual(buf.readline(), None)
+
+        buf.feed(b'0:a::\n%%<install:1')
+        buf.feed(b'00:b:true\n\n')
+
+        self.assertEqual(buf.readline(), '%%>message:1:0:a::')
+        self.assertEqual(buf.readline(), '%%<install:100:b:true')
+        self.assertEqual(buf.readline(), '')
+        self.assertEqual(buf.readline(), None)
+        self.assertEqual(len(buf), 0)
+
+        buf.feed(b'partial')
+        buf.clear()
+        buf.feed(b'line\n')
+        self.assertEqual(buf.readline(), 'line')
+
+
+class TestCallbackRegistry(TestCase):
+
+    def test_registry(self):
+        generator = libyate.engine.IdGenerator('test.')
+        registry = libyate.extmodule.CallbackRegistry(generator)
+
+        registry.add(generator(), None)
+        registry.add('test.2', len)
+        registry.add('test.02', str)
+        registry.add('other', repr)
+
+        self.assertEqual(len(registry), 4)
+        self.assertTrue('test.1' in registry)
+        self.assertFalse('test.3' in registry)
+        self.assertRaises(KeyError, registry.add, 'test.1', None)
+        self.assertRaises(KeyError, registry.add, 'other', None)
+
+        self.assertEqual(registry.pop('test.2'), len)
+        self.assertEqual(registry.pop('test.02'), str)
+        self.assertEqual(registry.pop('test.2', None), None)
+        self.assertRaises(KeyError, registry.pop, 'test.2')
+
+        self.assertEqual(sorted([registry.popitem(), registry.popitem()]),
+                         [('other', repr), ('test.1', None)])
+        self.assertRaises(KeyError, registry.popitem)
+
+    def test_message(self):
+        engine_sock, app_sock = socket.socketpair()
+
+        app = PairClient(app_sock)
+        ids = set()
+
+        for _ in range(1000):
+            app.message('call.execute')
+            ids.add(app.__startup_queue__.get()[0].split(':')[1])
+
+        self.assertEqual(len(ids), 1000)
+        self.assertEqual(len(app.__msg_callback__), 1000)
+        self.assertRaises(KeyError, app.message, 'call.execute',
+                          id=ids.pop())
+
+        app.close()
+        engine_sock.close()
@@ -0,0 +1,222 @@
+"""
+Test cases for libyate.metrics
+"""
+
+import socket
+
+import libyate.metrics
+import libyate.net
+import libyate.simulator
+
+from threading import Thread
+from unittest import TestCase
+
+from libyate.compat import wire
+from tests.helpers import PairClient
+
+try:
+    # noinspection PyUnresolvedReferences,PyCompatibility
+    from urllib2 import urlopen
+except ImportError:
+    # noinspection PyUnresolvedReferences,PyCompatibility
+    from urllib.request import urlopen
+
+
+class TestHistogram(TestCase):
+
+    def test_observe(self):
+        h = libyate.metrics.Histogram((1, 2, 5))
+
+        for value in (0.5, 1, 1.5, 3, 10):
+            h.observe(value)
+
+        self.assertEqual(h.count, 5)
+        self.assertEqual(h.sum, 16)
+        self.assertEqual(h.cumulative(),
+                         [(1, 2), (2, 3), (5, 4), (float('inf'), 5)])
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        self.metrics = libyate.metrics.Metrics()
+
+    def test_counter(self):
+        self.metrics.inc('requests_total')
+        self.metrics.inc('requests_total', value=2)
+        self.metrics.inc('requests_total', (('name', 'a'), ))
+
+        self.assertEqual(self.metrics.counter('requests_total'), 3)
+        self.assertEqual(
+            self.metrics.counter('requests_total', (('name', 'a'), )), 1)
+        self.assertEqual(self.metrics.counter('unknown_total'), 0)
+
+    def test_threads(self):
+        def run(n):
+            for i in range(1000):
+                self.metrics.inc('requests_total', (('thread', n % 2), ))
+                self.metrics.observe('latency_seconds', 0.001 * n)
+                self.metrics.snapshot()
+
+        threads = [Thread(target=run, args=(n, )) for n in range(4)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        snapshot = self.metrics.snapshot()
+
+        self.assertEqual(snapshot['counters']['requests_total'],
+                         {(('thread', 0), ): 2000, (('thread', 1), ): 2000})
+        self.assertEqual(
+            snapshot['histograms']['latency_seconds'][()]['count'], 4000)
+
+    def test_prometheus(self):
+        self.metrics.describe('requests_total', 'Requests')
+        self.metrics.inc('requests_total', (('name', 'a"b'), ))
+        self.metrics.gauge('queue_size', lambda: 3)
+        self.metrics.observe('latency_seconds', 0.002)
+
+        text = self.metrics.to_prometheus()
+
+        self.assertTrue('# HELP requests_total Requests\n' in text)
+        self.assertTrue('# TYPE requests_total counter\n' in text)
+        self.assertTrue('requests_total{name="a\\"b"} 1\n' in text)
+        self.assertTrue('queue_size 3\n' in text)
+        self.assertTrue('latency_seconds_bucket{le="0.001"} 0\n' in text)
+        self.assertTrue('latency_seconds_bucket{le="0.0025"} 1\n' in text)
+        self.assertTrue('latency_seconds_bucket{le="+Inf"} 1\n' in text)
+        self.assertTrue('latency_seconds_count 1\n' in text)
+
+    def test_failing_gauge(self):
+        self.metrics.gauge('broken', lambda: 1 / 0)
+        self.assertEqual(self.metrics.snapshot()['gauges'], {})
+
+    def test_prometheus_exporter(self):
+        self.metrics.inc('requests_total')
+
+        exporter = libyate.metrics.PrometheusExporter(self.metrics, port=0)
+        exporter.start()
+
+        try:
+            body = urlopen('http://{0}:{1}/metrics'.format(
+                *exporter.address)).read()
+        finally:
+            exporter.stop()
+
+        self.assertEqual(body, wire(self.metrics.to_prometheus()))
+
+
+class TestApplicationMetrics(TestCase):
+
+    def test_round_trip(self):
+        engine_sock, app_sock = socket.socketpair()
+
+        app = PairClient(app_sock)
+        app.install(app.call_route, 'call.route')
+
+        engine = libyate.simulator.Engine(rate=1000, duration=0.05,
+                                          timeout=2)
+
+        def run():
+            try:
+                engine.run(engine_sock.makefile('rb'), engine_sock.sendall)
+            finally:
+                engine_sock.shutdown(socket.SHUT_RDWR)
+                engine_sock.close()
+
+        thread = Thread(target=run)
+        thread.start()
+        app.main(threaded=False)
+        thread.join()
+
+        labels = (('kind', 'handler'), ('name', 'call.route'),
+                  ('handler', 'call_route'))
+
+        snapshot = app.metrics.snapshot()
+
+        self.assertEqual(app.metrics.counter('libyate_messages_total', labels),
+                         engine.sent)
+        self.assertEqual(
+            snapshot['histograms']['libyate_handler_seconds'][labels]['count'],
+            engine.sent)
+        self.assertTrue(app.metrics.counter('libyate_received_bytes_total'))
+        self.assertTrue(app.metrics.counter('libyate_sent_bytes_total'))
+        self.assertEqual(snapshot['gauges']['libyate_handlers'], {(): 1})
+
+    def test_received_bytes(self):
+        engine_sock, app_sock = socket.socketpair()
+        app = PairClient(app_sock)
+        app.__input_buffer__ = libyate.net.LineBuffer()
+
+        # Bytes as received, not characters of the decoded line
+        data = b'%%>message:m1:0:call.route::called=\xc3\xa9\n'
+        engine_sock.sendall(data)
+        app._enqueue(app.readline())
+
+        self.assertEqual(app.metrics.counter('libyate_received_bytes_total'),
+                         len(data))
+
+        engine_sock.close()
+        app_sock.close()
+
+
+class TestProfiler(TestCase):
+
+    def test_trace(self):
+        trace = libyate.metrics.Trace(start=0)
+        trace.marks.extend((('parse', 1.0), ('write', 3.5)))
+
+        self.assertEqual(trace.breakdown(),
+                         [('parse', 1.0), ('write', 2.5), ('total', 3.5)])
+
+    def test_sample(self):
+        metrics = libyate.metrics.Metrics()
+
+        profiler = libyate.metrics.Profiler(metrics, sample=0)
+        self.assertTrue(profiler.start() is None)
+
+        profiler = libyate.metrics.Profiler(metrics, sample=1)
+        self.assertTrue(profiler.start() is not None)
+        self.assertEqual(profiler.start(5).marks, [('read', 5)])
+
+    def test_round_trip(self):
+        engine_sock, app_sock = socket.socketpair()
+
+        app = PairClient(app_sock)
+        app.profiler = libyate.metrics.Profiler(app.metrics, sample=1,
+                                                threshold=0)
+        app.install(app.call_route, 'call.route')
+
+        engine = libyate.simulator.Engine(rate=1000, duration=0.05,
+                                          timeout=2)
+
+        def run():
+            try:
+                engine.run(engine_sock.makefile('rb'), engine_sock.sendall)
+            finally:
+                engine_sock.shutdown(socket.SHUT_RDWR)
+                engine_sock.close()
+
+        thread = Thread(target=run)
+        thread.start()
+        app.main(threaded=True)
+        thread.join()
+
+        stages = app.metrics.snapshot()['histograms']['libyate_stage_seconds']
+
+        for stage in ('enqueue', 'dequeue', 'parse', 'dispatch', 'handler',
+                      'serialize', 'dequeue_output', 'write', 'total'):
+            self.assertEqual(
+                stages[(('stage', stage), ('name', 'call.route'))]['count'],
+                engine.sent)
+
+        self.assertEqual(
+            stages[(('stage', 'total'), ('name', 'InstallReply'))]['count'],
+            1)
+
+        name, breakdown = app.profiler.slow[-1]
+        self.assertEqual(name, 'call.route')
+        self.assertEqual(breakdown[-1][0], 'total')
@@ -0,0 +1,525 @@
+"""
+Test cases for libyate.rmanager
+"""
+
+import socket
+import threading
+
+import libyate.net
+import libyate.rmanager
+
+from libyate.compat import native, wire
+
+from unittest import TestCase
+
+
+STATUS_1 = (
+    'name=engine,type=system;nodename=yate,plugins=40,inuse=1,handlers=300,'
+    'hooks=2,messages=0,maxqueue=3,supervised=false,runattempt=1,'
+    'lastsignal=0,threads=12,workers=5,mutexes=400,locks=0,semaphores=0,'
+    'waiting=0,acceptcalls=accept,congestion=0\r\n'
+    'name=sip,type=varchans,format=Status|Address|Peer;routed=2,routing=0,'
+    'total=2,chans=2,transactions=1;sip/1=answered|10.0.0.1:5060|wave/1,'
+    'sip/2=ringing|10.0.0.2:5060|wave/2'
+)
+
+STATUS_2 = (
+    'name=engine,type=system;nodename=yate,plugins=40,inuse=1,handlers=300,'
+    'hooks=2,messages=0,maxqueue=3,supervised=false,runattempt=1,'
+    'lastsignal=0,threads=12,workers=5,mutexes=400,locks=0,semaphores=0,'
+    'waiting=0,acceptcalls=accept,congestion=0\r\n'
+    'name=sip,type=varchans,format=Status|Address|Peer;routed=3,routing=0,'
+    'total=3,chans=2,transactions=1;sip/2=answered|10.0.0.2:5060|wave/2,'
+    'sip/3=incoming|10.0.0.3:5060|'
+)
+
+
+CDRBUILD = (
+    'name=cdrbuild,type=cdr,format=Status|Caller|Called|BillId|Duration;'
+    'cdrs=5,hungup=0;sip/4=answered|+5511987654321|0800123456|'
+    '1403660477-4|12,sip/5=answered|test|99991007|1403660477-6|3,'
+    'sip/6=answered|test|99991007|1403660477-8|2,sip/7=answered|'
+    'test|99991007|1403660477-10|2,sip/8=answered|test|99991007|'
+    '1403660477-12|2'
+)
+
+
+class TestStrToNumber(TestCase):
+
+    def test_numbers(self):
+        self.assertEqual(libyate.rmanager.str_to_number('12'), 12)
+        self.assertEqual(libyate.rmanager.str_to_number('-3'), -3)
+        self.assertEqual(libyate.rmanager.str_to_number('0'), 0)
+        self.assertEqual(libyate.rmanager.str_to_number('0.25'), 0.25)
+
+    def test_not_numbers(self):
+        for value in ('0800123456', '+5511987654321', '1_000', 'nan', 'inf',
+                      '1e3', '1.', '.5', ' 1', ''):
+            self.assertEqual(libyate.rmanager.str_to_number(value), value)
+
+
+class TestModuleStatus(TestCase):
+
+    def setUp(self):
+        self.module = libyate.rmanager.StatusSnapshot(
+            libyate.rmanager.parse_status(CDRBUILD))['cdrbuild']
+
+    def test_repr(self):
+        self.assertEqual(repr(self.module),
+                         '<libyate.rmanager.ModuleStatus "cdrbuild">')
+
+    def test_attrs(self):
+        self.assertEqual(self.module.type, 'cdr')
+        self.assertEqual(self.module.definition['format'],
+                         'Status|Caller|Called|BillId|Duration')
+        self.assertEqual(self.module.status, {'cdrs': 5, 'hungup': 0})
+        self.assertEqual(len(self.module.details), 5)
+
+    def test_identifiers(self):
+        self.assertEqual(self.module.details['sip/4'], {
+            'Status': 'answered', 'Caller': '+5511987654321',
+            'Called': '0800123456', 'BillId': '1403660477-4',
+            'Duration': 12})
+        self.assertEqual(self.module.details['sip/5']['Called'], '99991007')
+
+
+class TestStatusSnapshot(TestCase):
+
+    def setUp(self):
+        self.s1 = libyate.rmanager.StatusSnapshot(
+            libyate.rmanager.parse_status(STATUS_1), timestamp=1)
+        self.s2 = libyate.rmanager.StatusSnapshot(
+            libyate.rmanager.parse_status(STATUS_2), timestamp=2)
+
+    def test_modules(self):
+        self.assertEqual(list(self.s1.modules), ['engine', 'sip'])
+        self.assertEqual(len(self.s1), 2)
+        self.assertTrue('sip' in self.s1)
+        self.assertEqual(self.s1['sip'].type, 'varchans')
+
+    def test_numeric(self):
+        self.assertEqual(self.s1['engine'].status['plugins'], 40)
+        self.assertEqual(self.s1['engine'].status['supervised'], 'false')
+        self.assertEqual(self.s1['sip'].status['chans'], 2)
+
+    def test_details(self):
+        self.assertEqual(self.s1['sip'].details['sip/1'],
+                         {'Status': 'answered', 'Address': '10.0.0.1:5060',
+                          'Peer': 'wave/1'})
+
+    def test_diff_empty(self):
+        diff = self.s1.diff(self.s1)
+        self.assertFalse(diff)
+        self.assertEqual(len(diff), 0)
+
+    def test_diff(self):
+        diff = self.s2.diff(self.s1)
+
+        self.assertTrue(diff)
+        self.assertEqual(list(diff.added), ['sip'])
+        self.assertEqual(list(diff.added['sip']), ['sip/3'])
+        self.assertEqual(list(diff.removed['sip']), ['sip/1'])
+        self.assertEqual(diff.changed['sip'],
+                         {'sip/2': {'Status': ('ringing', 'answered')}})
+        self.assertEqual(diff.status['sip'],
+                         {'routed': (2, 3), 'total': (2, 3)})
+        self.assertTrue('engine' not in diff.status)
+
+    def test_diff_none(self):
+        diff = self.s1.diff(None)
+        self.assertEqual(sorted(diff.added['sip']), ['sip/1', 'sip/2'])
+
+
+# noinspection PyDocstring
+class FakeSocket(object):
+    """Socket replacement returning predefined chunks, or raising them if
+    they are exceptions"""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.sent = []
+
+    def recv(self, size):
+        chunk = self.chunks.pop(0) if self.chunks else b''
+
+        if isinstance(chunk, Exception):
+            raise chunk
+
+        return chunk
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+
+# noinspection PyDocstring
+class SessionMixin(object):
+
+    def session(self, *chunks):
+        session = libyate.rmanager.RManagerSession.__new__(
+            libyate.rmanager.RManagerSession)
+        session.logger = libyate.rmanager.logging.getLogger(__name__)
+        session._socket = FakeSocket(chunks)
+        session.close = lambda: None
+        session._read_cond = libyate.rmanager.Condition()
+        session._reading = False
+        session._reset_input()
+        session._events = None
+        session._events_level = None
+        session._restore_level = None
+        session._pending_cmds = 0
+        session._connecting = False
+        session._connection_id = 0
+        session.retries = 0
+        session.cache = None
+        return session
+
+
+class TestTelnet(SessionMixin, TestCase):
+
+    def test_lines(self):
+        s = self.session(b'first\r', b'\nsecond\r\nthi', b'rd\r\n')
+        self.assertEqual(s.readline(), 'first')
+        self.assertEqual(s.readline(), 'second')
+        self.assertEqual(s.readline(), 'third')
+        self.assertRaises(EOFError, s.readline)
+
+    def test_negotiation(self):
+        s = self.session(b'\xff\xfd\x18\xff\xfb\x01hello\xff',
+                         b'\xfe\x03\r\n')
+        self.assertEqual(s.readline(), 'hello')
+        self.assertEqual(s._socket.sent,
+                         [b'\xff\xfc\x18\xff\xfe\x01'])
+
+    def test_escape(self):
+        s = self.session(b'a\xff\xffb\xff', b'\xffc\r\n')
+        self.assertEqual(s.readline(), native(b'a\xffb\xffc'))
+
+    def test_subnegotiation(self):
+        s = self.session(b'a\xff\xfa\x18\x01\xff', b'\xff\xff\xf0b\r\n')
+        self.assertEqual(s.readline(), 'ab')
+        self.assertEqual(s._socket.sent, [])
+
+
+class TestConnection(SessionMixin, TestCase):
+
+    def test_replaced(self):
+        s = self.session()
+
+        def recv(size):
+            # Another thread reconnects while the reply is read
+            s._connection_id += 1
+            return b'Output mode: off\r\n'
+
+        s._socket.recv = recv
+
+        self.assertRaises(EOFError, s._send_cmd, 'output off')
+        self.assertEqual(len(s._replies), 0)
+        self.assertEqual(s._pending_cmds, 0)
+
+    def test_timeout(self):
+        s = self.session(socket.timeout('timed out'))
+        self.assertRaises(IOError, s.send_cmd, 'uptime')
+
+
+class TestEvents(SessionMixin, TestCase):
+
+    def test_from_string(self):
+        e = libyate.rmanager.LogEvent.from_string(
+            '20131022123456.123456 <sip:WARN> Invalid request')
+        self.assertEqual((e.time, e.source, e.level, e.message),
+                         ('20131022123456.123456', 'sip', 'WARN',
+                          'Invalid request'))
+
+        e = libyate.rmanager.LogEvent.from_string('<cdrbuild> Done')
+        self.assertEqual((e.source, e.level, e.message),
+                         ('cdrbuild', None, 'Done'))
+
+        self.assertTrue(
+            libyate.rmanager.LogEvent.from_string('Output mode: on') is None)
+
+    def test_subscribe(self):
+        s = self.session(b'Output mode: on\r\n<sip:INFO> one\r\n',
+                         b'plain output\r\n',
+                         b'<sip:NOTE> two\r\n<sip:NOTE> three\r\n'
+                         b'Uptime: 1\r\n')
+        s.subscribe(maxsize=1)
+
+        events = s.events()
+        self.assertEqual(next(events).message, 'one')
+        self.assertEqual(next(events).message, 'plain output')
+
+        self.assertEqual(s.send_cmd('uptime'), 'Uptime: 1')
+        self.assertEqual(next(events).message, 'three')
+        self.assertEqual(s.events_received, 4)
+        self.assertEqual(s.events_dropped, 1)
+
+    def test_multiline_reply(self):
+        s = self.session(b'Output mode: on\r\n%%+status\r\n',
+                         b'<sip> not an event\r\n<sip:NOTE> event\r\n',
+                         b'%%-status\r\n<sip:NOTE> one\r\n')
+        s.subscribe()
+
+        self.assertEqual(s.send_cmd('status'),
+                         '<sip> not an event\r\n<sip:NOTE> event')
+        self.assertEqual(next(s.events()).message, 'one')
+
+    def test_idle(self):
+        s = self.session(b'Output mode: on\r\n',
+                         socket.timeout('timed out'),
+                         b'<sip:NOTE> one\r\n')
+        s.subscribe()
+
+        self.assertEqual(next(s.events()).message, 'one')
+
+    def test_debug_level(self):
+        s = self.session(b'Output mode: on\r\n',
+                         b'Debug level: 5 local: off\r\n',
+                         b'Debug level: 9 local: off\r\n',
+                         b'Output mode: off\r\n',
+                         b'Debug level: 5 local: off\r\n',
+                         b'Output mode: on\r\nOutput mode: off\r\n')
+
+        s.subscribe(level=9)
+        s.unsubscribe()
+        s.subscribe()
+        s.unsubscribe()
+
+        self.assertEqual(s._socket.sent, [
+            b'output on\r\n', b'debug\r\n', b'debug 9\r\n',
+            b'output off\r\n', b'debug 5\r\n',
+            b'output on\r\n', b'output off\r\n'])
+
+
+# noinspection PyDocstring
+class FakeRManager(threading.Thread):
+    """Minimal rmanager listener, drops the first connection on uptime"""
+
+    replies = {
+        'output off': 'Output mode: off',
+        'debug off': 'Debug level: 0 local: off',
+        'color off': 'Colorized output: no',
+        'uptime': 'Uptime: 0 00:00:10 (10) user: 0.010 kernel: 0.020',
+        'quit': 'Goodbye!',
+    }
+
+    def __init__(self):
+        super(FakeRManager, self).__init__()
+        self.daemon = True
+        self.connections = 0
+        self.lines = []
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+
+    def run(self):
+        while True:
+            conn, _ = self.listener.accept()
+            self.connections += 1
+            conn.sendall(b'YATE 5.0.0 r1 ready.\r\n')
+            data = b''
+
+            while True:
+                chunk = conn.recv(1024)
+
+                if not chunk:
+                    break
+
+                data += chunk
+
+                while b'\r\n' in data:
+                    line, data = data.split(b'\r\n', 1)
+                    line = native(line)
+                    self.lines.append(line)
+
+                    if line == 'uptime' and self.connections == 1:
+                        conn.close()
+                        break
+
+                    conn.sendall(wire(self.replies.get(line, line) + '\r\n'))
+
+                else:
+                    continue
+
+                break
+
+
+class TestReconnect(TestCase):
+
+    def setUp(self):
+        self.server = FakeRManager()
+        self.server.start()
+
+    def test_create_connection(self):
+        sock = libyate.net.create_connection('localhost', self.server.port,
+                                             timeout=5)
+        self.assertEqual(sock.recv(1024), b'YATE 5.0.0 r1 ready.\r\n')
+        sock.close()
+
+    def test_create_connection_refused(self):
+        refused = socket.socket()
+        refused.bind(('127.0.0.1', 0))
+        refused_address = refused.getsockname()
+        refused.close()
+
+        addresses = [
+            (socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '',
+             refused_address),
+            (socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '',
+             ('127.0.0.1', self.server.port)),
+        ]
+
+        getaddrinfo = socket.getaddrinfo
+        socket.getaddrinfo = lambda *args: list(addresses)
+
+        try:
+            sock = libyate.net.create_connection('localhost', self.server.port,
+                                                 timeout=5, delay=5)
+        finally:
+            socket.getaddrinfo = getaddrinfo
+
+        self.assertEqual(sock.getpeername(), ('127.0.0.1', self.server.port))
+        sock.close()
+
+    def test_interleave(self):
+        self.assertEqual(
+            libyate.net.interleave_addresses([(10, 1), (10, 2), (2, 3),
+                                              (2, 4), (2, 5)]),
+            [(10, 1), (2, 3), (10, 2), (2, 4), (2, 5)])
+
+    def test_reconnect(self):
+        session = libyate.rmanager.RManagerSession(
+            port=self.server.port, timeout=5, retries=3)
+        self.assertEqual(session.uptime('total'), 10.0)
+        self.assertEqual(session.reconnections, 1)
+        self.assertEqual(self.server.connections, 2)
+        session.close()
+
+    def test_no_retry(self):
+        session = libyate.rmanager.RManagerSession(
+            port=self.server.port, timeout=5, retries=3)
+
+        # The command may have run before the connection was lost
+        self.assertRaises(EOFError, session.send_cmd, 'uptime', retry=False)
+        self.assertEqual(session.reconnections, 1)
+        self.assertEqual(self.server.lines.count('uptime'), 1)
+        self.assertEqual(session.uptime('total'), 10.0)
+        session.close()
+
+    def test_resubscribe(self):
+        session = libyate.rmanager.RManagerSession(
+            port=self.server.port, timeout=5, retries=3)
+        session.subscribe(level=8)
+        session.uptime()
+
+        self.assertEqual(session.reconnections, 1)
+        self.assertEqual(self.server.lines.count('output on'), 2)
+        self.assertEqual(self.server.lines.count('debug 8'), 2)
+        session.close()
+
+    def test_events_reader(self):
+        session = libyate.rmanager.RManagerSession(
+            port=self.server.port, timeout=5)
+        session.subscribe()
+        replies = []
+
+        def command():
+            while not session._reading:
+                libyate.rmanager.time.sleep(0.001)
+
+            # Read by the events reader, which is blocked on the socket
+            replies.append(session.send_cmd('help'))
+            session.write('<test> done\r\n')
+
+        thread = threading.Thread(target=command)
+        thread.start()
+
+        self.assertEqual(next(session.events()).message, 'done')
+        thread.join()
+
+        self.assertEqual(replies, ['help'])
+        session.close()
+
+    def test_no_reconnect(self):
+        session = libyate.rmanager.RManagerSession(
+            port=self.server.port, timeout=5)
+        self.assertRaises(EOFError, session.uptime)
+
+
+class TestQueryCache(TestCase):
+
+    def setUp(self):
+        self.cache = libyate.rmanager.QueryCache()
+        self.calls = []
+
+    def query(self, value='ok'):
+        self.calls.append(value)
+        return value
+
+    def test_ttl(self):
+        self.assertEqual(self.cache.get('a', 'uptime', self.query), 'ok')
+        self.assertEqual(self.cache.get('a', 'uptime', self.query), 'ok')
+        self.assertEqual(self.cache.get('b', 'uptime', self.query), 'ok')
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+        self.cache.invalidate('a')
+        self.cache.get('a', 'uptime', self.query)
+        self.assertEqual(len(self.calls), 3)
+
+    def test_not_cached(self):
+        self.cache.get('a', 'drop sip/1', self.query)
+        self.cache.get('a', 'drop sip/1', self.query)
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_expired(self):
+        cache = libyate.rmanager.QueryCache(ttl={'uptime': 0.001})
+        cache.get('a', 'uptime', self.query)
+        cache.get('b', 'uptime', self.query)
+        libyate.rmanager.time.sleep(0.01)
+        cache.get('a', 'uptime', self.query)
+        self.assertEqual(len(self.calls), 3)
+
+        # The result of b expired and is removed when a is stored
+        self.assertEqual(len(cache), 1)
+
+    def test_coalescing(self):
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def slow_query():
+            started.set()
+            release.wait()
+            return self.query()
+
+        leader = threading.Thread(target=lambda: results.append(
+            self.cache.get('a', 'status', slow_query)))
+        leader.start()
+        started.wait()
+
+        followers = [threading.Thread(target=lambda: results.append(
+            self.cache.get('a', 'status', self.query))) for _ in range(3)]
+
+        for t in followers:
+            t.start()
+
+        while self.cache.coalesced < 3:
+            libyate.rmanager.time.sleep(0.001)
+
+        release.set()
+
+        for t in [leader] + followers:
+            t.join()
+
+        self.assertEqual(results, ['ok'] * 4)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_error(self):
+        def failing_query():
+            raise IOError('Socket closed')
+
+        self.assertRaises(IOError, self.cache.get, 'a', 'uptime',
+                          failing_query)
+        self.assertEqual(len(self.cache), 0)
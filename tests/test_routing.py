@@ -0,0 +1,168 @@
+"""
+Test cases for libyate.routing
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import libyate.engine
+import libyate.routing
+import libyate.type
+
+from unittest import TestCase
+
+from tests.helpers import PairClient
+
+
+TABLE = r"""
+# called        caller  target                      parameters
+0800            *       sip/sip:{called}@10.0.0.1
+55              *       sip/sip:{1}@10.0.0.2        line=gw2
+5511            100     sip/sip:{1}@10.0.0.3
+5511            /^2/    sip/sip:{caller}@10.0.0.4
+/^9(\d{4})$/    *       sip/sip:{1}@10.0.0.5
+*               *       -                           error=noroute
+"""
+
+
+# Errors on purpose
+LOGGER = logging.getLogger('tests.test_routing')
+LOGGER.addHandler(logging.NullHandler())
+LOGGER.propagate = False
+
+
+def route_message(called, caller='100'):
+    return libyate.engine.Message(
+        name='call.route', kvp={'called': called, 'caller': caller})
+
+
+class TestRoutingTable(TestCase):
+
+    def setUp(self):
+        self.table = libyate.routing.RoutingTable.parse(TABLE)
+
+    def test_prefix(self):
+        self.assertEqual(len(self.table), 6)
+        self.assertEqual(self.table.lookup('08001234'),
+                         ('sip/sip:08001234@10.0.0.1', ()))
+        self.assertEqual(self.table.lookup('5521999', '300'),
+                         ('sip/sip:21999@10.0.0.2', (('line', 'gw2'), )))
+
+    def test_caller(self):
+        self.assertEqual(self.table.lookup('551133', '100')[0],
+                         'sip/sip:33@10.0.0.3')
+        self.assertEqual(self.table.lookup('551133', '200')[0],
+                         'sip/sip:200@10.0.0.4')
+        self.assertEqual(self.table.lookup('551133', '300')[0],
+                         'sip/sip:1133@10.0.0.2')
+
+    def test_regex(self):
+        self.assertEqual(self.table.lookup('91234')[0],
+                         'sip/sip:1234@10.0.0.5')
+        self.assertEqual(self.table.lookup('912345'),
+                         ('-', (('error', 'noroute'), )))
+
+    def test_no_route(self):
+        table = libyate.routing.RoutingTable.parse('0800 * sip/a')
+
+        self.assertTrue(table.lookup('5511') is None)
+        self.assertTrue(libyate.routing.RoutingTable().lookup('') is None)
+
+    def test_invalid(self):
+        for line in ('0800 *', '0800 * sip/a line', '/(/ * sip/a',
+                     '0800 * sip/{2}', '0800 * sip/{number}',
+                     '0800 * sip/{called.x}'):
+            self.assertRaises(ValueError, libyate.routing.RoutingTable.parse,
+                              line)
+
+
+class TestRouter(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'routes.conf')
+        self.write(TABLE)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, text):
+        with open(self.path, 'w') as f:
+            f.write(text)
+
+        # Changes within the file system time resolution
+        os.utime(self.path, (0, os.stat(self.path).st_mtime + 1))
+
+    def test_route(self):
+        router = libyate.routing.Router(self.path)
+        msg = route_message('08001234')
+
+        self.assertEqual(str(router.route(msg)),
+                         '%%<message:{0}:true::sip/sip%z08001234@10.0.0.1:'
+                         .format(libyate.type.yate_encode(msg.id)))
+
+    def test_reply(self):
+        router = libyate.routing.Router(self.path)
+
+        msg = route_message('5521999')
+        reply = router.route(msg)
+
+        self.assertTrue(reply.processed)
+        self.assertEqual(reply.retvalue, 'sip/sip:21999@10.0.0.2')
+        self.assertEqual(reply.kvp, libyate.type.OrderedDict(
+            (('line', 'gw2'), )))
+
+        msg = libyate.engine.Message(name='call.route')
+        self.assertFalse(router.route(msg).processed)
+
+    def test_reload(self):
+        router = libyate.routing.Router(self.path, logger=LOGGER)
+        table = router.table
+
+        self.assertFalse(router.check())
+
+        self.write('0800 * sip/b')
+        self.assertTrue(router.check())
+        self.assertEqual(router.table.lookup('0800')[0], 'sip/b')
+
+        # In-flight lookups keep the previous table
+        self.assertEqual(table.lookup('0800')[0], 'sip/sip:0800@10.0.0.1')
+
+        self.write('0800 *')
+        self.assertFalse(router.check())
+        self.assertEqual(router.table.lookup('0800')[0], 'sip/b')
+
+    def test_watch(self):
+        router = libyate.routing.Router(self.path, interval=0.01)
+        router.start()
+        router.start()
+
+        try:
+            self.assertEqual(len([t for t in threading.enumerate()
+                                  if t.name == 'RouterReload']), 1)
+
+            self.write('0800 * sip/b')
+
+            for _ in range(200):
+                if len(router.table) == 1:
+                    break
+
+                time.sleep(0.01)
+
+        finally:
+            router.stop()
+
+        self.assertEqual(router.table.lookup('0800')[0], 'sip/b')
+        self.assertRaises(ValueError, libyate.routing.Router(self.path).start)
+
+    def test_install(self):
+        app = PairClient(None)
+        libyate.routing.Router(self.path).install(app, priority=50)
+
+        self.assertTrue('call.route' in app.__msg_handlers__)
+        self.assertEqual(app.__startup_queue__.get()[0],
+                         '%%>install:50:call.route::\n')
@@ -0,0 +1,88 @@
+"""
+Test cases for libyate.scheduler
+"""
+
+import libyate.compat
+import libyate.scheduler
+
+from unittest import TestCase
+
+from libyate.scheduler import BULK, CRITICAL, NORMAL
+
+
+class TestFairQueue(TestCase):
+
+    def test_fifo(self):
+        queue = libyate.scheduler.FairQueue()
+
+        for i in range(5):
+            queue.put(i)
+
+        self.assertEqual(queue.qsize(), 5)
+        self.assertEqual([queue.get() for _ in range(5)], list(range(5)))
+        self.assertTrue(queue.empty())
+
+    def test_weights(self):
+        queue = libyate.scheduler.FairQueue()
+
+        for i in range(130):
+            queue.put((BULK, i), BULK)
+        for i in range(40):
+            queue.put((NORMAL, i), NORMAL)
+        for i in range(80):
+            queue.put((CRITICAL, i), CRITICAL)
+
+        first = [queue.get()[0] for _ in range(130)]
+
+        self.assertEqual(first.count(CRITICAL), 80)
+        self.assertEqual(first.count(NORMAL), 40)
+        self.assertEqual(first.count(BULK), 10)
+
+        # Order is kept within each class
+        self.assertEqual([queue.get() for _ in range(120)],
+                         [(BULK, i) for i in range(10, 130)])
+
+    def test_no_starvation(self):
+        queue = libyate.scheduler.FairQueue()
+
+        for i in range(100):
+            queue.put(i, BULK)
+
+        queue.put('route', CRITICAL)
+
+        self.assertEqual(queue.get(), 'route')
+
+        for i in range(100):
+            queue.put(i, CRITICAL)
+
+        self.assertTrue(0 in [queue.get() for _ in range(13)])
+        self.assertEqual(queue.qsize(BULK), 98)
+
+    def test_last(self):
+        queue = libyate.scheduler.FairQueue()
+
+        for i in range(10):
+            queue.put(i, CRITICAL)
+
+        queue.put_last(None)
+        queue.put(10, BULK)
+
+        self.assertEqual(queue.qsize(), 12)
+
+        items = [queue.get() for _ in range(12)]
+
+        self.assertEqual(sorted(items[:-1]), list(range(11)))
+        self.assertTrue(items[-1] is None)
+        self.assertTrue(queue.empty())
+
+    def test_empty(self):
+        queue = libyate.scheduler.FairQueue()
+
+        self.assertRaises(libyate.compat.queue.Empty, queue.get, False)
+        self.assertRaises(libyate.compat.queue.Empty, queue.get, timeout=0.01)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, libyate.scheduler.FairQueue,
+                          {NORMAL: 0})
+        self.assertRaises(KeyError, libyate.scheduler.FairQueue().put, 1,
+                          'unknown')
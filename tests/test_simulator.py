@@ -0,0 +1,79 @@
+"""
+Test cases for libyate.simulator
+"""
+
+import socket
+
+import libyate.simulator
+
+from threading import Thread
+from unittest import TestCase
+
+from tests.helpers import PairClient
+
+
+class TestPercentile(TestCase):
+
+    def test_percentile(self):
+        values = list(range(100))
+        self.assertEqual(libyate.simulator.percentile(values, 0.5), 50)
+        self.assertEqual(libyate.simulator.percentile(values, 0.99), 99)
+        self.assertEqual(libyate.simulator.percentile(values, 1), 99)
+        self.assertEqual(libyate.simulator.percentile([], 0.5), None)
+
+
+class TestEngine(TestCase):
+
+    def run_engine(self, app, engine_sock, engine):
+        result = {}
+
+        def run():
+            try:
+                result.update(engine.run(engine_sock.makefile('rb'),
+                                         engine_sock.sendall))
+            finally:
+                engine_sock.shutdown(socket.SHUT_RDWR)
+                engine_sock.close()
+
+        thread = Thread(target=run)
+        thread.start()
+        app.main(threaded=False)
+        thread.join()
+
+        return result
+
+    def test_round_trip(self):
+        engine_sock, app_sock = socket.socketpair()
+
+        app = PairClient(app_sock)
+        app.install(app.call_route, 'call.route')
+        app.watch(app.ignore, 'call.route')
+        app.set_local('engine.version')
+
+        engine = libyate.simulator.Engine(rate=1000, duration=0.1, timeout=2)
+        result = self.run_engine(app, engine_sock, engine)
+
+        self.assertTrue(result['sent'] > 0)
+        self.assertEqual(result['sent'], result['replied'])
+        self.assertEqual(result['unanswered'], 0)
+        self.assertEqual(result['errors'], 0)
+        self.assertTrue(result['p50'] <= result['max'])
+        self.assertEqual(result['received']['Install'], 1)
+        self.assertEqual(result['received']['Watch'], 1)
+        self.assertEqual(result['received']['SetLocal'], 1)
+        self.assertEqual(engine.watchers, set(['call.route']))
+
+    def test_unanswered(self):
+        engine_sock, app_sock = socket.socketpair()
+
+        app = PairClient(app_sock)
+        app.install(app.ignore, 'call.cdr')
+
+        engine = libyate.simulator.Engine(rate=1000, duration=0.05,
+                                          timeout=0.1)
+        engine.add_message('call.cdr', {'billid': '1'})
+        result = self.run_engine(app, engine_sock, engine)
+
+        self.assertTrue(result['sent'] > 0)
+        self.assertEqual(result['replied'], 0)
+        self.assertEqual(result['unanswered'], result['sent'])
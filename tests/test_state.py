@@ -0,0 +1,161 @@
+"""
+Test cases for libyate.state
+"""
+
+import time
+
+import libyate.engine
+import libyate.state
+
+from threading import Thread
+from unittest import TestCase
+
+from tests.helpers import PairClient
+
+
+def hangup_message(id):
+    return libyate.engine.MessageReply(
+        processed=False, name='chan.hangup',
+        kvp={'id': id, 'reason': 'normal'})
+
+
+class StateClient(PairClient):
+    """Socket client with a call state store"""
+
+    # noinspection PyMissingConstructor
+    def __init__(self, sock, calls):
+        libyate.extmodule.Application.__init__(self, calls=calls)
+        self._init_connection(sock)
+
+    def call_route(self, msg):
+        self.calls.for_message(msg)['called'] = msg.kvp['called']
+        return msg.reply(True, retvalue='sip/{0}'.format(msg.kvp['called']))
+
+
+class TestCallStore(TestCase):
+
+    def test_state(self):
+        calls = libyate.state.CallStore()
+
+        calls.state('sip/1')['route'] = 'a'
+
+        self.assertEqual(calls.get('sip/1'), {'route': 'a'})
+        self.assertTrue(calls.state('sip/1') is calls.get('sip/1'))
+        self.assertTrue(calls.get('sip/2') is None)
+        self.assertTrue('sip/1' in calls)
+        self.assertEqual(len(calls), 1)
+
+        self.assertEqual(calls.pop('sip/1'), {'route': 'a'})
+        self.assertEqual(len(calls), 0)
+        self.assertRaises(ValueError, libyate.state.CallStore, stripes=0)
+
+    def test_hangup(self):
+        calls = libyate.state.CallStore()
+        calls.state('sip/1')
+
+        self.assertEqual(calls.hangup(hangup_message('sip/1')), {})
+        self.assertTrue(calls.hangup(hangup_message('sip/1')) is None)
+        self.assertTrue(calls.for_message(
+            libyate.engine.Message(name='chan.hangup')) is None)
+        self.assertEqual(calls.hangups, 1)
+
+    def test_timeout(self):
+        calls = libyate.state.CallStore(timeout=0.05)
+
+        calls.state('sip/1')
+        calls.state('sip/2')
+        time.sleep(0.1)
+        calls.state('sip/3')
+
+        # Storing sip/3 already expires the states sharing its stripe
+        calls.expire()
+        self.assertEqual(calls.expirations, 2)
+        self.assertEqual(len(calls), 1)
+        self.assertTrue('sip/3' in calls)
+
+    def test_size(self):
+        calls = libyate.state.CallStore(size=2, stripes=1)
+
+        for id in ('sip/1', 'sip/2', 'sip/1', 'sip/3'):
+            calls.state(id)
+
+        self.assertEqual(len(calls), 2)
+        self.assertTrue('sip/2' not in calls)
+        self.assertEqual(calls.evictions, 1)
+
+    def test_threads(self):
+        calls = libyate.state.CallStore(stripes=4)
+
+        def run(n):
+            for i in range(1000):
+                state = calls.state('sip/{0}'.format(i % 50))
+                state[n] = i
+
+        threads = [Thread(target=run, args=(n, )) for n in range(4)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 50)
+        self.assertEqual(calls.get('sip/49'), {0: 999, 1: 999, 2: 999,
+                                               3: 999})
+
+
+class TestApplicationCallStore(TestCase):
+
+    def test_hangup(self):
+        app = StateClient(None, libyate.state.CallStore())
+        app.install(app.call_route, 'call.route')
+
+        self.assertEqual(app.__startup_queue__.get()[0],
+                         '%%>watch:chan.hangup\n')
+
+        app._command_message(libyate.engine.Message(
+            name='call.route', kvp={'id': 'sip/1', 'called': '200'}))
+        self.assertEqual(app.calls.get('sip/1'), {'called': '200'})
+        self.assertEqual(app.metrics.snapshot()['gauges']
+                         ['libyate_call_states'], {(): 1})
+
+        app._command_message(hangup_message('sip/1'))
+        self.assertTrue(app.calls.get('sip/1') is None)
+
+    def test_watch(self):
+        app = StateClient(None, libyate.state.CallStore())
+        notifications = []
+
+        def hangup(msg):
+            notifications.append(app.calls.get('sip/1'))
+
+        app.calls.state('sip/1')['called'] = '200'
+        app.watch(hangup, 'chan.hangup')
+        app._command_message(hangup_message('sip/1'))
+
+        self.assertEqual(notifications, [{'called': '200'}])
+        self.assertTrue(app.calls.get('sip/1') is None)
+        self.assertRaises(KeyError, app.watch, hangup, 'chan.hangup')
+        self.assertEqual(app.__startup_queue__.qsize(), 1)
+
+    def test_watch_batch(self):
+        app = StateClient(None, libyate.state.CallStore())
+        notifications = []
+
+        def hangup(msgs):
+            notifications.append([app.calls.get(msg.kvp['id'])
+                                  for msg in msgs])
+
+        app.calls.state('sip/1')['called'] = '200'
+        app.calls.state('sip/2')['called'] = '201'
+        app.watch(hangup, 'chan.hangup',
+                  batch=libyate.extmodule.NotificationBatch(size=2))
+
+        # The states live until the batch is delivered
+        app._command_message(hangup_message('sip/1'))
+        self.assertEqual(app.calls.get('sip/1'), {'called': '200'})
+
+        app._command_message(hangup_message('sip/2'))
+        self.assertEqual(notifications, [[{'called': '200'},
+                                          {'called': '201'}]])
+        self.assertEqual(len(app.calls), 0)
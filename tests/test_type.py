@@ -5,6 +5,8 @@ Test cases for libyate.type
 import libyate.type
 from unittest import TestCase
 
+from libyate.compat import PY3, native, with_metaclass
+
 
 #
 # Meta classes
@@ -22,9 +24,7 @@ class TypeCaseMeta(type):
         values = attrs.get('values', ())
 
         # noinspection PyDocstring
-        class C(object):
-            __metaclass__ = libyate.type.DescriptorMeta
-
+        class C(with_metaclass(libyate.type.DescriptorMeta)):
             attr = type_class(blank=True)
             not_blank = type_class()
 
@@ -63,7 +63,7 @@ class TestYateEncodeDecode(TestCase):
         ('', ''),
     )
 
-    for i in xrange(32):
+    for i in range(32):
         strings += (('%{0:c}'.format(i+64), chr(i)),)
 
     def test_decode_raise(self):
@@ -106,9 +106,7 @@ for n, (e, d) in enumerate(TestYateEncodeDecode.strings):
             test_encode_nok(e, d))
 
 
-class TestBaseType(TestCase):
-
-    __metaclass__ = TypeCaseMeta
+class TestBaseType(with_metaclass(TypeCaseMeta, TestCase)):
 
     type_class = libyate.type.Descriptor
     values = (
@@ -123,18 +121,14 @@ class TestBaseType(TestCase):
 
     def test_repr(self):
         # noinspection PyDocstring
-        class C(object):
-            __metaclass__ = libyate.type.DescriptorMeta
-
+        class C(with_metaclass(libyate.type.DescriptorMeta)):
             attr = self.type_class()
 
         self.assertEqual(repr(C.attr), '<libyate.type.Descriptor "attr">')
 
     def test_delete(self):
         # noinspection PyDocstring
-        class C(object):
-            __metaclass__ = libyate.type.DescriptorMeta
-
+        class C(with_metaclass(libyate.type.DescriptorMeta)):
             attr = libyate.type.Descriptor()
 
         o = C()
@@ -147,9 +141,7 @@ class TestBaseType(TestCase):
         self.assertTrue('attr' not in o.__dict__)
 
 
-class TestBoolean(TestCase):
-
-    __metaclass__ = TypeCaseMeta
+class TestBoolean(with_metaclass(TypeCaseMeta, TestCase)):
 
     type_class = libyate.type.Boolean
     values = (
@@ -163,9 +155,7 @@ class TestBoolean(TestCase):
 
     def test_raises(self):
         # noinspection PyDocstring
-        class C(object):
-            __metaclass__ = libyate.type.DescriptorMeta
-
+        class C(with_metaclass(libyate.type.DescriptorMeta)):
             attr = self.type_class()
 
         o = C()
@@ -174,10 +164,9 @@ class TestBoolean(TestCase):
         self.assertRaises(TypeError, setattr, o, 'attr', 0)
 
 
-class TestDateTime(TestCase):
-    from datetime import datetime
+class TestDateTime(with_metaclass(TypeCaseMeta, TestCase)):
 
-    __metaclass__ = TypeCaseMeta
+    from datetime import datetime
 
     type_class = libyate.type.DateTime
     values = (
@@ -191,9 +180,7 @@ class TestDateTime(TestCase):
 
     def test_raises(self):
         # noinspection PyDocstring
-        class C(object):
-            __metaclass__ = libyate.type.DescriptorMeta
-
+        class C(with_metaclass(libyate.type.DescriptorMeta)):
             attr = self.type_class()
 
         o = C()
@@ -202,9 +189,7 @@ class TestDateTime(TestCase):
         self.assertRaises(TypeError, setattr, o, 'attr', True)
 
 
-class TestInteger(TestCase):
-
-    __metaclass__ = TypeCaseMeta
+class TestInteger(with_metaclass(TypeCaseMeta, TestCase)):
 
     type_class = libyate.type.Integer
     values = (
@@ -216,9 +201,7 @@ class TestInteger(TestCase):
 
     def test_raises(self):
         # noinspection PyDocstring
-        class C(object):
-            __metaclass__ = libyate.type.DescriptorMeta
-
+        class C(with_metaclass(libyate.type.DescriptorMeta)):
             attr = self.type_class()
 
         o = C()
@@ -227,8 +210,7 @@ class TestInteger(TestCase):
         self.assertRaises(TypeError, setattr, o, 'attr', True)
 
 
-class TestKeyValueList(TestCase):
-    __metaclass__ = TypeCaseMeta
+class TestKeyValueList(with_metaclass(TypeCaseMeta, TestCase)):
 
     type_class = libyate.type.KeyValueList
     values = (
@@ -263,9 +245,7 @@ class TestKeyValueList(TestCase):
 
     def test_raises(self):
         # noinspection PyDocstring
-        class C(object):
-            __metaclass__ = libyate.type.DescriptorMeta
-
+        class C(with_metaclass(libyate.type.DescriptorMeta)):
             attr = self.type_class()
 
         o = C()
@@ -277,9 +257,7 @@ class TestKeyValueList(TestCase):
     # noinspection PyUnresolvedReferences
     def test_values(self):
         # noinspection PyDocstring
-        class KVP(object):
-            __metaclass__ = libyate.type.DescriptorMeta
-
+        class KVP(with_metaclass(libyate.type.DescriptorMeta)):
             kvp = libyate.type.KeyValueList()
 
         kvp = KVP()
@@ -293,10 +271,9 @@ class TestKeyValueList(TestCase):
         self.assertEqual(kvp.kvp['path'], '/bin:/usr/bin:')
 
 
-class TestString(TestCase):
-    from datetime import datetime
+class TestString(with_metaclass(TypeCaseMeta, TestCase)):
 
-    __metaclass__ = TypeCaseMeta
+    from datetime import datetime
 
     type_class = libyate.type.String
     values = (
@@ -311,9 +288,7 @@ class TestString(TestCase):
 
     def test_raises(self):
         # noinspection PyDocstring
-        class C(object):
-            __metaclass__ = libyate.type.DescriptorMeta
-
+        class C(with_metaclass(libyate.type.DescriptorMeta)):
             attr = self.type_class()
 
         o = C()
@@ -323,9 +298,7 @@ class TestString(TestCase):
 
     def test_length(self):
         # noinspection PyDocstring
-        class C(object):
-            __metaclass__ = libyate.type.DescriptorMeta
-
+        class C(with_metaclass(libyate.type.DescriptorMeta)):
             attr = libyate.type.String(length=3)
 
         o = C()
@@ -336,9 +309,7 @@ class TestString(TestCase):
 
     def test_max_length(self):
         # noinspection PyDocstring
-        class C(object):
-            __metaclass__ = libyate.type.DescriptorMeta
-
+        class C(with_metaclass(libyate.type.DescriptorMeta)):
             attr = libyate.type.String(max_length=3)
 
         o = C()
@@ -349,9 +320,7 @@ class TestString(TestCase):
 
     def test_min_length(self):
         # noinspection PyDocstring
-        class C(object):
-            __metaclass__ = libyate.type.DescriptorMeta
-
+        class C(with_metaclass(libyate.type.DescriptorMeta)):
             attr = libyate.type.String(min_length=3)
 
         o = C()
@@ -362,9 +331,7 @@ class TestString(TestCase):
 
     def test_max_min_length(self):
         # noinspection PyDocstring
-        class C(object):
-            __metaclass__ = libyate.type.DescriptorMeta
-
+        class C(with_metaclass(libyate.type.DescriptorMeta)):
             attr = libyate.type.String(min_length=2, max_length=4)
 
         o = C()
@@ -376,9 +343,7 @@ class TestString(TestCase):
         self.assertRaises(ValueError, setattr, o, 'attr', 'abcde')
 
 
-class TestEncodedString(TestCase):
-
-    __metaclass__ = TypeCaseMeta
+class TestEncodedString(with_metaclass(TypeCaseMeta, TestCase)):
 
     type_class = libyate.type.EncodedString
     values = (
@@ -393,9 +358,7 @@ class TestEncodedString(TestCase):
 
     def test_raises(self):
         # noinspection PyDocstring
-        class C(object):
-            __metaclass__ = libyate.type.DescriptorMeta
-
+        class C(with_metaclass(libyate.type.DescriptorMeta)):
             attr = self.type_class()
 
         o = C()
@@ -405,9 +368,7 @@ class TestEncodedString(TestCase):
 
     def test_length(self):
         # noinspection PyDocstring
-        class C(object):
-            __metaclass__ = libyate.type.DescriptorMeta
-
+        class C(with_metaclass(libyate.type.DescriptorMeta)):
             attr = libyate.type.String(length=3)
 
         o = C()
@@ -421,9 +382,7 @@ class TestEncodedString(TestCase):
 
     def test_max_length(self):
         # noinspection PyDocstring
-        class C(object):
-            __metaclass__ = libyate.type.DescriptorMeta
-
+        class C(with_metaclass(libyate.type.DescriptorMeta)):
             attr = libyate.type.String(max_length=3)
 
         o = C()
@@ -437,9 +396,7 @@ class TestEncodedString(TestCase):
 
     def test_min_length(self):
         # noinspection PyDocstring
-        class C(object):
-            __metaclass__ = libyate.type.DescriptorMeta
-
+        class C(with_metaclass(libyate.type.DescriptorMeta)):
             attr = libyate.type.String(min_length=3)
 
         o = C()
@@ -453,9 +410,7 @@ class TestEncodedString(TestCase):
 
     def test_max_min_length(self):
         # noinspection PyDocstring
-        class C(object):
-            __metaclass__ = libyate.type.DescriptorMeta
-
+        class C(with_metaclass(libyate.type.DescriptorMeta)):
             attr = libyate.type.String(min_length=2, max_length=4)
 
         o = C()
@@ -517,28 +472,103 @@ class TestOrderedDict(TestCase):
         del new['job']
         self.assertRaises(KeyError, new.__getitem__, 'job')
 
-#fixme: move to rmanager test
-# class TestYateStatus(TestCase):
-#     string = 'name=cdrbuild,type=cdr,format=Status|Caller|Called|BillId|' \
-#              'Duration;cdrs=5,hungup=0;sip/4=answered|test|99991007|' \
-#              '1403660477-4|12,sip/5=answered|test|99991007|1403660477-6|3,' \
-#              'sip/6=answered|test|99991007|1403660477-8|2,sip/7=answered|' \
-#              'test|99991007|1403660477-10|2,sip/8=answered|test|99991007|' \
-#              '1403660477-12|2'
-#     obj = libyate.type.YateStatus(string)
-#
-#     def test_repr(self):
-#         self.assertEqual(repr(self.obj),
-#                          '<libyate.type.YateStatus "cdrbuild">')
-#
-#     def test_attrs(self):
-#         self.assertEqual(self.obj.definition['name'], 'cdrbuild')
-#         self.assertEqual(self.obj.definition['format'],
-#                          'Status|Caller|Called|BillId|Duration')
-#         self.assertEqual(self.obj.status['cdrs'], '5')
-#         self.assertEqual(len(self.obj.nodes), 5)
-#         self.assertEqual(self.obj.nodes['sip/4']['BillId'], '1403660477-4')
-#         self.assertEqual(self.obj.nodes['sip/4']['Called'], '99991007')
-#         self.assertEqual(self.obj.nodes['sip/4']['Caller'], 'test')
-#         self.assertEqual(self.obj.nodes['sip/4']['Duration'], '12')
-#         self.assertEqual(self.obj.nodes['sip/4']['Status'], 'answered')
+
+class TestTrackedDict(TestCase):
+
+    def test_changes(self):
+        kvp = libyate.type.TrackedDict((('a', '1'), ('b', '2'), ('c', '3')))
+        self.assertFalse(kvp.modified)
+
+        kvp['a'] = '1'
+        self.assertFalse(kvp.modified)
+
+        kvp['a'] = 'x'
+        del kvp['b']
+        kvp.update(d='4')
+        kvp.pop('c')
+        kvp.setdefault('e', '5')
+
+        self.assertTrue(kvp.modified)
+        self.assertEqual(list(kvp.changes().items()),
+                         [('a', 'x'), ('b', None), ('d', '4'), ('c', None),
+                          ('e', '5')])
+        self.assertEqual(libyate.type.obj_to_str(kvp.changes()),
+                         'a=x:b:d=4:c:e=5')
+
+    def test_copy(self):
+        kvp = libyate.type.TrackedDict((('a', '1'), ))
+        kvp['a'] = '2'
+
+        self.assertFalse(kvp.copy().modified)
+        self.assertEqual(kvp.copy(), kvp)
+
+
+class TestLazyDict(TestCase):
+
+    string = 'sdp_raw=v=0%Jo=- 1 1 IN IP4 10.0.0.1%J:caller=100:called'
+
+    def test_iter_kvp(self):
+        pairs = libyate.type.iter_kvp(self.string)
+
+        self.assertEqual(next(pairs),
+                         ('sdp_raw', 'v=0\no=- 1 1 IN IP4 10.0.0.1\n'))
+        self.assertEqual(list(pairs), [('caller', '100'), ('called', '')])
+        self.assertRaises(ValueError, list,
+                          libyate.type.iter_kvp('a=1:=2'))
+
+    def test_raw_size(self):
+        pairs = list(libyate.type.iter_kvp(self.string, raw_size=10))
+
+        self.assertTrue(isinstance(pairs[0][1], libyate.type.RawValue))
+        self.assertEqual(pairs[0][1], 'v=0%Jo=- 1 1 IN IP4 10.0.0.1%J')
+        self.assertEqual(pairs[0][1].decode(),
+                         'v=0\no=- 1 1 IN IP4 10.0.0.1\n')
+        self.assertFalse(isinstance(pairs[1][1], libyate.type.RawValue))
+
+    def test_read(self):
+        expected = libyate.type.KeyValueList().format(self.string)
+        kvp = libyate.type.KeyValueList(raw_size=10).format(self.string)
+
+        # Decoded on Python 2, where copies would return the raw values
+        self.assertEqual(isinstance(kvp, libyate.type.LazyDict), PY3)
+        self.assertEqual(dict(kvp), expected)
+        self.assertEqual((lambda **k: k)(**kvp), expected)
+        self.assertEqual(libyate.type.OrderedDict(kvp), expected)
+        self.assertEqual(kvp, expected)
+        self.assertEqual(list(kvp.items()), list(expected.items()))
+        self.assertEqual(kvp.get('sdp_raw'), expected['sdp_raw'])
+        self.assertEqual(libyate.type.obj_to_str(kvp), self.string)
+
+        kvp = libyate.type.LazyDict(
+            libyate.type.iter_kvp(self.string, raw_size=10))
+
+        self.assertEqual(kvp.raw, ['sdp_raw'])
+        self.assertEqual(kvp['sdp_raw'], expected['sdp_raw'])
+        self.assertEqual(kvp.raw, [])
+
+    def test_tracked(self):
+        kvp = libyate.type.LazyTrackedDict(
+            libyate.type.iter_kvp(self.string, raw_size=10))
+
+        self.assertTrue(isinstance(kvp, libyate.type.LazyTrackedDict))
+
+        kvp['sdp_raw'] = 'v=0\no=- 1 1 IN IP4 10.0.0.1\n'
+        self.assertFalse(kvp.modified)
+
+        kvp['sdp_raw'] = ''
+        self.assertEqual(list(kvp.changes().items()), [('sdp_raw', '')])
+
+    def test_small(self):
+        kvp = libyate.type.KeyValueList(raw_size=100).format(self.string)
+
+        self.assertFalse(isinstance(kvp, libyate.type.LazyDict))
+
+
+class TestUnicode(TestCase):
+
+    def test_obj_to_str(self):
+        self.assertEqual(libyate.type.obj_to_str(u'caf\xe9'),
+                         native(b'caf\xc3\xa9'))
+        self.assertTrue(isinstance(
+            libyate.type.obj_to_str(libyate.type.OrderedDict(
+                ((u'name', u'Jos\xe9'), ))), str))